@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ベンダー名・別名の辞書（Aho-Corasickオートマトン）
+取り込み時にベンダー名と別名から構築してインデックスのバージョンと一緒に保存し、
+検索時は質問に含まれるベンダー名を1パスで検出する。質問がベンダー名だけで特定できる場合は
+埋め込みとベクトル検索を省略して、該当ベンダーの情報をそのまま返す
+"""
+
+import os
+import re
+import json
+import unicodedata
+from collections import deque
+from typing import Iterable, Optional
+
+ALIAS_INDEX_FILE = "alias_index.json"
+
+# 辞書に登録する最小文字数（1文字の別名は誤検出が多いため除外）
+MIN_ALIAS_LENGTH = 2
+
+# ベンダー名を除いた残りがこれらの語だけなら「ベンダー名で特定できた」とみなす
+# （「ハブルの概要は？」は特定済み、「ハブルと似たベンダーは？」は「似た」が残るため未特定）
+GENERIC_TERMS = (
+    "について", "に関して", "に関する", "とは", "って", "という", "の", "は", "を", "が", "と", "も",
+    "教えて", "ください", "下さい", "知りたい", "詳しく", "ですか", "ますか", "です", "か",
+    "概要", "詳細", "情報", "特徴", "サービス", "どんな", "どういう", "何", "なに",
+    "というベンダー", "という会社", "どんなベンダー", "どんな会社", "url",
+)
+
+_IGNORED_CHARS = re.compile(r"[\s\W_]+", re.UNICODE)
+_PARENTHESES = re.compile(r"[（(]([^）)]*)[）)]")
+
+def _fold_kana(text: str) -> str:
+    """カタカナをひらがなに揃える（ハブル / はぶる を同一視）"""
+    return "".join(
+        chr(ord(char) - 0x60) if "ァ" <= char <= "ヶ" else char
+        for char in text
+    )
+
+def normalize_for_alias(text: str) -> str:
+    """照合用の正規化（NFKC・小文字化・カタカナのひらがな化・記号と空白を1つの空白に）"""
+    text = _fold_kana(unicodedata.normalize("NFKC", text).casefold())
+    return _IGNORED_CHARS.sub(" ", text)
+
+def name_variants(metadata: dict) -> list[str]:
+    """
+    ベンダー名と別名から辞書に登録する表記を作成
+
+    「LegalForce（LegalOn）」のような括弧書きは括弧の外と中をそれぞれ登録し（「旧」は外した表記も登録）、
+    「GVA assist/OLGA」のようなスラッシュ区切りは全体と各部分を登録する。
+    """
+    names = [str(metadata.get("name") or "")]
+    names += [alias.strip() for alias in str(metadata.get("aliases") or "").split(",")]
+
+    variants = []
+    for name in names:
+        variants.append(name)
+        variants.append(_PARENTHESES.sub(" ", name))
+        for inner in _PARENTHESES.findall(name):
+            variants.extend((inner, inner.removeprefix("旧")))
+        if "/" in name:
+            variants.extend(name.split("/"))
+
+    normalized = []
+    for variant in variants:
+        variant = normalize_for_alias(variant).strip()
+        if len(variant) >= MIN_ALIAS_LENGTH and variant not in normalized:
+            normalized.append(variant)
+    return normalized
+
+def _is_word_char(char: str) -> bool:
+    return char.isascii() and char.isalnum()
+
+class AliasIndex:
+    """ベンダー名・別名を検出する Aho-Corasick オートマトン"""
+
+    def __init__(self, patterns: dict):
+        """
+        初期化（通常は build() または load() から生成）
+
+        Args:
+            patterns: 正規化した表記 → ベンダーIDのリスト
+        """
+        self.patterns = patterns
+        self._build_automaton()
+
+    def _build_automaton(self):
+        """遷移表・失敗遷移・出力（その状態で終わる表記）を構築"""
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for pattern in self.patterns:
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                state = next_state
+            self._output[state].append(pattern)
+
+        # 幅優先で失敗遷移を設定し、失敗先の出力を引き継ぐ
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    @classmethod
+    def build(cls, records: Iterable[tuple[str, dict]]) -> "AliasIndex":
+        """
+        (ベンダーID, メタデータ) の列から辞書を構築
+
+        Args:
+            records: ベンダーIDと vendor_fields 形式のメタデータの組
+        """
+        patterns = {}
+        for vendor_id, metadata in records:
+            for variant in name_variants(metadata):
+                vendor_ids = patterns.setdefault(variant, [])
+                if vendor_id not in vendor_ids:
+                    vendor_ids.append(vendor_id)
+        return cls(patterns)
+
+    def save(self, directory: str):
+        """インデックスのディレクトリに保存（オートマトンは読み込み時に再構築する）"""
+        path = os.path.join(directory, ALIAS_INDEX_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"patterns": self.patterns}, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["AliasIndex"]:
+        """インデックスのディレクトリから読み込み（ファイルがない場合はNone）"""
+        path = os.path.join(directory, ALIAS_INDEX_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["patterns"])
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+    def find(self, text: str) -> list[tuple[int, int, str]]:
+        """
+        正規化済みのテキストからベンダー名を検出
+
+        英数字で始まる（終わる）表記は、前後が英数字の場合は一致とみなさない（rist と christ など）。
+        重なる一致は先に始まるもの、同じ位置なら長いものを優先する。
+
+        Returns:
+            (開始位置, 終了位置, 表記) のリスト（出現順）
+        """
+        matches = []
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for pattern in self._output[state]:
+                start = end - len(pattern)
+                if _is_word_char(pattern[0]) and start > 0 and _is_word_char(text[start - 1]):
+                    continue
+                if _is_word_char(pattern[-1]) and end < len(text) and _is_word_char(text[end]):
+                    continue
+                matches.append((start, end, pattern))
+
+        selected, position = [], 0
+        for start, end, pattern in sorted(matches, key=lambda match: (match[0], match[0] - match[1])):
+            if start >= position:
+                selected.append((start, end, pattern))
+                position = end
+        return selected
+
+    def resolve(self, question: str) -> tuple[list[str], bool]:
+        """
+        質問に含まれるベンダーを特定
+
+        Args:
+            question: ユーザーの質問
+
+        Returns:
+            (言及されたベンダーIDのリスト（出現順・重複なし）,
+             ベンダー名以外に検索が必要な語が残っていないかどうか)
+        """
+        text = normalize_for_alias(question)
+        matches = self.find(text)
+        if not matches:
+            return [], False
+
+        vendor_ids = []
+        residue, position = [], 0
+        for start, end, pattern in matches:
+            residue.append(text[position:start])
+            position = end
+            for vendor_id in self.patterns[pattern]:
+                if vendor_id not in vendor_ids:
+                    vendor_ids.append(vendor_id)
+        residue.append(text[position:])
+
+        residue = " ".join(residue)
+        for term in _GENERIC_TERMS:
+            residue = residue.replace(term, " ")
+        return vendor_ids, not residue.strip()
+
+# 長い語から取り除く（「という会社」を「という」より先に）
+_GENERIC_TERMS = sorted({normalize_for_alias(term).strip() for term in GENERIC_TERMS}, key=len, reverse=True)
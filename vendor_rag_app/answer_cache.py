@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+回答キャッシュ
+(正規化した質問, 検索条件, モデル, インデックスのバージョン) をキーに生成済みの回答を保持し、
+同じ質問で検索とLLMの呼び出しを繰り返さないようにする。
+プロセス内のメモリ、または複数ワーカーで共有できるSQLiteを選べる（TTL・件数上限付きLRU）
+"""
+
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+# 回答キャッシュの種類（memory: プロセス内 / sqlite: ファイルで共有 / off: 無効）
+ANSWER_CACHE_BACKENDS = ("memory", "sqlite", "off")
+
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 1000
+
+def normalize_question(question: str) -> str:
+    """キャッシュキー用の質問の正規化（NFKC・小文字化・連続空白の圧縮・前後空白除去）"""
+    question = unicodedata.normalize("NFKC", question).casefold()
+    return re.sub(r"\s+", " ", question).strip()
+
+def make_answer_key(question: str, params: dict) -> str:
+    """
+    キャッシュキーの生成
+
+    Args:
+        question: ユーザーの質問
+        params: 回答に影響する条件（検索件数・検索方法・絞り込み・モデル・インデックスのバージョンなど）
+    """
+    payload = json.dumps([normalize_question(question), params], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class AnswerCache:
+    """回答キャッシュの共通処理（統計）"""
+
+    def __init__(self, ttl: float = DEFAULT_TTL_SECONDS, max_entries: int = DEFAULT_MAX_ENTRIES):
+        """
+        初期化
+
+        Args:
+            ttl: 有効期限（秒）。0以下なら期限なし
+            max_entries: 保持する最大件数（超えた分は最終アクセスの古い順に削除）
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl > 0 and now - created_at > self.ttl
+
+    def get(self, key: str, version: str) -> Optional[tuple[str, dict]]:
+        """
+        キャッシュ済みの回答を取得
+
+        Args:
+            key: make_answer_key() で生成したキー
+            version: 公開中のインデックスのバージョン（変わっていれば古い回答を破棄する）
+
+        Returns:
+            (回答, トークン数情報)。未キャッシュ・期限切れの場合はNone
+        """
+        raise NotImplementedError
+
+    def put(self, key: str, version: str, response: str, token_info: dict):
+        """回答を保存"""
+        raise NotImplementedError
+
+    def _count(self) -> int:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        """ヒット・ミス数などの統計を取得"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+            "entries": self._count()
+        }
+
+class MemoryAnswerCache(AnswerCache):
+    """プロセス内のメモリに保持する回答キャッシュ"""
+
+    def __init__(self, ttl: float = DEFAULT_TTL_SECONDS, max_entries: int = DEFAULT_MAX_ENTRIES):
+        super().__init__(ttl, max_entries)
+        # キー → (バージョン, 作成時刻, 回答, トークン数情報)。末尾が最近使ったもの
+        self._entries = OrderedDict()
+        self._version = None
+
+    def _invalidate_other_versions(self, version: str):
+        """バージョンが切り替わったら、それ以前の回答をすべて破棄（ロック取得済みで呼ぶ）"""
+        if version == self._version:
+            return
+        stale = [key for key, entry in self._entries.items() if entry[0] != version]
+        for key in stale:
+            del self._entries[key]
+        self.invalidations += len(stale)
+        self._version = version
+
+    def get(self, key: str, version: str) -> Optional[tuple[str, dict]]:
+        with self._lock:
+            self._invalidate_other_versions(version)
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[1], time.time()):
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2], dict(entry[3])
+
+    def put(self, key: str, version: str, response: str, token_info: dict):
+        with self._lock:
+            self._invalidate_other_versions(version)
+            self._entries[key] = (version, time.time(), response, dict(token_info))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _count(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+class SQLiteAnswerCache(AnswerCache):
+    """SQLiteに保存する回答キャッシュ（同じファイルを使う複数ワーカー・再起動後も共有）"""
+
+    def __init__(self, path: str, ttl: float = DEFAULT_TTL_SECONDS, max_entries: int = DEFAULT_MAX_ENTRIES):
+        """
+        初期化
+
+        Args:
+            path: SQLiteファイルのパス
+            ttl: 有効期限（秒）。0以下なら期限なし
+            max_entries: 保持する最大件数
+        """
+        super().__init__(ttl, max_entries)
+        self.path = path
+        self._version = None
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        # Streamlitなど複数スレッドから利用されるため、接続はロックで保護して共有する
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY,
+                version TEXT NOT NULL,
+                response TEXT NOT NULL,
+                token_info TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_last_access ON answers(last_access)")
+        self._conn.commit()
+
+    def _invalidate_other_versions(self, version: str):
+        """バージョンが切り替わったら、それ以前の回答をすべて削除（ロック取得済みで呼ぶ）"""
+        if version == self._version:
+            return
+        cursor = self._conn.execute("DELETE FROM answers WHERE version != ?", (version,))
+        self.invalidations += cursor.rowcount
+        self._conn.commit()
+        self._version = version
+
+    def get(self, key: str, version: str) -> Optional[tuple[str, dict]]:
+        with self._lock:
+            self._invalidate_other_versions(version)
+            row = self._conn.execute(
+                "SELECT response, token_info, created_at FROM answers WHERE key = ? AND version = ?",
+                (key, version)
+            ).fetchone()
+            now = time.time()
+            if row is not None and self._expired(row[2], now):
+                self._conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+                self._conn.commit()
+                self.expirations += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE answers SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0], json.loads(row[1])
+
+    def put(self, key: str, version: str, response: str, token_info: dict):
+        now = time.time()
+        with self._lock:
+            self._invalidate_other_versions(version)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers (key, version, response, token_info, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, version, response, json.dumps(token_info, ensure_ascii=False), now, now)
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """件数の上限を超えた分を最終アクセスの古い順に削除（ロック取得済みで呼ぶ）"""
+        count = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+        excess = count - self.max_entries
+        if excess <= 0:
+            return
+        self._conn.execute(
+            "DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY last_access ASC LIMIT ?)",
+            (excess,)
+        )
+        self.evictions += excess
+
+    def _count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+    def close(self):
+        """接続を閉じる"""
+        with self._lock:
+            self._conn.close()
+
+def open_answer_cache(vectordb_path: str) -> Optional[AnswerCache]:
+    """
+    環境変数の設定に従って回答キャッシュを作成
+
+    - VENDOR_RAG_ANSWER_CACHE: memory（デフォルト） / sqlite / off
+    - VENDOR_RAG_ANSWER_CACHE_PATH: sqlite の保存先（デフォルトはベクトルDBの隣）
+    - VENDOR_RAG_ANSWER_CACHE_TTL: 有効期限（秒、デフォルト: 86400）
+    - VENDOR_RAG_ANSWER_CACHE_SIZE: 最大件数（デフォルト: 1000）
+
+    Returns:
+        回答キャッシュ（off の場合はNone）
+    """
+    backend = os.getenv("VENDOR_RAG_ANSWER_CACHE", "memory").strip().lower()
+    if backend not in ANSWER_CACHE_BACKENDS:
+        raise ValueError(f"不明な回答キャッシュの種類です: {backend}（{' / '.join(ANSWER_CACHE_BACKENDS)}）")
+    if backend == "off":
+        return None
+
+    ttl = float(os.getenv("VENDOR_RAG_ANSWER_CACHE_TTL", DEFAULT_TTL_SECONDS))
+    max_entries = int(os.getenv("VENDOR_RAG_ANSWER_CACHE_SIZE", DEFAULT_MAX_ENTRIES))
+    if backend == "sqlite":
+        path = os.getenv("VENDOR_RAG_ANSWER_CACHE_PATH") or f"{vectordb_path.rstrip(os.sep)}.answer_cache.sqlite"
+        return SQLiteAnswerCache(path, ttl=ttl, max_entries=max_entries)
+    return MemoryAnswerCache(ttl=ttl, max_entries=max_entries)
@@ -7,7 +7,13 @@ Streamlitでベンダー情報検索＆回答生成を行うWebアプリ
 
 import streamlit as st
 import time
-from query import query_vendor_info
+from query import stream_vendor_info, get_retriever, get_answer_cache, get_semantic_cache, get_single_flight, get_generation_stats, get_telemetry, invalidate_engines
+from filter_index import FILTER_FIELDS
+from openai_transport import get_transport
+from telemetry import SUMMARY_DAYS
+
+# ストリーミング表示の再描画間隔（秒）
+STREAM_RENDER_INTERVAL = 0.05
 
 # ページ設定
 st.set_page_config(
@@ -30,16 +36,50 @@ def main():
         
         # 検索オプション
         st.subheader("検索設定")
-        k = st.slider("検索件数", min_value=1, max_value=10, value=5, help="検索するベンダー数")
-        use_mmr = st.checkbox("MMR検索を使用", value=True, help="関連性と多様性のバランスを取った検索")
+        k = st.slider("検索件数", min_value=1, max_value=50, value=5,
+                      help="検索するベンダー数。多い場合はベンダーを分けて並列に選定し、結果をまとめて回答します（分割生成）")
+        search_labels = {"mmr": "MMR", "similarity": "類似度検索", "hybrid": "ハイブリッド（キーワード＋ベクトル）"}
+        search_type = st.radio(
+            "検索方法",
+            list(search_labels),
+            format_func=search_labels.get,
+            help="MMR: 関連性と多様性のバランス / ハイブリッド: ベンダー名・別名などのキーワード一致も考慮"
+        )
+        fetch_k, lambda_mult = None, 0.7
+        if search_type == "mmr":
+            fetch_k = st.number_input(
+                "MMRの候補数（fetch_k）", min_value=k, max_value=1000, value=max(k * 4, 20), step=10,
+                help="多様性を考慮する候補の数。大きくすると似たベンダーの重複を避けやすくなります"
+            )
+            lambda_mult = st.slider(
+                "関連性の重み（lambda_mult）", min_value=0.0, max_value=1.0, value=0.7, step=0.05,
+                help="1に近いほど関連性、0に近いほど多様性を重視"
+            )
         
         # モデル選択
         st.subheader("LLM設定")
+        renderer_labels = {
+            "llm": "LLMで生成",
+            "compact": "選定のみLLM（ベンダーIDと理由だけ生成）",
+            "template": "テンプレート（LLMなし・即時）"
+        }
+        renderer = st.radio(
+            "回答の作成方法",
+            list(renderer_labels),
+            format_func=renderer_labels.get,
+            help="選定のみLLM: LLMは該当するベンダーのIDと選定理由だけをJSONで返し、項目は保存済みの情報から転記します（出力トークンと生成時間を削減）。"
+                 "テンプレート: 検索されたベンダーの項目を回答形式にそのまま転記します（トークン消費なし）。「〜のベンダーは？」のような一覧の質問向け"
+        )
         model = st.selectbox(
             "使用モデル",
             ["gpt-3.5-turbo", "gpt-4"],
             help="使用するOpenAIモデル"
         )
+        use_cache = st.checkbox(
+            "回答キャッシュを使う",
+            value=True,
+            help="同じ質問・設定なら保存済みの回答を検索・生成なしで返し、言い回しの違う類似の質問でも検索結果のベンダーが同じなら回答生成を省略します"
+        )
         
         # ベクトルDBパス
         st.subheader("データベース設定")
@@ -49,6 +89,28 @@ def main():
             help="ChromaベクトルDBのパス"
         )
         
+        # 絞り込み（取り込み時に作成した絞り込み用インデックスの値を選択肢にする）
+        st.subheader("絞り込み")
+        filters = {}
+        try:
+            filter_index = get_retriever(vectordb_path).filter_index
+        except Exception:
+            filter_index = None
+        if filter_index is None:
+            st.caption("絞り込み用インデックスがありません（取り込みを再実行すると利用できます）")
+        else:
+            for label, field in FILTER_FIELDS.items():
+                options = filter_index.values(field)
+                counts = dict(options)
+                selected = st.multiselect(
+                    label,
+                    [value for value, _ in options],
+                    format_func=lambda value, counts=counts: f"{value}（{counts[value]}）",
+                    help="同じ項目内はいずれかに一致、項目間はすべてに一致するベンダーだけを検索します"
+                )
+                if selected:
+                    filters[field] = selected
+        
         # 情報表示
         st.markdown("---")
         st.info("""
@@ -80,88 +142,207 @@ def main():
         # 検索ボタン
         if st.button("🔍 検索実行", type="primary", use_container_width=True):
             if question.strip():
-                # プログレスバー
-                with st.spinner("検索中..."):
-                    progress_bar = st.progress(0)
+                # 検索実行（回答は生成されたトークンから順に表示する）
+                try:
+                    stream = stream_vendor_info(
+                        question=question,
+                        k=k,
+                        search_type=search_type,
+                        filters=filters,
+                        fetch_k=fetch_k,
+                        lambda_mult=lambda_mult,
+                        model=model,
+                        vectordb_path=vectordb_path,
+                        use_cache=use_cache,
+                        renderer=renderer
+                    )
+                    chunks = iter(stream)
                     
-                    # 検索実行
-                    try:
-                        # プログレスバー更新
-                        progress_bar.progress(25)
-                        time.sleep(0.5)
-                        
-                        # RAG処理実行
-                        progress_bar.progress(50)
-                        result, token_info = query_vendor_info(
-                            question=question,
-                            k=k,
-                            use_mmr=use_mmr,
-                            model=model,
-                            vectordb_path=vectordb_path
-                        )
-                        
-                        progress_bar.progress(100)
-                        time.sleep(0.5)
-                        
-                        # 結果表示
-                        st.subheader("📊 検索結果")
-                        st.markdown(result)
-                        
-                        # トークン数情報の表示
-                        if token_info:
-                            st.subheader("📊 トークン使用量")
-                            col1, col2, col3, col4 = st.columns(4)
-                            with col1:
-                                st.metric("質問トークン", token_info.get("question_tokens", 0))
-                            with col2:
-                                st.metric("コンテキストトークン", token_info.get("context_tokens", 0))
-                            with col3:
-                                st.metric("回答トークン", token_info.get("response_tokens", 0))
-                            with col4:
-                                st.metric("合計トークン", token_info.get("total_tokens", 0))
-                            
-                            # 詳細情報
-                            st.info(f"""
-                            **詳細情報:**
-                            - 使用モデル: {token_info.get("model_used", "N/A")}
-                            - 取得ドキュメント数: {token_info.get("documents_retrieved", 0)}件
-                            - 検索方法: {'MMR' if use_mmr else '類似度検索'}
-                            """)
-                        
-                        # 成功メッセージ
-                        st.success("検索が完了しました！")
+                    # 最初のトークンが届くまで（検索と回答生成の開始まで）はスピナーを表示
+                    with st.spinner("検索中..."):
+                        first_chunk = next(chunks, "")
+                    
+                    # 結果表示
+                    st.subheader("📊 検索結果")
+                    # キャッシュから返す場合は最初の断片の時点で回答全体とトークン数情報がそろっている
+                    if stream.token_info.get("renderer") == "template":
+                        st.caption(f"⚡ 検索結果の項目をテンプレートで表示しています（LLMは使っていません。"
+                                   f"{stream.token_info.get('generation_seconds', 0) * 1000:.1f}ミリ秒）")
+                    elif stream.token_info.get("cache_hit") == "exact":
+                        st.caption("⚡ 回答キャッシュから表示しています（検索・回答生成は行っていません）")
+                    elif stream.token_info.get("cache_hit") == "semantic":
+                        st.caption(f"⚡ 類似の質問（類似度 {stream.token_info.get('semantic_similarity', 0):.3f}）の回答を表示しています"
+                                   "（検索結果のベンダーが同じため回答生成は行っていません）")
+                    placeholder = st.empty()
+                    partial = first_chunk
+                    placeholder.markdown(partial + "▌")
+                    last_rendered = time.perf_counter()
+                    for chunk in chunks:
+                        partial += chunk
+                        # 再描画の回数を抑える（トークンごとに描画すると長い回答で遅くなる）
+                        if time.perf_counter() - last_rendered >= STREAM_RENDER_INTERVAL:
+                            placeholder.markdown(partial + "▌")
+                            last_rendered = time.perf_counter()
+                    
+                    result, token_info = stream.response, stream.token_info
+                    placeholder.markdown(result)
+                    if token_info.get("coalesced"):
+                        source = "別のワーカープロセス" if token_info["coalesced"] == "file" else "同じプロセス"
+                        st.caption(f"🔗 同時に送られた同じ質問の検索・回答生成の結果を共有しました（{source}）")
+                    
+                    # トークン数情報の表示
+                    if token_info:
+                        st.subheader("📊 トークン使用量")
+                        col1, col2, col3, col4, col5 = st.columns(5)
+                        with col1:
+                            st.metric("質問トークン", token_info.get("question_tokens", 0))
+                        with col2:
+                            st.metric("コンテキストトークン", token_info.get("context_tokens", 0))
+                        with col3:
+                            st.metric("回答トークン", token_info.get("response_tokens", 0))
+                        with col4:
+                            st.metric("合計トークン", token_info.get("total_tokens", 0))
+                        with col5:
+                            st.metric("最初のトークンまで", f"{token_info.get('time_to_first_token', 0):.2f}秒")
                         
-                    except Exception as e:
-                        st.error(f"エラーが発生しました: {e}")
-                        progress_bar.progress(0)
+                        # 詳細情報
+                        context_labels = {"precomputed": "取り込み時に作成済みのブロック", "built": "質問に合わせて作成"}
+                        usage_labels = {"api": "APIの実測値", "estimate": "見積もり", "none": "LLMを使用していません"}
+                        st.info(f"""
+                        **詳細情報:**
+                        - 使用モデル: {token_info.get("model_used", "N/A")}
+                        - 取得ドキュメント数: {token_info.get("documents_retrieved", 0)}件
+                        - トークン数: {usage_labels.get(token_info.get("usage_source"), "見積もり")}（LLM呼び出し {token_info.get("llm_calls", 1)}回）
+                        - プロンプト: {token_info.get("prompt_tokens", 0)}トークン（コンテキスト上限 {token_info.get("context_budget", 0)}トークン、短縮した項目 {token_info.get("fields_truncated", 0)}件・省略した項目 {token_info.get("fields_dropped", 0)}件）
+                        - コンテキスト: {context_labels.get(token_info.get("context_source"), "なし")}
+                        - 検索方法: {search_labels[search_type]}
+                        """)
+                        map_reduce = token_info.get("map_reduce")
+                        if map_reduce:
+                            st.caption(f"分割生成: {map_reduce['map_calls']}回に分けて並列に選定（{map_reduce['map_seconds']:.2f}秒）→ "
+                                       f"候補 {map_reduce['candidates']}件をまとめて回答（{map_reduce.get('reduce_seconds', 0):.2f}秒）")
+                        if token_info.get("renderer") == "compact" or map_reduce:
+                            st.caption(f"出力トークン {token_info.get('response_tokens', 0)}（回答全体をLLMで生成した場合の目安 "
+                                       f"{token_info.get('rendered_tokens', 0)}、削減 {token_info.get('output_tokens_saved', 0)}）"
+                                       f" / 回答生成 {token_info.get('generation_seconds', 0):.2f}秒")
+                    
+                    # 成功メッセージ
+                    st.success("検索が完了しました！")
+                    
+                except Exception as e:
+                    st.error(f"エラーが発生しました: {e}")
             else:
                 st.warning("質問を入力してください。")
     
     with col2:
         st.subheader("📈 統計情報")
         
-        # 統計情報の表示
+        # 統計情報の表示（プロセス内で共有する検索クラスを再利用）
         try:
-            from query import VendorRetriever, load_environment
-            api_key = load_environment()
-            retriever = VendorRetriever(vectordb_path=vectordb_path, api_key=api_key)
+            retriever = get_retriever(vectordb_path)
             doc_count = retriever.get_document_count()
             
             st.metric("ベクトルDB内のベンダー数", doc_count)
             
             if doc_count > 0:
                 st.success("✅ ベクトルDBが正常に読み込まれています")
+                st.caption(f"インデックスのバージョン: {retriever.index_version or '旧形式'}"
+                           f"（検索バックエンド: {retriever.backend.name}）")
             else:
                 st.error("❌ ベクトルDBにデータがありません")
+            
+            cache_stats = retriever.get_cache_stats()
+            if cache_stats:
+                st.metric("埋め込みキャッシュ ヒット率", f"{cache_stats['hit_rate']:.0%}")
+            
+            answer_cache = get_answer_cache(vectordb_path)
+            if answer_cache is not None:
+                answer_stats = answer_cache.stats()
+                st.metric("回答キャッシュ ヒット率", f"{answer_stats['hit_rate']:.0%}",
+                          help=f"ヒット {answer_stats['hits']}件 / ミス {answer_stats['misses']}件 / 保存 {answer_stats['entries']}件")
+            
+            semantic_cache = get_semantic_cache(vectordb_path)
+            if semantic_cache is not None:
+                semantic_stats = semantic_cache.stats()
+                st.metric("類似質問キャッシュ ヒット率", f"{semantic_stats['hit_rate']:.0%}",
+                          help=f"ヒット {semantic_stats['hits']}件 / ミス {semantic_stats['misses']}件 / 保存 {semantic_stats['entries']}件")
+                if semantic_stats["hits"]:
+                    st.caption(f"短縮できた回答生成時間: p50 {semantic_stats['saved_p50']:.2f}秒 / "
+                               f"p99 {semantic_stats['saved_p99']:.2f}秒")
+            
+            # 回答の作成方法ごとの生成時間と出力トークン数（このプロセスで生成した回答）
+            generation_stats = get_generation_stats()
+            if generation_stats:
+                st.caption("回答生成（作成方法別）: " + " / ".join(
+                    f"{renderer_labels.get(renderer, '分割生成')} p50 {stats['seconds_p50']:.2f}秒・p95 {stats['seconds_p95']:.2f}秒・"
+                    f"出力 {stats['output_tokens_p50']:.0f}トークン（{stats['count']}件）"
+                    for renderer, stats in generation_stats.items()
+                ))
+            
+            # 同時に送られた同じ質問をまとめた件数（このプロセスの集計）
+            single_flight = get_single_flight(vectordb_path)
+            if single_flight is not None:
+                flight_stats = single_flight.stats()
+                shared = flight_stats["coalesced"] + flight_stats["shared_across_processes"]
+                if shared:
+                    st.caption(f"同時の同じ質問: 結果を共有 {shared}件（他のプロセスから {flight_stats['shared_across_processes']}件）"
+                               f" / 実行 {flight_stats['leaders']}件")
+            
+            # 直近のリクエストの所要時間・トークン数・料金（テレメトリに記録した全ワーカーの集計）
+            telemetry = get_telemetry(vectordb_path)
+            if telemetry is not None:
+                summary = telemetry.summary()
+                if summary["requests"]:
+                    st.markdown(f"**直近{SUMMARY_DAYS}日間のリクエスト**")
+                    col_p50, col_p95 = st.columns(2)
+                    with col_p50:
+                        st.metric("所要時間 p50", f"{summary['latency_p50']:.2f}秒")
+                    with col_p95:
+                        st.metric("所要時間 p95", f"{summary['latency_p95']:.2f}秒")
+                    stage_labels = {"search": "検索", "generation": "回答生成", "first_token": "最初のトークンまで"}
+                    st.caption(" / ".join(
+                        f"{stage_labels[stage]} p50 {stats['p50']:.2f}秒・p95 {stats['p95']:.2f}秒"
+                        for stage, stats in summary["stages"].items()
+                    ))
+                    st.caption(f"{summary['requests']}件（キャッシュ・共有 {summary['cache_hits']}件 / エラー {summary['errors']}件）")
+                    if summary["tokens_by_day"]:
+                        st.caption("日ごとのトークン数（入力＋出力）")
+                        st.bar_chart(summary["tokens_by_day"])
+                    if summary["cost_by_model"]:
+                        st.caption(f"料金: 合計 ${summary['cost_total']:.4f}（" + " / ".join(
+                            f"{name} ${cost:.4f}" for name, cost in summary["cost_by_model"].items()
+                        ) + "）")
+            
+            # OpenAI APIの接続の再利用・リトライ・サーキットブレーカー（プロセス内で共有するトランスポート）
+            transport_stats = get_transport().stats()
+            st.caption(f"API接続: 新規 {transport_stats['connections_opened']}回 / "
+                       f"再利用 {transport_stats['connections_reused']}回（待機中 {transport_stats['connections_idle']}）")
+            for stage, stage_label in (("embedding", "埋め込み"), ("chat", "回答生成")):
+                stage_stats = transport_stats["stages"][stage]
+                if stage_stats["circuit"] != "closed":
+                    st.warning(f"⚠️ {stage_label}のAPI呼び出しが続けて失敗したため、一時的に停止しています")
+                if stage_stats["requests"]:
+                    st.caption(f"{stage_label}API: {stage_stats['requests']}件・リトライ {stage_stats['retries']}回・"
+                               f"タイムアウト {stage_stats['timeouts']}回・接続待ち {stage_stats['pool_timeouts']}回・応答 p95 {stage_stats['latency_p95']:.2f}秒")
                 
         except Exception as e:
             st.error(f"❌ ベクトルDBの読み込みに失敗: {e}")
         
+        if st.button("🔄 ベクトルDBを再読み込み", help="共有している検索エンジンを破棄して作り直します"):
+            invalidate_engines(vectordb_path)
+            st.rerun()
+        
         # 使用設定の表示
         st.subheader("🔧 現在の設定")
         st.write(f"**検索件数:** {k}")
-        st.write(f"**検索方法:** {'MMR' if use_mmr else '類似度検索'}")
+        st.write(f"**検索方法:** {search_labels[search_type]}")
+        if filters:
+            labels = {field: label for label, field in FILTER_FIELDS.items()}
+            st.write("**絞り込み:** " + " / ".join(
+                f"{labels[field]}={', '.join(values)}" for field, values in filters.items()
+            ))
         st.write(f"**使用モデル:** {model}")
+        st.write(f"**回答の作成方法:** {renderer_labels[renderer]}")
         st.write(f"**ベクトルDB:** {vectordb_path}")
     
     # フッター
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+構造化メタデータの絞り込み用ビットマップインデックス
+カテゴリ・業界タグ・価格帯・デプロイ方式・面談状況の値ごとに、該当ベンダーのビット集合を
+Pythonの整数で保持し、ベクトル検索の前に候補を絞り込む
+"""
+
+import os
+import json
+import unicodedata
+from typing import Iterable, Optional
+
+FILTER_INDEX_FILE = "filter_index.json"
+
+# 絞り込み可能な項目（ラベル → メタデータキー）
+FILTER_FIELDS = {
+    "カテゴリ": "category",
+    "業界タグ": "industry_tags",
+    "価格帯": "price_range",
+    "デプロイ方式": "deployment",
+    "面談状況": "interview_status",
+}
+
+def normalize_value(value: str) -> str:
+    """照合用の値の正規化（NFKC・小文字化・前後空白除去）"""
+    return unicodedata.normalize("NFKC", value).casefold().strip()
+
+def split_values(value) -> list[str]:
+    """メタデータの値を個々の値に分割（複数値はカンマ区切りで保存されている）"""
+    return [item.strip() for item in str(value or "").split(",") if item.strip()]
+
+def resolve_field(name: str) -> str:
+    """項目名（メタデータキーまたは日本語ラベル）をメタデータキーに変換"""
+    name = name.strip()
+    if name in FILTER_FIELDS.values():
+        return name
+    if name in FILTER_FIELDS:
+        return FILTER_FIELDS[name]
+    raise ValueError(f"絞り込みできない項目です: {name}（{', '.join(FILTER_FIELDS)} のいずれかを指定してください）")
+
+def normalize_filters(filters: Optional[dict]) -> dict[str, list[str]]:
+    """
+    絞り込み条件を正規化
+
+    Args:
+        filters: 項目名 → 値または値のリスト（同じ項目内はOR、項目間はAND）
+
+    Returns:
+        メタデータキー → 値のリスト（値が空の項目は除外）
+    """
+    normalized = {}
+    for name, values in (filters or {}).items():
+        if isinstance(values, str):
+            values = split_values(values)
+        values = [value for value in values if value]
+        if values:
+            normalized.setdefault(resolve_field(name), []).extend(values)
+    return normalized
+
+def parse_filter_args(items: Optional[list[str]]) -> dict[str, list[str]]:
+    """
+    コマンドラインの `項目=値1,値2` 形式の指定を絞り込み条件に変換
+
+    Raises:
+        ValueError: 形式が正しくない場合
+    """
+    filters = {}
+    for item in items or []:
+        name, separator, value = item.partition("=")
+        if not separator or not value.strip():
+            raise ValueError(f"絞り込み条件の形式が正しくありません: {item}（例: 価格帯=低）")
+        filters.setdefault(resolve_field(name), []).extend(split_values(value))
+    return filters
+
+def _bit_positions(mask: int) -> Iterable[int]:
+    """ビット集合から立っているビットの位置を昇順に返す"""
+    bits = bin(mask)[:1:-1]
+    position = bits.find("1")
+    while position != -1:
+        yield position
+        position = bits.find("1", position + 1)
+
+class FilterIndex:
+    """項目の値ごとのビットマップによる絞り込みインデックス"""
+
+    def __init__(self, ids: list[str], bitmaps: dict, labels: dict):
+        """
+        初期化（通常は build() または load() から生成）
+
+        Args:
+            ids: 文書番号（ビット位置） → ベンダーID
+            bitmaps: メタデータキー → 正規化した値 → ビット集合
+            labels: メタデータキー → 正規化した値 → 表示用の値
+        """
+        self.ids = ids
+        self.bitmaps = bitmaps
+        self.labels = labels
+        self.all_mask = (1 << len(ids)) - 1
+
+    @classmethod
+    def build(cls, records: Iterable[tuple[str, dict]]) -> "FilterIndex":
+        """
+        (ベンダーID, メタデータ) の列からインデックスを構築
+
+        Args:
+            records: ベンダーIDと vendor_fields 形式のメタデータの組
+        """
+        ids = []
+        bitmaps = {field: {} for field in FILTER_FIELDS.values()}
+        labels = {field: {} for field in FILTER_FIELDS.values()}
+        for vendor_id, metadata in records:
+            bit = 1 << len(ids)
+            ids.append(vendor_id)
+            for field in FILTER_FIELDS.values():
+                for value in split_values(metadata.get(field)):
+                    key = normalize_value(value)
+                    bitmaps[field][key] = bitmaps[field].get(key, 0) | bit
+                    labels[field].setdefault(key, value)
+        return cls(ids, bitmaps, labels)
+
+    def save(self, directory: str):
+        """インデックスのディレクトリに保存（ビット集合は16進文字列で保存）"""
+        path = os.path.join(directory, FILTER_INDEX_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({
+                "ids": self.ids,
+                "bitmaps": {
+                    field: {value: format(mask, "x") for value, mask in values.items()}
+                    for field, values in self.bitmaps.items()
+                },
+                "labels": self.labels,
+            }, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["FilterIndex"]:
+        """インデックスのディレクトリから読み込み（ファイルがない場合はNone）"""
+        path = os.path.join(directory, FILTER_INDEX_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        bitmaps = {
+            field: {value: int(mask, 16) for value, mask in values.items()}
+            for field, values in data["bitmaps"].items()
+        }
+        return cls(data["ids"], bitmaps, data["labels"])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def match_mask(self, filters: Optional[dict]) -> int:
+        """
+        絞り込み条件に一致するベンダーのビット集合を取得
+
+        Args:
+            filters: 項目名 → 値または値のリスト（同じ項目内はOR、項目間はAND）
+        """
+        mask = self.all_mask
+        for field, values in normalize_filters(filters).items():
+            field_mask = 0
+            for value in values:
+                field_mask |= self.bitmaps.get(field, {}).get(normalize_value(value), 0)
+            mask &= field_mask
+            if not mask:
+                break
+        return mask
+
+    def match(self, filters: Optional[dict]) -> list[str]:
+        """絞り込み条件に一致するベンダーIDのリストを取得"""
+        return [self.ids[position] for position in _bit_positions(self.match_mask(filters))]
+
+    def values(self, field: str) -> list[tuple[str, int]]:
+        """
+        項目の値の一覧を件数の多い順に取得（UIの選択肢用）
+
+        Returns:
+            (表示用の値, 該当件数) のリスト
+        """
+        field = resolve_field(field)
+        counts = [
+            (self.labels[field][value], bin(mask).count("1"))
+            for value, mask in self.bitmaps.get(field, {}).items()
+        ]
+        return sorted(counts, key=lambda item: (-item[1], item[0]))
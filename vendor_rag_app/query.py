@@ -6,132 +6,541 @@ Streamlitアプリから呼び出し可能な関数を提供
 """
 
 import os
-from typing import List, Optional
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterator, List, Optional
+import numpy as np
 from dotenv import load_dotenv
-from langchain_community.vectorstores import Chroma
 from langchain_openai import OpenAIEmbeddings
 from langchain_core.documents import Document
-# MMRRetrieverは使わずにvectorstore.as_retriever()を使用
 from langchain_openai import ChatOpenAI
 from langchain_core.messages import HumanMessage, SystemMessage
 import re
-import tiktoken
+import json
+from collections import OrderedDict, deque
+from vendor_fields import vendor_info_from_metadata, vendor_info_from_text
+from embedding_cache import EmbeddingCache, CachedEmbeddings, default_cache_path
+from index_manager import IndexPointer, resolve_index_path
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from filter_index import FilterIndex, normalize_filters
+from alias_index import AliasIndex
+from vector_backends import open_backend
+from answer_cache import AnswerCache, make_answer_key, open_answer_cache
+from semantic_cache import SemanticAnswerCache, open_semantic_cache
+from context_builder import ContextBuilder, count_tokens
+from openai_transport import get_transport
+from singleflight import SingleFlight, open_single_flight
+from telemetry import TelemetryStore, open_telemetry
+
+# 検索方法（mmr: 多様性重視 / similarity: 類似度のみ / hybrid: キーワード検索とベクトル検索の統合）
+SEARCH_TYPES = ("mmr", "similarity", "hybrid")
+
+# MMRの既定値（fetch_k 未指定時は max(k * 4, 20) 件の候補から選ぶ）
+DEFAULT_LAMBDA_MULT = 0.7
+
+# 回答生成に失敗したときの回答の先頭（この回答は回答キャッシュに保存しない）
+GENERATION_ERROR_PREFIX = "回答生成中にエラーが発生しました"
+
+# 回答の作成方法（llm: LLMで生成 / compact: LLMはベンダーIDと選定理由だけをJSONで返し、項目はメタデータから転記 /
+# template: LLMを使わず検索結果の項目を回答形式に転記）
+RENDERERS = ("llm", "compact", "template")
+
+# 回答形式の各ベンダーの項目（メタデータのキー, 表示名）
+ANSWER_FIELDS = (
+    ("name", "ベンダー名"),
+    ("category", "カテゴリ"),
+    ("industry_tags", "業界タグ"),
+    ("service_summary", "サービス概要"),
+    ("strengths", "強み"),
+    ("price_range", "価格帯"),
+    ("interview_status", "面談状況"),
+)
+
+# 分割生成（map-reduce）: 検索件数がこの数を超えるか、コンテキストの見積もりが上限を超える場合は、
+# ベンダーを MAP_CHUNK_SIZE 件ずつに分けて並列に選定・要約し（map）、選ばれたベンダーだけを1回の短い呼び出しでまとめる（reduce）
+MAP_REDUCE_DOCUMENTS = 10
+MAP_CHUNK_SIZE = 5
+# map の同時呼び出し数の上限（既定値では検索件数50件までの map を1度に呼び出す。共有トランスポートの接続数の上限より小さくする）
+MAP_CONCURRENCY = 10
+# map で関連度（0〜10）がこの値未満のベンダーは reduce に渡さない
+MAP_MIN_SCORE = 5
+
+# 作成済みのプロンプトを保持する件数（回答生成後のトークン数の集計で作り直さないため）
+PROMPT_CACHE_SIZE = 128
+
+# チャット形式のメッセージ1件ごとに加算されるトークン数と、回答の開始に加算されるトークン数
+MESSAGE_OVERHEAD_TOKENS = 3
+REPLY_PRIMING_TOKENS = 3
+
+def _add_usage(usage: Optional[dict], message):
+    """
+    LLMの応答の usage_metadata（APIが返した usage の値）を usage に加算
+    
+    Args:
+        usage: 集計先（input_tokens / output_tokens / calls。Noneなら何もしない）
+        message: LLMの応答（ストリーミングでは usage を持つ最後の断片）
+    """
+    metadata = getattr(message, "usage_metadata", None)
+    if usage is None or not metadata:
+        return
+    usage["input_tokens"] = usage.get("input_tokens", 0) + metadata.get("input_tokens", 0)
+    usage["output_tokens"] = usage.get("output_tokens", 0) + metadata.get("output_tokens", 0)
+    usage["calls"] = usage.get("calls", 0) + 1
+
+class IndexSnapshot:
+    """
+    公開中の1つのバージョンのベクトル検索バックエンドと補助インデックス（読み込み後は変更しない）
+    
+    バージョンの切り替えではスナップショットごと差し替えるため、バックエンドと補助インデックスの
+    バージョンが食い違った状態にはならない。
+    """
+    
+    def __init__(self, index_path: str, index_version: Optional[str], backend, lexical_index: Optional[LexicalIndex],
+                 filter_index: Optional[FilterIndex], alias_index: Optional[AliasIndex]):
+        self.index_path = index_path
+        self.index_version = index_version
+        self.backend = backend
+        # Chromaバックエンドの場合のみ（NumPy形式ではNone）
+        self.vectorstore = getattr(backend, "vectorstore", None)
+        # 構築前の旧バージョンにはないためNoneになる
+        self.lexical_index = lexical_index
+        self.filter_index = filter_index
+        self.alias_index = alias_index
 
 class VendorRetriever:
     """ベンダー情報検索クラス"""
     
-    def __init__(self, vectordb_path: str = "vectordb", api_key: Optional[str] = None):
+    def __init__(self, vectordb_path: str = "vectordb", api_key: Optional[str] = None, backend: Optional[str] = None):
         """
         初期化
         
         Args:
             vectordb_path: ベクトルDBのパス
             api_key: OpenAI APIキー
+            backend: ベクトル検索のバックエンド（"auto" / "chroma" / "numpy"）。
+                未指定時は環境変数 VENDOR_RAG_BACKEND、なければ "auto"（NumPy形式があれば優先）
         """
         self.vectordb_path = vectordb_path
         self.api_key = api_key
-        self.vectorstore = None
+        self.backend_name = backend or os.getenv("VENDOR_RAG_BACKEND", "auto")
         self.retriever = None
+        self.embedding_cache = None
+        self.embeddings = None
+        # 公開中のバージョンのスナップショット（読み込み直しは1回の代入で差し替える）
+        self.index = None
+        self.index_pointer = IndexPointer(vectordb_path)
+        self._reload_lock = threading.Lock()
         
         self._initialize_vectorstore()
     
+    @property
+    def backend(self):
+        return self.index.backend if self.index else None
+    
+    @property
+    def vectorstore(self):
+        return self.index.vectorstore if self.index else None
+    
+    @property
+    def lexical_index(self) -> Optional[LexicalIndex]:
+        return self.index.lexical_index if self.index else None
+    
+    @property
+    def filter_index(self) -> Optional[FilterIndex]:
+        return self.index.filter_index if self.index else None
+    
+    @property
+    def alias_index(self) -> Optional[AliasIndex]:
+        return self.index.alias_index if self.index else None
+    
+    @property
+    def index_path(self) -> Optional[str]:
+        return self.index.index_path if self.index else None
+    
+    @property
+    def index_version(self) -> Optional[str]:
+        return self.index.index_version if self.index else None
+    
     def _initialize_vectorstore(self):
         """ベクトルストアの初期化"""
         try:
-            # ベクトルDBの存在確認
-            if not os.path.exists(self.vectordb_path):
-                raise FileNotFoundError(f"ベクトルDBが見つかりません: {self.vectordb_path}")
-            
-            # OpenAI Embeddingsの初期化
-            embeddings = OpenAIEmbeddings(
-                model="text-embedding-ada-002",
-                openai_api_key=self.api_key
-            )
+            # ベクトルDBの存在確認（公開中のバージョン、または旧形式のディレクトリ）
+            resolve_index_path(self.vectordb_path)
             
-            # Chromaベクトルストアの読み込み
-            self.vectorstore = Chroma(
-                persist_directory=self.vectordb_path,
-                embedding_function=embeddings
+            # OpenAI Embeddingsの初期化（永続キャッシュでラップし、同じ質問の再埋め込みを避ける）
+            # 接続・タイムアウト・リトライは共有トランスポートで管理する（クライアント側のリトライは無効化）
+            transport = get_transport()
+            self.embedding_cache = EmbeddingCache(default_cache_path(self.vectordb_path))
+            self.embeddings = CachedEmbeddings(
+                OpenAIEmbeddings(
+                    model="text-embedding-ada-002",
+                    openai_api_key=self.api_key,
+                    http_client=transport.http_client,
+                    http_async_client=transport.async_http_client,
+                    timeout=transport.timeout("embedding"),
+                    max_retries=0
+                ),
+                self.embedding_cache,
+                model="text-embedding-ada-002"
             )
             
-            # MMR Retrieverの初期化（vectorstore.as_retrieverを使用）
-            # MMRRetrieverクラスは使わず、vectorstoreのas_retrieverメソッドを使用
+            # ベクトル検索バックエンド（Chroma または NumPy形式）の読み込み
+            self._refresh_if_updated()
             
         except Exception as e:
             raise Exception(f"ベクトルストアの初期化に失敗しました: {e}")
     
-    def search(self, query: str, k: int = 5, use_mmr: bool = True) -> List[Document]:
+    def _load_index(self) -> IndexSnapshot:
+        """公開中のバージョンのベクトル検索バックエンドと補助インデックスを読み込み"""
+        index_path, index_version = resolve_index_path(self.vectordb_path)
+        return IndexSnapshot(
+            index_path,
+            index_version,
+            open_backend(index_path, self.embeddings, self.backend_name),
+            LexicalIndex.load(index_path),
+            FilterIndex.load(index_path),
+            AliasIndex.load(index_path),
+        )
+    
+    def _refresh_if_updated(self) -> IndexSnapshot:
         """
-        検索実行（デフォルトでMMR使用）
+        取り込みで CURRENT が切り替わっていれば、新しいバージョンを読み込み直す（再起動不要）
+        
+        すべて読み込めてから1回の代入で差し替え、その後で確認済みにする。途中で失敗した場合は
+        今のスナップショットのまま残し、次の呼び出しで読み込みをやり直す。
         
-        Args:
-            query: 検索クエリ
-            k: 取得するドキュメント数
-            use_mmr: MMR検索を使用するかどうか
-            
         Returns:
-            検索結果のドキュメントリスト
+            公開中のバージョンのスナップショット
+        """
+        if self.index_pointer.changed() is not None:
+            with self._reload_lock:
+                # 待っている間に他のスレッドが読み込み直していれば、それを使う
+                stat_key = self.index_pointer.changed()
+                if stat_key is not None:
+                    self.index = self._load_index()
+                    self.index_pointer.commit(stat_key)
+        return self.index
+    
+    def _resolve_candidates(self, index: IndexSnapshot, filters: Optional[dict]) -> Optional[List[str]]:
+        """
+        絞り込み条件に一致するベンダーIDを取得
+        
+        Returns:
+            候補のベンダーIDのリスト（絞り込みなし、または全件が一致する場合はNone）
+        """
+        if not normalize_filters(filters):
+            return None
+        if index.filter_index is None:
+            raise ValueError("絞り込み用インデックスがありません。取り込みを再実行してください")
+        
+        candidate_ids = index.filter_index.match(filters)
+        if len(candidate_ids) == len(index.filter_index):
+            return None
+        return candidate_ids
+    
+    def _fuse_hybrid(self, index: IndexSnapshot, query: str, vector_results: List[Document], k: int,
+                     candidate_ids: Optional[List[str]] = None) -> List[Document]:
+        """
+        キーワード検索（n-gram BM25）の結果とベクトル検索の結果を Reciprocal Rank Fusion で統合
+        
+        キーワード検索用インデックスがない旧バージョンではベクトル検索の結果をそのまま返す。
+        """
+        if index.lexical_index is None:
+            return vector_results[:k]
+        
+        vector_docs = {doc.metadata.get("vendor_id"): doc for doc in vector_results}
+        lexical_hits = index.lexical_index.search(
+            query, k=max(k * 4, 20), candidate_ids=set(candidate_ids) if candidate_ids is not None else None
+        )
+        lexical_ids = [vendor_id for vendor_id, _ in lexical_hits]
+        fused_ids = [vendor_id for vendor_id, _ in reciprocal_rank_fusion([list(vector_docs), lexical_ids])[:k]]
+        
+        # キーワード検索のみでヒットしたベンダーは本文とメタデータをまとめて取得する
+        lexical_only = {
+            doc.metadata["vendor_id"]: doc
+            for doc in index.backend.get_documents([vendor_id for vendor_id in fused_ids if vendor_id not in vector_docs])
+        }
+        return [
+            vector_docs.get(vendor_id) or lexical_only[vendor_id]
+            for vendor_id in fused_ids
+            if vendor_id in vector_docs or vendor_id in lexical_only
+        ]
+    
+    def _prepare_search(self, search_type: Optional[str], use_mmr: bool, filters: Optional[dict]):
+        """
+        検索前の共通処理（検索方法の確認・バージョン切り替えの検知・絞り込み候補の取得）
+        
+        1回の検索はここで取得したスナップショットだけを使う（検索中に他のスレッドが新しいバージョンを
+        読み込んでも、絞り込み・ベクトル検索・キーワード検索・ベンダー名辞書のバージョンは食い違わない）。
+        
+        Returns:
+            (検索方法, 公開中のバージョンのスナップショット, 候補のベンダーIDのリストまたはNone)
+        """
+        if not self.index:
+            raise ValueError("ベクトルストアが初期化されていません")
+        
+        search_type = search_type or ("mmr" if use_mmr else "similarity")
+        if search_type not in SEARCH_TYPES:
+            raise ValueError(f"不明な検索方法です: {search_type}")
+        
+        index = self._refresh_if_updated()
+        
+        # 絞り込み条件に一致するベンダーだけをスコアリング対象にする
+        return search_type, index, self._resolve_candidates(index, filters)
+    
+    def _search_by_vectors(self, index: IndexSnapshot, queries: List[str], query_vectors: List[List[float]], k: int,
+                           search_type: str, candidate_ids: Optional[List[str]], fetch_k: Optional[int],
+                           lambda_mult: float) -> List[List[Document]]:
+        """埋め込み済みの質問でベクトル検索（同期版・非同期版で共通）"""
+        if search_type == "mmr":
+            # MMR検索を使用（候補とそのベクトルを1回で取得し、行列演算で選択）
+            return index.backend.max_marginal_relevance_search_by_vectors(
+                query_vectors,
+                k=k,
+                fetch_k=max(fetch_k or max(k * 4, 20), k),
+                lambda_mult=lambda_mult,
+                candidate_ids=candidate_ids
+            )
+        
+        if search_type == "hybrid":
+            # キーワード検索とベクトル検索の統合（ベクトル検索は多めに取得してから統合）
+            vector_results = index.backend.similarity_search_by_vectors(
+                query_vectors, k=max(k * 4, 20), candidate_ids=candidate_ids
+            )
+            return [
+                self._fuse_hybrid(index, query, results, k, candidate_ids)
+                for query, results in zip(queries, vector_results)
+            ]
+        
+        # 類似度検索を使用
+        return index.backend.similarity_search_by_vectors(query_vectors, k=k, candidate_ids=candidate_ids)
+    
+    def _resolve_mentions(self, index: IndexSnapshot, queries: List[str], candidate_ids: Optional[List[str]]) -> list:
+        """
+        質問ごとに言及されたベンダーをベンダー名辞書で特定（埋め込み不要）
+        
+        Returns:
+            質問ごとの (言及されたベンダーIDのリスト, ベンダー名だけで特定できたかどうか)。
+            絞り込み条件に一致しないベンダーは除外し、残らなければ未特定として扱う
+        """
+        if index.alias_index is None:
+            return [([], False) for _ in queries]
+        
+        allowed = set(candidate_ids) if candidate_ids is not None else None
+        mentions = []
+        for query in queries:
+            vendor_ids, resolved = index.alias_index.resolve(query)
+            if allowed is not None:
+                vendor_ids = [vendor_id for vendor_id in vendor_ids if vendor_id in allowed]
+            mentions.append((vendor_ids, resolved and bool(vendor_ids)))
+        return mentions
+    
+    def _merge_mentions(self, index: IndexSnapshot, mentions: list, results: List[List[Document]],
+                        k: int) -> List[List[Document]]:
+        """言及されたベンダーを検索結果の先頭に置く（特定できた質問は言及されたベンダーのみ）"""
+        mentioned_ids = list(dict.fromkeys(vendor_id for vendor_ids, _ in mentions for vendor_id in vendor_ids))
+        if not mentioned_ids:
+            return results
+        
+        documents = {doc.metadata["vendor_id"]: doc for doc in index.backend.get_documents(mentioned_ids)}
+        merged = []
+        for (vendor_ids, _), docs in zip(mentions, results):
+            pinned = [documents[vendor_id] for vendor_id in vendor_ids if vendor_id in documents]
+            pinned_ids = {doc.metadata["vendor_id"] for doc in pinned}
+            merged.append((pinned + [doc for doc in docs if doc.metadata.get("vendor_id") not in pinned_ids])[:k])
+        return merged
+    
+    def search_many(self, queries: List[str], k: int = 5, use_mmr: bool = True, search_type: Optional[str] = None,
+                    filters: Optional[dict] = None, fetch_k: Optional[int] = None,
+                    lambda_mult: float = DEFAULT_LAMBDA_MULT) -> List[List[Document]]:
+        """
+        複数の質問をまとめて検索
+        
+        全質問の埋め込みを1回のバッチリクエスト（キャッシュ済みの質問は除く）で取得し、
+        ベクトル検索もバックエンドへの1回の問い合わせ・行列積でまとめて行う。
+        質問に含まれるベンダー名・別名はベンダー名辞書で検出して結果の先頭に置き、
+        「ハブルの概要は？」のようにベンダー名だけで特定できる質問は埋め込みもベクトル検索も行わない。
+        引数は search() と同じ（絞り込み条件は全質問に共通）。
+        
+        Returns:
+            質問ごとの検索結果のドキュメントリスト（入力と同じ順序）
         """
         try:
-            if not self.vectorstore:
-                raise ValueError("ベクトルストアが初期化されていません")
+            queries = list(queries)
+            search_type, index, candidate_ids = self._prepare_search(search_type, use_mmr, filters)
+            if not queries or (candidate_ids is not None and not candidate_ids):
+                return [[] for _ in queries]
             
-            if use_mmr:
-                # MMR検索を使用
-                retriever = self.vectorstore.as_retriever(
-                    search_type="mmr", 
-                    search_kwargs={
-                        "k": k,
-                        "fetch_k": k * 2,  # より多くの候補を取得
-                        "lambda_mult": 0.7  # 多様性の重み
-                    }
+            # ベンダー名だけで特定できた質問は埋め込みとベクトル検索を省略する
+            mentions = self._resolve_mentions(index, queries, candidate_ids)
+            pending = [i for i, (_, resolved) in enumerate(mentions) if not resolved]
+            results = [[] for _ in queries]
+            if pending:
+                pending_queries = [queries[i] for i in pending]
+                query_vectors = self.embeddings.embed_documents(pending_queries)
+                pending_results = self._search_by_vectors(
+                    index, pending_queries, query_vectors, k, search_type, candidate_ids, fetch_k, lambda_mult
                 )
-                results = retriever.get_relevant_documents(query)
-            else:
-                # 類似度検索を使用
-                results = self.vectorstore.similarity_search(query, k=k)
+                for i, docs in zip(pending, pending_results):
+                    results[i] = docs
+            return self._merge_mentions(index, mentions, results, k)
+            
+        except Exception as e:
+            raise Exception(f"検索に失敗しました: {e}")
+    
+    async def asearch_many(self, queries: List[str], k: int = 5, use_mmr: bool = True, search_type: Optional[str] = None,
+                           filters: Optional[dict] = None, fetch_k: Optional[int] = None,
+                           lambda_mult: float = DEFAULT_LAMBDA_MULT) -> List[List[Document]]:
+        """
+        search_many() の非同期版
+        
+        埋め込みは非同期クライアントで取得し、待ち時間の間はイベントループで他の質問を処理できる。
+        ローカルのベクトル検索（行列演算・Chromaの問い合わせ）は asyncio.to_thread で
+        既定のスレッドプール（上限あり）に渡すため、リクエストごとにスレッドを作ることはない。
+        """
+        try:
+            queries = list(queries)
+            # 新しいバージョンが公開されていれば、読み込み直しもスレッドで行う
+            if self.index_pointer.changed() is not None:
+                await asyncio.to_thread(self._refresh_if_updated)
+            search_type, index, candidate_ids = self._prepare_search(search_type, use_mmr, filters)
+            if not queries or (candidate_ids is not None and not candidate_ids):
+                return [[] for _ in queries]
             
-            return results[:k]  # 必要な件数に制限
+            mentions = self._resolve_mentions(index, queries, candidate_ids)
+            pending = [i for i, (_, resolved) in enumerate(mentions) if not resolved]
+            results = [[] for _ in queries]
+            if pending:
+                pending_queries = [queries[i] for i in pending]
+                query_vectors = await self.embeddings.aembed_documents(pending_queries)
+                pending_results = await asyncio.to_thread(
+                    self._search_by_vectors, index, pending_queries, query_vectors, k, search_type, candidate_ids,
+                    fetch_k, lambda_mult
+                )
+                for i, docs in zip(pending, pending_results):
+                    results[i] = docs
+            return self._merge_mentions(index, mentions, results, k)
             
         except Exception as e:
             raise Exception(f"検索に失敗しました: {e}")
     
+    def search(self, query: str, k: int = 5, use_mmr: bool = True, search_type: Optional[str] = None,
+               filters: Optional[dict] = None, fetch_k: Optional[int] = None,
+               lambda_mult: float = DEFAULT_LAMBDA_MULT) -> List[Document]:
+        """
+        検索実行（デフォルトでMMR使用）
+        
+        質問に含まれるベンダー名・別名は結果の先頭に置き、ベンダー名だけで特定できる質問
+        （「ハブルの概要は？」など）は埋め込みとベクトル検索を省略して該当ベンダーを返す。
+        
+        Args:
+            query: 検索クエリ
+            k: 取得するドキュメント数
+            use_mmr: MMR検索を使用するかどうか（search_type 未指定時のみ参照）
+            search_type: 検索方法（"mmr" / "similarity" / "hybrid"）
+            filters: 絞り込み条件（例: {"industry_tags": ["製造業"], "deployment": ["SaaS"]}）。
+                一致するベンダーだけをベクトル検索の対象にする
+            fetch_k: MMRで多様性を考慮する候補数（未指定時は max(k * 4, 20)）
+            lambda_mult: MMRの関連性の重み（1に近いほど関連性、0に近いほど多様性を重視）
+            
+        Returns:
+            検索結果のドキュメントリスト
+        """
+        return self.search_many(
+            [query], k=k, use_mmr=use_mmr, search_type=search_type,
+            filters=filters, fetch_k=fetch_k, lambda_mult=lambda_mult
+        )[0]
+    
+    async def asearch(self, query: str, k: int = 5, use_mmr: bool = True, search_type: Optional[str] = None,
+                      filters: Optional[dict] = None, fetch_k: Optional[int] = None,
+                      lambda_mult: float = DEFAULT_LAMBDA_MULT) -> List[Document]:
+        """search() の非同期版（引数は search() と同じ）"""
+        return (await self.asearch_many(
+            [query], k=k, use_mmr=use_mmr, search_type=search_type,
+            filters=filters, fetch_k=fetch_k, lambda_mult=lambda_mult
+        ))[0]
+    
+    def named_vendor_ids(self, query: str) -> List[str]:
+        """
+        ベンダー名だけで特定できる質問なら、そのベンダーIDを取得（search() が埋め込みを省略する質問）
+        
+        Returns:
+            ベンダー名辞書で特定したベンダーIDのリスト（特定できない場合・辞書がない旧バージョンでは空）
+        """
+        alias_index = self.alias_index
+        if alias_index is None:
+            return []
+        vendor_ids, resolved = alias_index.resolve(query)
+        return vendor_ids if resolved else []
+    
+    def get_cache_stats(self) -> dict:
+        """埋め込みキャッシュの統計を取得"""
+        if not self.embedding_cache:
+            return {}
+        return self.embedding_cache.stats()
+    
     def get_document_count(self) -> int:
         """ベクトルDB内のドキュメント数を取得"""
         try:
-            if not self.vectorstore:
+            if not self.index:
                 return 0
             
-            collection = self.vectorstore._collection
-            return collection.count()
+            return self._refresh_if_updated().backend.count()
         except Exception:
             return 0
 
 class VendorResponseFormatter:
     """ベンダー回答整形クラス"""
     
-    def __init__(self, api_key: Optional[str] = None, model: str = "gpt-3.5-turbo"):
+    def __init__(self, api_key: Optional[str] = None, model: str = "gpt-3.5-turbo", context_tokens: Optional[int] = None,
+                 map_reduce_documents: Optional[int] = None, map_reduce_tokens: Optional[int] = None):
         """
         初期化
         
         Args:
             api_key: OpenAI APIキー
             model: 使用するモデル名
+            context_tokens: コンテキストのトークン数の上限（未指定時はモデルごとの既定値）
+            map_reduce_documents: 分割生成に切り替える検索件数（これより多い場合。
+                未指定時は環境変数 VENDOR_RAG_MAP_REDUCE_K、なければ MAP_REDUCE_DOCUMENTS）
+            map_reduce_tokens: 分割生成に切り替えるコンテキストの見積もりトークン数（これより多い場合。
+                未指定時は環境変数 VENDOR_RAG_MAP_REDUCE_TOKENS、なければコンテキストの上限）
         """
         self.api_key = api_key
         self.model = model
         self.llm = None
+        self.selection_llm = None
+        self.context_builder = ContextBuilder(model, budget=context_tokens)
+        self.map_reduce_documents = map_reduce_documents or int(os.getenv("VENDOR_RAG_MAP_REDUCE_K", MAP_REDUCE_DOCUMENTS))
+        self.map_reduce_tokens = (map_reduce_tokens or int(os.getenv("VENDOR_RAG_MAP_REDUCE_TOKENS", 0))
+                                  or self.context_builder.budget)
+        self.map_chunk_size = int(os.getenv("VENDOR_RAG_MAP_CHUNK_SIZE", MAP_CHUNK_SIZE))
+        self.map_concurrency = int(os.getenv("VENDOR_RAG_MAP_CONCURRENCY", MAP_CONCURRENCY))
+        self._prompts = OrderedDict()
+        self._prompts_lock = threading.Lock()
         
         self._initialize_llm()
     
     def _initialize_llm(self):
         """LLMの初期化"""
         try:
+            # 接続・タイムアウト・リトライは共有トランスポートで管理する（クライアント側のリトライは無効化）
+            transport = get_transport()
             self.llm = ChatOpenAI(
                 model=self.model,
                 openai_api_key=self.api_key,
-                temperature=0.1  # 低い温度で一貫性のある回答を生成
+                temperature=0.1,  # 低い温度で一貫性のある回答を生成
+                http_client=transport.http_client,
+                http_async_client=transport.async_http_client,
+                timeout=transport.timeout("chat"),
+                max_retries=0,
+                # ストリーミングでも最後にAPIの usage（実際のトークン数）を受け取る
+                stream_usage=True
             )
+            # ベンダーの選定（compact）はJSONだけを返させる
+            self.selection_llm = self.llm.bind(response_format={"type": "json_object"})
         except Exception as e:
             raise Exception(f"LLMの初期化に失敗しました: {e}")
     
@@ -145,88 +554,108 @@ class VendorResponseFormatter:
         Returns:
             抽出されたベンダー情報の辞書
         """
-        content = document.page_content
-        
-        # 正規表現でベンダー情報を抽出
-        patterns = {
-            'name': r'ベンダー \d+: (.+?) ｜',
-            'vendor_id': r'ベンダーID: (.+?) ｜',
-            'aliases': r'別名: (.+?) ｜',
-            'interview_status': r'面談状況: (.+?) ｜',
-            'category': r'カテゴリ: (.+?) ｜',
-            'industry_tags': r'業界タグ: (.+?) ｜',
-            'tech_stack': r'技術スタック: (.+?) ｜',
-            'price_range': r'価格帯: (.+?) ｜',
-            'deployment': r'デプロイ方式: (.+?) ｜',
-            'strengths': r'強み: (.+?) ｜',
-            'service_summary': r'サービス概要: (.+?) ｜',
-            'description': r'詳細説明: (.+?) ｜',
-            'url': r'URL: (.+?) ｜'
-        }
-        
-        vendor_info = {}
-        for key, pattern in patterns.items():
-            match = re.search(pattern, content)
-            if match:
-                vendor_info[key] = match.group(1).strip()
-            else:
-                vendor_info[key] = "情報なし"
+        # 取り込み時に解析済みのメタデータをそのまま使用（正規表現は使わない）
+        vendor_info = vendor_info_from_metadata(document.metadata)
+        if vendor_info is None:
+            # 旧形式のベクトルDB（メタデータにフィールドがない）は本文を1パスで解析
+            vendor_info = vendor_info_from_text(document.page_content)
         
         return vendor_info
     
-    def _create_context_text(self, documents: List[Document]) -> str:
+    def _create_context_text(self, question: str, documents: List[Document]) -> tuple[str, dict]:
         """
         ドキュメントリストからコンテキストテキストを作成
         
+        取り込み時に作成済みのコンテキストブロックがあれば、ベンダーIDの順につなげるだけで作る
+        （同じベンダーの組み合わせなら同じテキストになる）。ブロックがない旧形式のベクトルDBや、
+        質問がブロックにない項目を求めている場合・上限を超える場合は、質問との関連が低い項目を
+        トークン数の上限に応じて省略・短縮して作り直す（context_builder を参照）。
+        
         Args:
+            question: ユーザーの質問
             documents: 検索結果のドキュメントリスト
             
         Returns:
-            コンテキストテキスト
+            コンテキストテキストと、トークン数・省略した項目数などの統計情報
         """
-        context_parts = []
-        
-        for i, doc in enumerate(documents, 1):
-            vendor_info = self._extract_vendor_info(doc)
-            
-            context_part = f"""
-## ベンダー{i}
-- **ベンダー名**: {vendor_info['name']}
-- **ベンダーID**: {vendor_info['vendor_id']}
-- **別名**: {vendor_info['aliases']}
-- **面談状況**: {vendor_info['interview_status']}
-- **カテゴリ**: {vendor_info['category']}
-- **業界タグ**: {vendor_info['industry_tags']}
-- **技術スタック**: {vendor_info['tech_stack']}
-- **価格帯**: {vendor_info['price_range']}
-- **デプロイ方式**: {vendor_info['deployment']}
-- **強み**: {vendor_info['strengths']}
-- **サービス概要**: {vendor_info['service_summary']}
-- **詳細説明**: {vendor_info['description']}
-- **URL**: {vendor_info['url']}
-"""
-            context_parts.append(context_part)
+        assembled = self.context_builder.assemble(question, [self._context_block(doc) for doc in documents])
+        if assembled is not None:
+            return assembled
         
-        return "\n".join(context_parts)
+        vendor_infos = [self._extract_vendor_info(doc) for doc in documents]
+        return self.context_builder.build(question, vendor_infos)
+    
+    def _context_block(self, document: Document) -> Optional[tuple[str, str, int]]:
+        """取り込み時に作成済みのコンテキストブロック（ベンダーID, ブロック, トークン数）。ない場合はNone"""
+        metadata = document.metadata or {}
+        block = metadata.get("context_block")
+        if not block:
+            return None
+        return metadata.get("vendor_id") or "", block, int(metadata.get("context_block_tokens") or 0)
     
-    def format_response(self, question: str, documents: List[Document]) -> str:
+    def build_prompt(self, question: str, documents: List[Document], renderer: str = "llm") -> tuple[list, dict]:
         """
-        質問とドキュメントから整形された回答を生成
+        質問とドキュメントからLLMに渡すメッセージを作成
+        
+        同じ質問と検索結果のプロンプトは保持しておき、回答生成後のトークン数の集計では作り直さない。
         
         Args:
             question: ユーザーの質問
             documents: 検索結果のドキュメントリスト
+            renderer: 回答の作成方法（"llm": 回答全体を生成 / "compact": ベンダーIDと選定理由だけを生成）
             
         Returns:
-            整形されたMarkdown形式の回答
+            SystemMessage と HumanMessage のリストと、プロンプトのトークン数情報
+            （prompt_tokens と _create_context_text() の統計情報）
         """
-        if not documents:
-            return self._create_no_results_response(question)
+        key = (renderer, question, tuple(doc.page_content for doc in documents))
+        with self._prompts_lock:
+            cached = self._prompts.get(key)
+            if cached is not None:
+                self._prompts.move_to_end(key)
+                return cached
         
+        messages, prompt_info = self._build_messages(question, documents, renderer)
+        with self._prompts_lock:
+            self._prompts[key] = (messages, prompt_info)
+            while len(self._prompts) > PROMPT_CACHE_SIZE:
+                self._prompts.popitem(last=False)
+        return messages, prompt_info
+    
+    def _build_messages(self, question: str, documents: List[Document], renderer: str = "llm") -> tuple[list, dict]:
+        """build_prompt() の本体（プロンプトを作成してトークン数を数える）"""
         # コンテキストテキストの作成
-        context_text = self._create_context_text(documents)
+        context_text, prompt_info = self._create_context_text(question, documents)
+        
+        if renderer == "compact":
+            system_prompt, instruction = self._selection_prompt()
+        elif renderer == "map":
+            system_prompt, instruction = self._map_prompt()
+        else:
+            system_prompt, instruction = self._answer_prompt()
+        
+        # システムプロンプトとベンダー情報を先頭に置き、質問は最後に置く
+        # （同じベンダーの組み合わせならプロンプトの先頭が一致し、プロバイダー側のプロンプトキャッシュが効く）
+        human_prompt = f"""ベンダー情報:
+{context_text}
+
+質問: {question}
+
+{instruction}
+"""
         
-        # プロンプトテンプレート
+        messages = [
+            SystemMessage(content=system_prompt),
+            HumanMessage(content=human_prompt)
+        ]
+        prompt_info = dict(prompt_info)
+        prompt_info["prompt_tokens"] = REPLY_PRIMING_TOKENS + sum(
+            count_tokens(message.content, self.model) + MESSAGE_OVERHEAD_TOKENS for message in messages
+        )
+        return messages, prompt_info
+    
+    def _answer_prompt(self) -> tuple[str, str]:
+        """回答全体を生成させるプロンプト（システムプロンプト, 質問の後の指示）"""
         system_prompt = """あなたはベンダー情報の専門アシスタントです。
 提供されたベンダー情報のみを使用して、ユーザーの質問に回答してください。
 
@@ -255,164 +684,1418 @@ class VendorResponseFormatter:
 ## ベンダー2
 （同様に続く）
 ```"""
+        return system_prompt, "上記のベンダー情報のみを使用して、質問に回答してください。"
+    
+    def _selection_prompt(self) -> tuple[str, str]:
+        """ベンダーIDと選定理由だけを生成させるプロンプト（システムプロンプト, 質問の後の指示）"""
+        system_prompt = """あなたはベンダー情報の専門アシスタントです。
+提供されたベンダー情報のみを使用して、ユーザーの質問に該当するベンダーを選んでください。
 
-        human_prompt = f"""
-質問: {question}
+重要なルール：
+1. 質問に関連するベンダーのみを、関連の高い順に選ぶ
+2. ベンダーIDは提供された値をそのまま使う
+3. 選定理由は提供されたベンダー情報に基づき、1文（40文字程度）で書く
+4. ベンダー名やカテゴリなどの項目は出力しない（項目はシステムが転記する）
+5. 次の形式のJSONだけを出力する。該当するベンダーがなければ "vendors" は空のリストにする
 
-ベンダー情報:
-{context_text}
+{"vendors": [{"id": "ベンダーID", "reason": "選定理由"}]}"""
+        return system_prompt, "上記のベンダー情報から質問に該当するベンダーを選び、JSONだけを出力してください。"
+    
+    def _map_prompt(self) -> tuple[str, str]:
+        """分割生成の map（ベンダーの一部から該当するものを関連度付きで選ぶ）のプロンプト（システムプロンプト, 質問の後の指示）"""
+        system_prompt = """あなたはベンダー情報の専門アシスタントです。
+提供されたベンダー情報（候補の一部）のみを使用して、ユーザーの質問に該当するベンダーを選んでください。
 
-上記のベンダー情報のみを使用して、質問に回答してください。
-"""
+重要なルール：
+1. 質問に関連するベンダーのみを選ぶ
+2. ベンダーIDは提供された値をそのまま使う
+3. 関連度は0〜10の整数で付ける（10が最も関連が高い）
+4. 選定理由は提供されたベンダー情報に基づき、1文（40文字程度）で書く
+5. 次の形式のJSONだけを出力する。該当するベンダーがなければ "vendors" は空のリストにする
 
-        try:
-            # LLMで回答生成
-            messages = [
-                SystemMessage(content=system_prompt),
-                HumanMessage(content=human_prompt)
-            ]
-            
-            response = self.llm.invoke(messages)
-            
-            # 回答の整形
-            formatted_response = self._post_process_response(response.content)
-            
-            return formatted_response
-            
-        except Exception as e:
-            return f"回答生成中にエラーが発生しました: {e}"
+{"vendors": [{"id": "ベンダーID", "score": 関連度, "reason": "選定理由"}]}"""
+        return system_prompt, "上記のベンダー情報から質問に該当するベンダーを選び、関連度と選定理由を付けてJSONだけを出力してください。"
     
-    def _create_no_results_response(self, question: str) -> str:
-        """検索結果がない場合の回答"""
-        return f"""【質問】
-{question}
+    def _reduce_prompt(self) -> tuple[str, str]:
+        """分割生成の reduce（map で選ばれた候補から最終的な回答のベンダーを選ぶ）のプロンプト（システムプロンプト, 質問の後の指示）"""
+        system_prompt = """あなたはベンダー情報の専門アシスタントです。
+ベンダー候補は、検索結果を分けて質問との関連度と選定理由を付けたものです。
+候補の中から、ユーザーの質問への回答に含めるベンダーを選んでください。
 
-【回答】
-申し訳ございませんが、ご質問に関連するベンダー情報が見つかりませんでした。
+重要なルール：
+1. 質問に関連するベンダーのみを、関連の高い順に選ぶ
+2. ベンダーIDは提供された値をそのまま使う
+3. 選定理由は候補の選定理由をもとに、1文（40文字程度）で書く
+4. 次の形式のJSONだけを出力する。該当するベンダーがなければ "vendors" は空のリストにする
 
-以下の点をご確認ください：
-- キーワードを変更して再度お試しください
-- より具体的な業界やカテゴリを指定してください
-- 技術スタックやサービス内容で検索してみてください"""
+{"vendors": [{"id": "ベンダーID", "reason": "選定理由"}]}"""
+        return system_prompt, "上記のベンダー候補から回答に含めるベンダーを選び、JSONだけを出力してください。"
     
-    def _post_process_response(self, response: str) -> str:
+    def format_response(self, question: str, documents: List[Document], usage: Optional[dict] = None) -> str:
         """
-        回答の後処理
+        質問とドキュメントから整形された回答を生成
         
         Args:
-            response: LLMからの回答
+            question: ユーザーの質問
+            documents: 検索結果のドキュメントリスト
+            usage: APIが返したトークン数の集計先（input_tokens / output_tokens / calls を加算する）
             
         Returns:
-            後処理された回答
+            整形されたMarkdown形式の回答
         """
-        # 余分な改行を整理
-        response = re.sub(r'\n{3,}', '\n\n', response)
-        
-        # マークダウンの整形
-        response = response.strip()
+        if not documents:
+            return self._create_no_results_response(question)
         
-        return response
-
-def load_environment():
-    """環境変数の読み込み"""
-    load_dotenv()
-    
-    # OpenAI APIキーの確認
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        # .envファイルがない場合は、API.txtから読み込み
         try:
-            with open("../../API.txt", "r", encoding="utf-8") as f:
-                api_key = f.read().strip()
-        except FileNotFoundError:
-            raise ValueError("OPENAI_API_KEYが設定されていません。.envファイルまたはAPI.txtを確認してください。")
+            # LLMで回答生成
+            response = self.llm.invoke(self.build_prompt(question, documents)[0])
+            _add_usage(usage, response)
+            
+            # 回答の整形
+            return self._post_process_response(response.content)
+            
+        except Exception as e:
+            return f"{GENERATION_ERROR_PREFIX}: {e}"
     
-    return api_key
-
-def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
-    """テキストのトークン数を計算"""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-        return len(encoding.encode(text))
-    except Exception:
-        # フォールバック: 大まかな計算（1トークン ≈ 4文字）
-        return len(text) // 4
-
-def query_vendor_info(question: str, k: int = 5, use_mmr: bool = True, model: str = "gpt-3.5-turbo", vectordb_path: str = "vectordb") -> tuple[str, dict]:
-    """
-    ベンダー情報を検索して回答を生成する関数
+    async def aformat_response(self, question: str, documents: List[Document], usage: Optional[dict] = None) -> str:
+        """format_response() の非同期版（LLMの非同期クライアントで生成）"""
+        if not documents:
+            return self._create_no_results_response(question)
+        
+        try:
+            response = await self.llm.ainvoke(self.build_prompt(question, documents)[0])
+            _add_usage(usage, response)
+            return self._post_process_response(response.content)
+            
+        except Exception as e:
+            return f"{GENERATION_ERROR_PREFIX}: {e}"
     
-    Args:
-        question: 検索したい質問
-        k: 検索するベンダー数
-        use_mmr: MMR検索を使用するかどうか
-        model: 使用するLLMモデル
-        vectordb_path: ベクトルDBのパス
+    def stream_response(self, question: str, documents: List[Document], usage: Optional[dict] = None) -> Iterator[str]:
+        """
+        format_response() のストリーミング版（生成されたトークンを順に返す）
         
-    Returns:
-        整形されたMarkdown形式の回答
-    """
-    try:
-        # 1. 環境変数の読み込み
-        api_key = load_environment()
+        後処理（余分な改行の整理）はかけないため、全体をつなげた後に _post_process_response() を通す。
+        生成中にエラーが発生した場合は、エラーメッセージを最後の断片として返す。
+        """
+        if not documents:
+            yield self._create_no_results_response(question)
+            return
         
-        # 2. ベクトルDBの読み込み
-        retriever = VendorRetriever(
-            vectordb_path=vectordb_path,
-            api_key=api_key
-        )
+        try:
+            for chunk in self.llm.stream(self.build_prompt(question, documents)[0]):
+                _add_usage(usage, chunk)
+                if chunk.content:
+                    yield chunk.content
+        except Exception as e:
+            yield f"\n\n{GENERATION_ERROR_PREFIX}: {e}"
+    
+    async def astream_response(self, question: str, documents: List[Document],
+                               usage: Optional[dict] = None) -> AsyncIterator[str]:
+        """stream_response() の非同期版"""
+        if not documents:
+            yield self._create_no_results_response(question)
+            return
         
-        # ベクトルDB内のドキュメント数を確認
-        doc_count = retriever.get_document_count()
-        if doc_count == 0:
-            return "エラー: ベクトルDBにデータがありません。Step1を先に実行してください。", {}
+        try:
+            async for chunk in self.llm.astream(self.build_prompt(question, documents)[0]):
+                _add_usage(usage, chunk)
+                if chunk.content:
+                    yield chunk.content
+        except Exception as e:
+            yield f"\n\n{GENERATION_ERROR_PREFIX}: {e}"
+    
+    def render_template(self, question: str, documents: List[Document]) -> str:
+        """
+        LLMを使わずに回答を作成（検索されたベンダーの項目を回答形式のMarkdownにそのまま転記）
         
-        # 3. ベンダー情報の検索
-        documents = retriever.search(
-            query=question,
-            k=k,
-            use_mmr=use_mmr
-        )
+        「〜のベンダーは？」のような一覧の質問向け。トークンを消費せず、ミリ秒単位で返る。
         
+        Args:
+            question: ユーザーの質問
+            documents: 検索結果のドキュメントリスト
+            
+        Returns:
+            format_response() と同じ【質問】/【回答】形式のMarkdown
+        """
         if not documents:
-            return "検索結果が見つかりませんでした。", {}
+            return self._create_no_results_response(question)
+        return self._render_cards(question, [(doc, None) for doc in documents])
+    
+    def _render_cards(self, question: str, selections: list) -> str:
+        """
+        (ドキュメント, 選定理由) の列を回答形式のMarkdownに転記
         
-        # 4. LLMの初期化
-        formatter = VendorResponseFormatter(
-            api_key=api_key,
-            model=model
-        )
+        Args:
+            question: ユーザーの質問
+            selections: (ドキュメント, 選定理由またはNone) のリスト
+        """
+        parts = []
+        for i, (doc, reason) in enumerate(selections, 1):
+            vendor_info = self._extract_vendor_info(doc)
+            lines = [f"- **{label}**: {vendor_info[key]}" for key, label in ANSWER_FIELDS]
+            if reason:
+                lines.append(f"- **選定理由**: {reason}")
+            parts.append(f"## ベンダー{i}\n" + "\n".join(lines))
+        if not parts:
+            parts.append("提供されたベンダー情報の中に、ご質問に該当するベンダーは見つかりませんでした。")
+        return f"【質問】\n{question}\n\n【回答】\n" + "\n\n".join(parts)
+    
+    def _parse_selection(self, content: str, documents: List[Document]) -> list:
+        """
+        ベンダー選定のJSONを解析
         
-        # 5. 回答の生成
-        response = formatter.format_response(question, documents)
+        検索結果にないベンダーIDと重複は無視する。
         
-        # 6. トークン数の計算
-        # 質問のトークン数
-        question_tokens = count_tokens(question, model)
+        Returns:
+            (ドキュメント, 選定理由) のリスト（LLMが選んだ順）
+            
+        Raises:
+            ValueError: JSONとして解析できない場合
+        """
+        return [(doc, str(item.get("reason") or "").strip()) for doc, item in self._parse_vendors(content, documents)]
+    
+    def _parse_vendors(self, content: str, documents: List[Document]) -> list:
+        """
+        ベンダー選定のJSONの "vendors" を解析（検索結果にないベンダーIDと重複は無視）
         
-        # 検索結果のトークン数
-        context_text = ""
-        for doc in documents:
-            context_text += doc.page_content + "\n"
-        context_tokens = count_tokens(context_text, model)
+        Returns:
+            (ドキュメント, JSONの要素) のリスト（LLMが選んだ順）
+            
+        Raises:
+            ValueError: JSONとして解析できない場合
+        """
+        match = re.search(r"\{.*\}", content, re.DOTALL)
+        if match is None:
+            raise ValueError("JSONが見つかりません")
+        data = json.loads(match.group(0))
         
-        # 回答のトークン数
-        response_tokens = count_tokens(response, model)
+        by_id = {doc.metadata.get("vendor_id"): doc for doc in documents}
+        selections, seen = [], set()
+        for item in data.get("vendors") or []:
+            vendor_id = str(item.get("id", "")).strip() if isinstance(item, dict) else ""
+            if vendor_id in by_id and vendor_id not in seen:
+                seen.add(vendor_id)
+                selections.append((by_id[vendor_id], item))
+        return selections
+    
+    def _parse_scores(self, content: str, documents: List[Document]) -> list:
+        """
+        map の結果を解析
+        
+        Returns:
+            関連度が MAP_MIN_SCORE 以上の (ドキュメント, 関連度, 選定理由) のリスト（関連度がないものは MAP_MIN_SCORE とみなす）
+        """
+        candidates = []
+        for doc, item in self._parse_vendors(content, documents):
+            try:
+                score = float(item.get("score", MAP_MIN_SCORE))
+            except (TypeError, ValueError):
+                score = MAP_MIN_SCORE
+            if score >= MAP_MIN_SCORE:
+                candidates.append((doc, score, str(item.get("reason") or "").strip()))
+        return candidates
+    
+    def format_compact(self, question: str, documents: List[Document], usage: Optional[dict] = None) -> tuple[str, str]:
+        """
+        LLMにはベンダーIDと選定理由だけをJSONで生成させ、項目はメタデータから転記して回答を作成
+        
+        LLMが書く量が選定結果だけになるため、出力トークン数と生成時間が回答全体を生成する場合より小さい。
+        
+        Args:
+            question: ユーザーの質問
+            documents: 検索結果のドキュメントリスト
+            usage: APIが返したトークン数の集計先（format_response() と同じ）
+            
+        Returns:
+            (回答形式のMarkdown, LLMが実際に出力したテキスト)
+        """
+        if not documents:
+            return self._create_no_results_response(question), ""
+        
+        try:
+            response = self.selection_llm.invoke(self.build_prompt(question, documents, "compact")[0])
+            _add_usage(usage, response)
+            return self._render_cards(question, self._parse_selection(response.content, documents)), response.content
+        except Exception as e:
+            return f"{GENERATION_ERROR_PREFIX}: {e}", ""
+    
+    async def aformat_compact(self, question: str, documents: List[Document],
+                              usage: Optional[dict] = None) -> tuple[str, str]:
+        """format_compact() の非同期版"""
+        if not documents:
+            return self._create_no_results_response(question), ""
+        
+        try:
+            response = await self.selection_llm.ainvoke(self.build_prompt(question, documents, "compact")[0])
+            _add_usage(usage, response)
+            return self._render_cards(question, self._parse_selection(response.content, documents)), response.content
+        except Exception as e:
+            return f"{GENERATION_ERROR_PREFIX}: {e}", ""
+    
+    def use_map_reduce(self, documents: List[Document]) -> bool:
+        """
+        分割生成（map-reduce）で回答を作成するか
+        
+        検索件数が map_reduce_documents を超える場合と、コンテキストの見積もり（作成済みブロックのトークン数、
+        ない場合は本文のトークン数）が map_reduce_tokens を超える場合に使う。
+        """
+        if len(documents) > self.map_reduce_documents:
+            return True
+        estimated = 0
+        for doc in documents:
+            block = self._context_block(doc)
+            estimated += block[2] if block else count_tokens(doc.page_content, self.model)
+        return estimated > self.map_reduce_tokens
+    
+    def _map_chunks(self, documents: List[Document]) -> List[List[Document]]:
+        return [documents[i:i + self.map_chunk_size] for i in range(0, len(documents), self.map_chunk_size)]
+    
+    def _reduce_messages(self, question: str, candidates: list) -> list:
+        """map で選ばれた候補（ベンダーID・ベンダー名・関連度・選定理由だけ）から reduce のメッセージを作成"""
+        blocks = []
+        for doc, score, reason in candidates:
+            vendor_id = doc.metadata.get("vendor_id") or ""
+            blocks.append(f"\n## ベンダー（{vendor_id}）\n"
+                          f"- **ベンダーID**: {vendor_id}\n"
+                          f"- **ベンダー名**: {self._extract_vendor_info(doc)['name']}\n"
+                          f"- **関連度**: {score:g}\n"
+                          f"- **選定理由**: {reason}\n")
+        system_prompt, instruction = self._reduce_prompt()
+        human_prompt = f"""ベンダー候補:
+{"".join(blocks)}
+
+質問: {question}
+
+{instruction}
+"""
+        return [SystemMessage(content=system_prompt), HumanMessage(content=human_prompt)]
+    
+    def _map_reduce_result(self, question: str, chunks: List[List[Document]],
+                           map_outputs: List[str], map_seconds: float) -> tuple[list, list, dict]:
+        """
+        map の結果をまとめ、reduce のメッセージとプロンプトのトークン数情報を作成（同期版・非同期版で共通）
+        
+        Returns:
+            (map で選ばれた候補, reduce のメッセージ（候補がなければ空）, プロンプトのトークン数情報)
+        """
+        candidates = []
+        prompt_info = {"prompt_tokens": 0, "context_tokens": 0, "fields_truncated": 0, "fields_dropped": 0,
+                       "context_budget": self.context_builder.budget, "context_source": "precomputed"}
+        for chunk, output in zip(chunks, map_outputs):
+            candidates.extend(self._parse_scores(output, chunk))
+            _, chunk_info = self.build_prompt(question, chunk, "map")
+            for key in ("prompt_tokens", "context_tokens", "fields_truncated", "fields_dropped"):
+                prompt_info[key] += chunk_info.get(key, 0)
+            if chunk_info.get("context_source") == "built":
+                prompt_info["context_source"] = "built"
+        
+        messages = self._reduce_messages(question, candidates) if candidates else []
+        prompt_info["prompt_tokens"] += sum(
+            count_tokens(message.content, self.model) + MESSAGE_OVERHEAD_TOKENS for message in messages
+        ) + (REPLY_PRIMING_TOKENS if messages else 0)
+        prompt_info["map_reduce"] = {
+            "map_calls": len(chunks),
+            "candidates": len(candidates),
+            "map_seconds": round(map_seconds, 3),
+        }
+        return candidates, messages, prompt_info
+    
+    def format_map_reduce(self, question: str, documents: List[Document],
+                          usage: Optional[dict] = None) -> tuple[str, str, dict]:
+        """
+        分割生成（map-reduce）で回答を作成
+        
+        ベンダーを map_chunk_size 件ずつに分け、各チャンクで該当するベンダーを関連度・選定理由付きで選ぶ（map、
+        最大 map_concurrency 件を並列に呼び出す）。選ばれたベンダーのID・名前・関連度・選定理由だけを渡す1回の
+        短い呼び出し（reduce）で回答に含めるベンダーと順序を決め、項目はメタデータから転記する。
+        どの呼び出しも出力は選定結果のJSONだけのため、検索件数が多くても全体の時間は小さな呼び出し2回分程度になる。
+        
+        Args:
+            question: ユーザーの質問
+            documents: 検索結果のドキュメントリスト
+            usage: APIが返したトークン数の集計先（全呼び出しの合計を加算する）
+            
+        Returns:
+            (回答形式のMarkdown, LLMが実際に出力したテキスト（全呼び出し分）, プロンプトのトークン数情報
+            （build_prompt() と同じ項目と、map_reduce に呼び出し回数・候補数・秒数）)
+        """
+        if not documents:
+            return self._create_no_results_response(question), "", {}
+        
+        try:
+            started = time.perf_counter()
+            chunks = self._map_chunks(documents)
+            
+            def map_chunk(chunk: List[Document]):
+                return self.selection_llm.invoke(self.build_prompt(question, chunk, "map")[0])
+            
+            with ThreadPoolExecutor(max_workers=min(self.map_concurrency, len(chunks))) as executor:
+                map_responses = list(executor.map(map_chunk, chunks))
+            for response in map_responses:
+                _add_usage(usage, response)
+            map_outputs = [response.content for response in map_responses]
+            
+            reduce_started = time.perf_counter()
+            candidates, messages, prompt_info = self._map_reduce_result(
+                question, chunks, map_outputs, reduce_started - started
+            )
+            if not messages:
+                return self._render_cards(question, []), "".join(map_outputs), prompt_info
+            reduce_response = self.selection_llm.invoke(messages)
+            _add_usage(usage, reduce_response)
+            reduce_output = reduce_response.content
+            prompt_info["map_reduce"]["reduce_seconds"] = round(time.perf_counter() - reduce_started, 3)
+            selections = self._parse_selection(reduce_output, [doc for doc, _, _ in candidates])
+            return self._render_cards(question, selections), "".join(map_outputs) + reduce_output, prompt_info
+        except Exception as e:
+            return f"{GENERATION_ERROR_PREFIX}: {e}", "", {}
+    
+    async def aformat_map_reduce(self, question: str, documents: List[Document],
+                                 usage: Optional[dict] = None) -> tuple[str, str, dict]:
+        """format_map_reduce() の非同期版（map は非同期クライアントで同時に呼び出す）"""
+        if not documents:
+            return self._create_no_results_response(question), "", {}
+        
+        try:
+            started = time.perf_counter()
+            chunks = self._map_chunks(documents)
+            semaphore = asyncio.Semaphore(self.map_concurrency)
+            
+            async def map_chunk(chunk: List[Document]):
+                async with semaphore:
+                    return await self.selection_llm.ainvoke(self.build_prompt(question, chunk, "map")[0])
+            
+            map_responses = await asyncio.gather(*(map_chunk(chunk) for chunk in chunks))
+            for response in map_responses:
+                _add_usage(usage, response)
+            map_outputs = [response.content for response in map_responses]
+            
+            reduce_started = time.perf_counter()
+            candidates, messages, prompt_info = self._map_reduce_result(
+                question, chunks, map_outputs, reduce_started - started
+            )
+            if not messages:
+                return self._render_cards(question, []), "".join(map_outputs), prompt_info
+            reduce_response = await self.selection_llm.ainvoke(messages)
+            _add_usage(usage, reduce_response)
+            reduce_output = reduce_response.content
+            prompt_info["map_reduce"]["reduce_seconds"] = round(time.perf_counter() - reduce_started, 3)
+            selections = self._parse_selection(reduce_output, [doc for doc, _, _ in candidates])
+            return self._render_cards(question, selections), "".join(map_outputs) + reduce_output, prompt_info
+        except Exception as e:
+            return f"{GENERATION_ERROR_PREFIX}: {e}", "", {}
+    
+    def _create_no_results_response(self, question: str) -> str:
+        """検索結果がない場合の回答"""
+        return f"""【質問】
+{question}
+
+【回答】
+申し訳ございませんが、ご質問に関連するベンダー情報が見つかりませんでした。
+
+以下の点をご確認ください：
+- キーワードを変更して再度お試しください
+- より具体的な業界やカテゴリを指定してください
+- 技術スタックやサービス内容で検索してみてください"""
+    
+    def _post_process_response(self, response: str) -> str:
+        """
+        回答の後処理
+        
+        Args:
+            response: LLMからの回答
+            
+        Returns:
+            後処理された回答
+        """
+        # 余分な改行を整理
+        response = re.sub(r'\n{3,}', '\n\n', response)
+        
+        # マークダウンの整形
+        response = response.strip()
+        
+        return response
+
+def load_environment():
+    """環境変数の読み込み"""
+    load_dotenv()
+    
+    # OpenAI APIキーの確認
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        # .envファイルがない場合は、API.txtから読み込み
+        try:
+            with open("../../API.txt", "r", encoding="utf-8") as f:
+                api_key = f.read().strip()
+        except FileNotFoundError:
+            raise ValueError("OPENAI_API_KEYが設定されていません。.envファイルまたはAPI.txtを確認してください。")
+    
+    return api_key
+
+class VendorRAGEngine:
+    """
+    プロセス内で共有する検索・回答生成エンジン
+    
+    ベクトルDB・埋め込みクライアント・LLMクライアントを一度だけ初期化して保持し、
+    Streamlitのセッションや再実行をまたいで再利用する。get_engine() から取得する。
+    """
+    
+    def __init__(self, vectordb_path: str, model: str, api_key: Optional[str] = None):
+        """
+        初期化
+        
+        Args:
+            vectordb_path: ベクトルDBのパス
+            model: 使用するLLMモデル
+            api_key: OpenAI APIキー
+        """
+        self.vectordb_path = vectordb_path
+        self.model = model
+        self.retriever = get_retriever(vectordb_path, api_key)
+        self.formatter = VendorResponseFormatter(api_key=api_key, model=model)
+
+# (ベクトルDBの絶対パス, モデル) → エンジン、ベクトルDBの絶対パス → 検索クラス
+_engines: dict = {}
+_retrievers: dict = {}
+_engines_lock = threading.Lock()
+
+# ベクトルDBの絶対パス → 回答キャッシュ・意味的な回答キャッシュ・同時実行のまとめ・テレメトリ（無効の場合はNone）
+_answer_caches: dict = {}
+_semantic_caches: dict = {}
+_single_flights: dict = {}
+_telemetries: dict = {}
+
+def get_retriever(vectordb_path: str = "vectordb", api_key: Optional[str] = None) -> VendorRetriever:
+    """
+    プロセス内で共有する VendorRetriever を取得（初回のみ初期化）
+    
+    同じベクトルDBを使うエンジン同士（モデル違い）でも、埋め込みクライアントとChromaは共有する。
+    """
+    key = os.path.abspath(vectordb_path)
+    with _engines_lock:
+        retriever = _retrievers.get(key)
+        if retriever is None:
+            retriever = VendorRetriever(
+                vectordb_path=vectordb_path,
+                api_key=api_key or load_environment()
+            )
+            _retrievers[key] = retriever
+        return retriever
+
+def get_answer_cache(vectordb_path: str = "vectordb") -> Optional[AnswerCache]:
+    """
+    プロセス内で共有する回答キャッシュを取得（初回のみ作成）
+    
+    種類・有効期限・件数は環境変数で設定する（answer_cache.open_answer_cache を参照）。
+    モデルが違っても同じベクトルDBなら同じキャッシュを使う（キーにモデルを含む）。
+    """
+    key = os.path.abspath(vectordb_path)
+    with _engines_lock:
+        if key not in _answer_caches:
+            _answer_caches[key] = open_answer_cache(vectordb_path)
+        return _answer_caches[key]
+
+def get_semantic_cache(vectordb_path: str = "vectordb") -> Optional[SemanticAnswerCache]:
+    """
+    プロセス内で共有する意味的な回答キャッシュを取得（初回のみ作成）
+    
+    閾値・件数は環境変数で設定する（semantic_cache.open_semantic_cache を参照）。
+    """
+    key = os.path.abspath(vectordb_path)
+    with _engines_lock:
+        if key not in _semantic_caches:
+            _semantic_caches[key] = open_semantic_cache()
+        return _semantic_caches[key]
+
+def get_single_flight(vectordb_path: str = "vectordb") -> Optional[SingleFlight]:
+    """
+    プロセス内で共有する同時実行のまとめを取得（初回のみ作成）
+    
+    方式・ロックの保存先・待つ秒数は環境変数で設定する（singleflight.open_single_flight を参照）。
+    """
+    key = os.path.abspath(vectordb_path)
+    with _engines_lock:
+        if key not in _single_flights:
+            _single_flights[key] = open_single_flight(vectordb_path)
+        return _single_flights[key]
+
+def get_telemetry(vectordb_path: str = "vectordb") -> Optional[TelemetryStore]:
+    """
+    プロセス内で共有するテレメトリの保存先を取得（初回のみ作成）
+    
+    種類・保存先・料金は環境変数で設定する（telemetry.open_telemetry を参照）。
+    """
+    key = os.path.abspath(vectordb_path)
+    with _engines_lock:
+        if key not in _telemetries:
+            _telemetries[key] = open_telemetry(vectordb_path)
+        return _telemetries[key]
+
+def _engine_key(vectordb_path: str, model: str) -> tuple:
+    return os.path.abspath(vectordb_path), model
+
+def find_engine(vectordb_path: str = "vectordb", model: str = "gpt-3.5-turbo") -> Optional[VendorRAGEngine]:
+    """
+    初期化済みの共有エンジンを取得（ブロックしない。未初期化ならNone）
+    
+    非同期版で、初期化済みならスレッドに渡さずにそのまま使うために使う。
+    """
+    return _engines.get(_engine_key(vectordb_path, model))
+
+async def aget_engine(vectordb_path: str = "vectordb", model: str = "gpt-3.5-turbo") -> VendorRAGEngine:
+    """get_engine() の非同期版（初回の初期化だけはブロックするためスレッドで行う）"""
+    engine = find_engine(vectordb_path, model)
+    if engine is None:
+        engine = await asyncio.to_thread(get_engine, vectordb_path, model)
+    return engine
+
+def get_engine(vectordb_path: str = "vectordb", model: str = "gpt-3.5-turbo") -> VendorRAGEngine:
+    """
+    (vectordb_path, model) ごとにプロセス内で共有するエンジンを取得（初回のみ初期化）
+    
+    インデックスのバージョン切り替えは VendorRetriever が検知して自動で読み込み直すため、
+    通常は作り直す必要はない。ベクトルDBの場所自体が変わった場合などは invalidate_engines() を呼ぶ。
+    """
+    key = _engine_key(vectordb_path, model)
+    engine = _engines.get(key)
+    if engine is not None:
+        return engine
+    
+    api_key = load_environment()
+    # get_retriever がロックを取得するため、ここではロック外で構築する
+    engine = VendorRAGEngine(vectordb_path=vectordb_path, model=model, api_key=api_key)
+    with _engines_lock:
+        # 同時に構築された場合は先に登録された方を使う
+        return _engines.setdefault(key, engine)
+
+def invalidate_engines(vectordb_path: Optional[str] = None):
+    """
+    共有エンジンを破棄（次回の get_engine() で作り直す）
+    
+    Args:
+        vectordb_path: 対象のベクトルDB（Noneの場合はすべて破棄）
+    """
+    with _engines_lock:
+        if vectordb_path is None:
+            _engines.clear()
+            _retrievers.clear()
+            return
+        
+        path = os.path.abspath(vectordb_path)
+        for key in [key for key in _engines if key[0] == path]:
+            del _engines[key]
+        _retrievers.pop(path, None)
+
+def _index_version_token(retriever: VendorRetriever) -> str:
+    """
+    キャッシュの無効化に使うインデックスのバージョン
+    
+    バージョン管理のない旧形式では、インデックスのディレクトリの更新時刻をバージョンの代わりに使う。
+    """
+    index = retriever.index
+    return index.index_version or f"legacy-{os.path.getmtime(index.index_path)}"
+
+def _answer_cache_key(question: str, k: int, use_mmr: bool, model: str, search_type: Optional[str],
+                      filters: Optional[dict], fetch_k: Optional[int], lambda_mult: float, index_version: str,
+                      renderer: str = "llm") -> str:
+    """回答キャッシュのキーを作成（回答に影響する条件だけを含める。MMRのパラメータはMMRの場合のみ）"""
+    search_type = search_type or ("mmr" if use_mmr else "similarity")
+    params = {
+        "k": k,
+        "search_type": search_type,
+        "filters": {field: sorted(values) for field, values in normalize_filters(filters).items()},
+        "model": model,
+        "index_version": index_version,
+    }
+    if search_type == "mmr":
+        params["fetch_k"] = max(fetch_k or max(k * 4, 20), k)
+        params["lambda_mult"] = lambda_mult
+    # LLMで生成する場合は既存のキーを変えないため含めない
+    if renderer != "llm":
+        params["renderer"] = renderer
+    return make_answer_key(question, params)
+
+# 回答の作成方法（分割生成は "map_reduce"） → 直近の (回答生成の秒数, LLMの出力トークン数)。作成方法ごとの比較に使う
+_generation_samples: dict = {}
+_generation_lock = threading.Lock()
+GENERATION_SAMPLE_WINDOW = 1000
+
+def _record_generation(renderer: str, seconds: float, output_tokens: int):
+    with _generation_lock:
+        _generation_samples.setdefault(renderer, deque(maxlen=GENERATION_SAMPLE_WINDOW)).append((seconds, output_tokens))
+
+def get_generation_stats() -> dict:
+    """
+    回答の作成方法ごとの回答生成の統計（このプロセスで生成した直近の回答。キャッシュから返した回答は含まない）
+    
+    Returns:
+        作成方法 → {"count": 件数, "seconds_p50": 秒, "seconds_p95": 秒, "output_tokens_p50": LLMの出力トークン数}
+    """
+    with _generation_lock:
+        samples = {renderer: list(values) for renderer, values in _generation_samples.items()}
+    stats = {}
+    for renderer, values in samples.items():
+        seconds = np.array([value[0] for value in values])
+        tokens = np.array([value[1] for value in values])
+        stats[renderer] = {
+            "count": len(values),
+            "seconds_p50": float(np.percentile(seconds, 50)),
+            "seconds_p95": float(np.percentile(seconds, 95)),
+            "output_tokens_p50": float(np.percentile(tokens, 50))
+        }
+    return stats
+
+def _build_token_info(question: str, prompt_info: dict, response: str, documents: List[Document], model: str) -> dict:
+    """
+    質問・プロンプト・回答のトークン数情報を作成
+    
+    Args:
+        prompt_info: VendorResponseFormatter.build_prompt() のトークン数情報（実際に送ったプロンプトの値）
+    """
+    question_tokens = count_tokens(question, model)
+    response_tokens = count_tokens(response, model)
+    
+    return {
+        "question_tokens": question_tokens,
+        "context_tokens": prompt_info.get("context_tokens", 0),
+        "prompt_tokens": prompt_info.get("prompt_tokens", 0),
+        "response_tokens": response_tokens,
+        "total_tokens": prompt_info.get("prompt_tokens", 0) + response_tokens,
+        "context_budget": prompt_info.get("context_budget", 0),
+        "context_source": prompt_info.get("context_source", "built"),
+        "fields_truncated": prompt_info.get("fields_truncated", 0),
+        "fields_dropped": prompt_info.get("fields_dropped", 0),
+        "documents_retrieved": len(documents),
+        "model_used": model
+    }
+
+def _is_shareable(result: tuple) -> bool:
+    """他のプロセスに渡してよい結果か（回答生成に失敗した回答・検索結果がない場合などは各プロセスで実行する）"""
+    response, token_info = result
+    return bool(token_info) and GENERATION_ERROR_PREFIX not in response
+
+class _AnswerRequest:
+    """
+    1回の質問の処理状態（同期版・非同期版・ストリーミング版で共通の前後処理）
+    
+    キャッシュの照合・保存とトークン数の計算をまとめ、各版は検索と回答生成の呼び出し方だけを持つ。
+    """
+    
+    def __init__(self, engine: VendorRAGEngine, question: str, k: int, use_mmr: bool, model: str,
+                 vectordb_path: str, search_type: Optional[str], filters: Optional[dict],
+                 fetch_k: Optional[int], lambda_mult: float, use_cache: bool, renderer: str = "llm"):
+        if renderer not in RENDERERS:
+            raise ValueError(f"不明な回答の作成方法です: {renderer}（{' / '.join(RENDERERS)}）")
+        self.engine = engine
+        self.renderer = renderer
+        self.retriever = engine.retriever
+        self.question = question
+        self.model = model
+        self.filters = filters
+        self.search_kwargs = {
+            "query": question,
+            "k": k,
+            "use_mmr": use_mmr,
+            "search_type": search_type,
+            "filters": filters,
+            "fetch_k": fetch_k,
+            "lambda_mult": lambda_mult
+        }
+        # テンプレートでの作成は照合より速いため、回答キャッシュは使わない
+        use_cache = use_cache and renderer != "template"
+        self.answer_cache = get_answer_cache(vectordb_path) if use_cache else None
+        self.semantic_cache = get_semantic_cache(vectordb_path) if use_cache else None
+        # 同じ質問が同時に来た場合は1回だけ検索・回答生成する（テンプレートはまとめるまでもなく速い）
+        self.single_flight = get_single_flight(vectordb_path) if renderer != "template" else None
+        self.telemetry = get_telemetry(vectordb_path)
+        self.started = time.perf_counter()
+        # この呼び出しで実際に行った検索・回答生成の秒数と、APIが返したトークン数（キャッシュから返した場合は空のまま）
+        self.search_seconds = None
+        self.generation_seconds = None
+        self.usage = {}
+        self.estimated_usage = None
+        self.index_version = None
+        self.cache_key = None
+        self.vendor_ids = []
+        self.question_vector = None
+        # 類似質問キャッシュでは、回答の作成方法が違えば別の前提として扱う
+        self.cache_model = model if renderer == "llm" else f"{model}/{renderer}"
+    
+    def start(self) -> Optional[tuple[str, dict]]:
+        """
+        検索前の処理（データの有無の確認と回答キャッシュの照合）
+        
+        Returns:
+            検索せずに返す (回答, トークン数情報)。検索が必要な場合はNone
+        """
+        # ベクトルDB内のドキュメント数を確認（新しいバージョンが公開されていればここで読み込み直す）
+        if self.retriever.get_document_count() == 0:
+            return "エラー: ベクトルDBにデータがありません。Step1を先に実行してください。", {}
+        
+        if self.answer_cache is None and self.semantic_cache is None and self.single_flight is None:
+            return None
+        
+        # 同じ条件の回答がキャッシュにあれば、検索も回答生成も行わずに返す
+        # （キーは同じ質問の同時実行をまとめる場合にも使う）
+        self.index_version = _index_version_token(self.retriever)
+        kwargs = self.search_kwargs
+        self.cache_key = _answer_cache_key(
+            self.question, kwargs["k"], kwargs["use_mmr"], self.model, kwargs["search_type"],
+            self.filters, kwargs["fetch_k"], kwargs["lambda_mult"], self.index_version, self.renderer
+        )
+        if self.answer_cache is not None:
+            cached = self.answer_cache.get(self.cache_key, self.index_version)
+            if cached is not None:
+                response, token_info = cached
+                token_info["cache_hit"] = "exact"
+                return response, token_info
+        return None
+    
+    async def astart(self) -> Optional[tuple[str, dict]]:
+        """
+        start() の非同期版
         
-        # 合計トークン数
-        total_tokens = question_tokens + context_tokens + response_tokens
+        インデックスの読み込み直しと回答キャッシュ（SQLite）の照合はブロックするため、asyncio.to_thread で
+        イベントループの外で行う（以降の非同期版のキャッシュへの保存・テレメトリの記録も同じ）。
+        """
+        return await asyncio.to_thread(self.start)
+    
+    def search(self) -> List[Document]:
+        """ベンダー情報の検索（秒数を記録）"""
+        started = time.perf_counter()
+        documents = self.retriever.search(**self.search_kwargs)
+        self.search_seconds = time.perf_counter() - started
+        return documents
+    
+    async def asearch(self) -> List[Document]:
+        """search() の非同期版"""
+        started = time.perf_counter()
+        documents = await self.retriever.asearch(**self.search_kwargs)
+        self.search_seconds = time.perf_counter() - started
+        return documents
+    
+    def coalesce(self, compute) -> tuple[str, dict]:
+        """
+        同じ質問を実行中の呼び出しがあればその結果を待ち、なければ compute() で検索・回答生成する
         
-        # トークン数情報
+        Args:
+            compute: (回答, トークン数情報) を返す処理
+        """
+        if self.single_flight is None:
+            return compute()
+        return self.shared(*self.single_flight.run(self.cache_key, compute, _is_shareable))
+    
+    async def acoalesce(self, compute) -> tuple[str, dict]:
+        """coalesce() の非同期版（compute は (回答, トークン数情報) を返すコルーチン関数）"""
+        if self.single_flight is None:
+            return await compute()
+        return self.shared(*await self.single_flight.arun(self.cache_key, compute, _is_shareable))
+    
+    def shared(self, result: tuple, source: Optional[str]) -> tuple[str, dict]:
+        """
+        他の呼び出しの結果を受け取った場合は、トークン数情報の coalesced に共有元を記録
+        
+        Args:
+            source: "process"（同じプロセス）/ "file"（他のプロセス）/ None（自分で実行）
+        """
+        response, token_info = result
+        if source is None or not token_info:
+            return response, token_info
+        token_info = dict(token_info)
+        token_info["coalesced"] = source
+        return response, token_info
+    
+    def no_results(self) -> tuple[str, dict]:
+        """検索結果がない場合の回答"""
+        if self.filters:
+            return "絞り込み条件に一致するベンダーが見つかりませんでした。", {}
+        return "検索結果が見つかりませんでした。", {}
+    
+    def _uses_semantic_cache(self, documents: List[Document]) -> bool:
+        """
+        類似質問キャッシュを照合するか
+        
+        ベンダー名だけで特定できた質問（「ハブルの概要は？」など）は検索時に埋め込みを行っていないため、
+        照合のためだけに埋め込みAPIを呼ぶことはせず、類似質問キャッシュを使わない（同じ質問は回答キャッシュで返せる）。
+        """
+        if self.semantic_cache is None or not documents:
+            return False
+        named = set(self.retriever.named_vendor_ids(self.question))
+        return not named or any(doc.metadata.get("vendor_id") not in named for doc in documents)
+    
+    def embed_question(self, documents: List[Document]):
+        """
+        類似質問キャッシュの照合に使う質問の埋め込み（検索時に埋め込みキャッシュへ保存済みのため、通常はAPIを呼ばない）
+        
+        Returns:
+            質問の埋め込み（類似質問キャッシュを使わない場合はNone）
+        """
+        if not self._uses_semantic_cache(documents):
+            return None
+        return self.retriever.embeddings.embed_query(self.question)
+    
+    async def aembed_question(self, documents: List[Document]):
+        """embed_question() の非同期版"""
+        if not self._uses_semantic_cache(documents):
+            return None
+        return await self.retriever.embeddings.aembed_query(self.question)
+    
+    def check_semantic(self, documents: List[Document], question_vector) -> Optional[tuple[str, dict]]:
+        """
+        類似の質問で同じベンダーから回答済みなら、その回答を返す
+        
+        Args:
+            documents: 今回の検索結果
+            question_vector: 質問の埋め込み（類似質問キャッシュを使わない場合はNone）
+        """
+        self.vendor_ids = [doc.metadata.get("vendor_id") for doc in documents]
+        self.question_vector = question_vector
+        if question_vector is None:
+            return None
+        
+        cached = self.semantic_cache.get(
+            self.question, question_vector, self.vendor_ids, self.cache_model, self.index_version
+        )
+        if cached is None:
+            return None
+        response, token_info = cached
+        token_info["cache_hit"] = "semantic"
+        if self.answer_cache is not None:
+            self.answer_cache.put(self.cache_key, self.index_version, response, token_info)
+        return response, token_info
+    
+    def render_template(self, documents: List[Document]) -> Optional[tuple[str, dict]]:
+        """
+        テンプレートで回答を作成（renderer が template の場合のみ）
+        
+        Returns:
+            (回答, トークン数情報)。LLMで生成する場合はNone
+        """
+        if self.renderer != "template":
+            return None
+        started = time.perf_counter()
+        response = self.engine.formatter.render_template(self.question, documents)
         token_info = {
-            "question_tokens": question_tokens,
-            "context_tokens": context_tokens,
-            "response_tokens": response_tokens,
-            "total_tokens": total_tokens,
+            "question_tokens": 0,
+            "context_tokens": 0,
+            "prompt_tokens": 0,
+            "response_tokens": 0,
+            "total_tokens": 0,
             "documents_retrieved": len(documents),
-            "model_used": model
+            "model_used": "なし（テンプレート）",
+            "renderer": self.renderer,
+            "usage_source": "none",
+            "llm_calls": 0,
+            "generation_seconds": round(time.perf_counter() - started, 6)
         }
+        self.generation_seconds = token_info["generation_seconds"]
+        _record_generation(self.renderer, token_info["generation_seconds"], 0)
+        return response, token_info
+    
+    def _before_generation(self, documents: List[Document], question_vector) -> Optional[tuple[str, dict]]:
+        """LLMを呼ばずに返せる回答（検索結果なし・類似の質問の回答・テンプレート）。LLMで生成する場合はNone"""
+        if not documents:
+            return self.no_results()
+        cached = self.check_semantic(documents, question_vector)
+        if cached is not None:
+            return cached
+        return self.render_template(documents)
+    
+    def retrieve(self) -> tuple[List[Document], Optional[tuple[str, dict]]]:
+        """
+        検索から、LLMを呼ばずに返せる回答の確認まで（同期版・非同期版・ストリーミング版で共通の手順）
+        
+        Returns:
+            (検索結果, LLMを呼ばずに返す (回答, トークン数情報)。LLMで生成する場合はNone)
+        """
+        # 3. ベンダー情報の検索
+        documents = self.search()
+        return documents, self._before_generation(documents, self.embed_question(documents))
+    
+    async def aretrieve(self) -> tuple[List[Document], Optional[tuple[str, dict]]]:
+        """retrieve() の非同期版"""
+        documents = await self.asearch()
+        question_vector = await self.aembed_question(documents)
+        return documents, await asyncio.to_thread(self._before_generation, documents, question_vector)
+    
+    def streams_tokens(self, documents: List[Document]) -> bool:
+        """
+        回答をトークンごとに返せるか
+        
+        compact・分割生成は選定結果のJSONを転記するため、途中では表示できない（回答全体を1つの断片として返す）。
+        """
+        return self.renderer != "compact" and not self.engine.formatter.use_map_reduce(documents)
+    
+    def generate(self, documents: List[Document]) -> tuple[str, dict]:
+        """
+        LLMで回答を生成（renderer が compact なら選定結果だけを生成して転記）
         
+        検索件数・コンテキストが分割生成の閾値を超える場合は、作成方法によらず分割生成（map-reduce）で作成する。
+        """
+        started = time.perf_counter()
+        prompt_info = None
+        formatter = self.engine.formatter
+        if formatter.use_map_reduce(documents):
+            response, output_text, prompt_info = formatter.format_map_reduce(self.question, documents, usage=self.usage)
+        elif self.renderer == "compact":
+            response, output_text = formatter.format_compact(self.question, documents, usage=self.usage)
+        else:
+            response = output_text = formatter.format_response(self.question, documents, usage=self.usage)
+        return response, self.finish(documents, response, time.perf_counter() - started, output_text, prompt_info)
+    
+    async def agenerate(self, documents: List[Document]) -> tuple[str, dict]:
+        """generate() の非同期版"""
+        started = time.perf_counter()
+        prompt_info = None
+        formatter = self.engine.formatter
+        if formatter.use_map_reduce(documents):
+            response, output_text, prompt_info = await formatter.aformat_map_reduce(self.question, documents, usage=self.usage)
+        elif self.renderer == "compact":
+            response, output_text = await formatter.aformat_compact(self.question, documents, usage=self.usage)
+        else:
+            response = output_text = await formatter.aformat_response(self.question, documents, usage=self.usage)
+        token_info = await asyncio.to_thread(
+            self.finish, documents, response, time.perf_counter() - started, output_text, prompt_info
+        )
         return response, token_info
+    
+    def _apply_usage(self, token_info: dict):
+        """
+        APIが返したトークン数（usage）があれば、プロンプト・回答のトークン数をその値に置き換える
+        
+        tiktokenでの見積もりは prompt_tokens_estimated / response_tokens_estimated に残し、
+        usage_source に "api"（APIの値） / "estimate"（usage を返さないAPIでは見積もり）を記録する。
+        """
+        if not self.usage.get("calls"):
+            token_info["usage_source"] = "estimate"
+            self.estimated_usage = (token_info["prompt_tokens"], token_info["response_tokens"])
+            return
+        token_info["prompt_tokens_estimated"] = token_info["prompt_tokens"]
+        token_info["response_tokens_estimated"] = token_info["response_tokens"]
+        token_info["prompt_tokens"] = self.usage["input_tokens"]
+        token_info["response_tokens"] = self.usage["output_tokens"]
+        token_info["total_tokens"] = self.usage["input_tokens"] + self.usage["output_tokens"]
+        token_info["llm_calls"] = self.usage["calls"]
+        token_info["usage_source"] = "api"
+    
+    def record(self, response: str, token_info: dict):
+        """
+        テレメトリに1件を追記（段階ごとの秒数・この呼び出しで実際に使ったトークン数・料金）
+        
+        キャッシュや同時実行のまとめで返した場合はLLMを呼んでいないため、トークン数と料金は0として記録する。
+        テレメトリの保存に失敗しても回答は返す。
+        """
+        if self.telemetry is None:
+            return
+        if self.usage.get("calls"):
+            usage_source, calls = "api", self.usage["calls"]
+            input_tokens, output_tokens = self.usage["input_tokens"], self.usage["output_tokens"]
+        elif self.estimated_usage is not None:
+            usage_source, calls = "estimate", token_info.get("map_reduce", {}).get("map_calls", 0) + 1
+            input_tokens, output_tokens = self.estimated_usage
+        else:
+            usage_source, calls, input_tokens, output_tokens = "none", 0, 0, 0
+        failed = GENERATION_ERROR_PREFIX in response or response.startswith("エラー")
+        try:
+            self.telemetry.record(
+                model=self.model,
+                renderer="map_reduce" if "map_reduce" in token_info else self.renderer,
+                status="error" if failed else "ok",
+                cache_hit=token_info.get("cache_hit"),
+                coalesced=token_info.get("coalesced"),
+                usage_source=usage_source,
+                llm_calls=calls,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+                search_seconds=self.search_seconds,
+                generation_seconds=self.generation_seconds,
+                first_token_seconds=token_info.get("time_to_first_token"),
+                total_seconds=time.perf_counter() - self.started
+            )
+        except Exception as e:
+            print(f"テレメトリの保存に失敗しました: {e}")
+    
+    async def arecord(self, response: str, token_info: dict):
+        """record() の非同期版"""
+        if self.telemetry is not None:
+            await asyncio.to_thread(self.record, response, token_info)
+    
+    def finish(self, documents: List[Document], response: str, generation_seconds: float,
+               output_text: Optional[str] = None, prompt_info: Optional[dict] = None) -> dict:
+        """
+        回答生成後の処理（トークン数の計算とキャッシュへの保存）
+        
+        Args:
+            documents: 検索結果
+            response: 利用者に返す回答
+            generation_seconds: 回答生成にかかった秒数
+            output_text: LLMが実際に出力したテキスト（compact では選定結果のJSON。未指定時は response）
+            prompt_info: 送ったプロンプトのトークン数情報（未指定時は build_prompt() の値。分割生成では全呼び出しの合計）
+        """
+        # 6. トークン数の計算
+        if prompt_info is None:
+            _, prompt_info = self.engine.formatter.build_prompt(self.question, documents, self.renderer)
+        output_text = response if output_text is None else output_text
+        token_info = _build_token_info(self.question, prompt_info, output_text, documents, self.model)
+        token_info["renderer"] = self.renderer
+        token_info["generation_seconds"] = round(generation_seconds, 3)
+        self.generation_seconds = generation_seconds
+        self._apply_usage(token_info)
+        if "map_reduce" in prompt_info:
+            token_info["map_reduce"] = prompt_info["map_reduce"]
+        if self.renderer == "compact" or "map_reduce" in prompt_info:
+            # 回答全体をLLMで生成した場合に出力するはずだったトークン数との比較
+            rendered_tokens = count_tokens(response, self.model)
+            token_info["rendered_tokens"] = rendered_tokens
+            token_info["output_tokens_saved"] = max(rendered_tokens - token_info["response_tokens"], 0)
+        
+        # 回答生成に失敗した回答は保存しない
+        if GENERATION_ERROR_PREFIX not in response:
+            _record_generation("map_reduce" if "map_reduce" in prompt_info else self.renderer,
+                               generation_seconds, token_info["response_tokens"])
+            if self.answer_cache is not None:
+                self.answer_cache.put(self.cache_key, self.index_version, response, token_info)
+            if self.question_vector is not None:
+                self.semantic_cache.put(self.question, self.question_vector, self.vendor_ids, self.cache_model,
+                                        self.index_version, response, token_info, generation_seconds)
+        return token_info
+
+def query_vendor_info(question: str, k: int = 5, use_mmr: bool = True, model: str = "gpt-3.5-turbo", vectordb_path: str = "vectordb", search_type: Optional[str] = None, filters: Optional[dict] = None,
+                      fetch_k: Optional[int] = None, lambda_mult: float = DEFAULT_LAMBDA_MULT, use_cache: bool = True,
+                      renderer: str = "llm") -> tuple[str, dict]:
+    """
+    ベンダー情報を検索して回答を生成する関数
+    
+    Args:
+        question: 検索したい質問
+        k: 検索するベンダー数
+        use_mmr: MMR検索を使用するかどうか（search_type 未指定時のみ参照）
+        model: 使用するLLMモデル
+        vectordb_path: ベクトルDBのパス
+        search_type: 検索方法（"mmr" / "similarity" / "hybrid"）
+        filters: 絞り込み条件（項目名 → 値のリスト。同じ項目内はOR、項目間はAND）
+        fetch_k: MMRで多様性を考慮する候補数（未指定時は max(k * 4, 20)）
+        lambda_mult: MMRの関連性の重み
+        use_cache: 回答キャッシュを使うかどうか。同じ質問・条件なら検索も回答生成も行わず、
+            言い回しが違っても埋め込みが十分近く、検索されたベンダーが同じなら回答生成を行わない
+        renderer: 回答の作成方法（"llm": LLMで生成 / "compact": LLMはベンダーIDと選定理由だけを生成し、項目は転記 /
+            "template": LLMを使わず検索結果の項目を回答形式に転記）
+        
+    Returns:
+        整形されたMarkdown形式の回答と、トークン数情報
+        （キャッシュから返した場合は cache_hit に "exact" または "semantic"）
+    """
+    request = None
+    try:
+        # 1-2. 共有エンジンの取得（初回のみ環境変数・ベクトルDB・LLMを初期化）
+        engine = get_engine(vectordb_path=vectordb_path, model=model)
+        request = _AnswerRequest(engine, question, k, use_mmr, model, vectordb_path,
+                                 search_type, filters, fetch_k, lambda_mult, use_cache, renderer)
+        result = request.start()
+        if result is None:
+            # 同じ質問を同時に処理している場合は、その結果を待って返す
+            result = request.coalesce(lambda: _answer(request))
         
     except Exception as e:
-        return f"エラーが発生しました: {e}", {}
+        result = _error_result(e)
+    
+    if request is not None:
+        request.record(*result)
+    return result
+
+def _error_result(error: Exception) -> tuple[str, dict]:
+    return f"エラーが発生しました: {error}", {}
+
+def _answer(request: _AnswerRequest) -> tuple[str, dict]:
+    """query_vendor_info() の検索から回答生成まで（回答キャッシュの照合後の処理）"""
+    documents, early = request.retrieve()
+    if early is not None:
+        return early
+    # 4-5. 回答の生成（LLMはエンジンで初期化済み）
+    return request.generate(documents)
+
+async def aquery_vendor_info(question: str, k: int = 5, use_mmr: bool = True, model: str = "gpt-3.5-turbo", vectordb_path: str = "vectordb", search_type: Optional[str] = None, filters: Optional[dict] = None,
+                             fetch_k: Optional[int] = None, lambda_mult: float = DEFAULT_LAMBDA_MULT, use_cache: bool = True,
+                             renderer: str = "llm") -> tuple[str, dict]:
+    """
+    query_vendor_info() の非同期版（引数・戻り値は query_vendor_info() と同じ）
+    
+    質問の埋め込みとLLMの呼び出しを非同期クライアントで待つため、1つのイベントループで
+    多数の質問を同時に処理できる（リクエストごとにスレッドを占有しない）。
+    """
+    request = None
+    try:
+        # 1-2. 共有エンジンの取得（初回の初期化だけはブロックするためスレッドで行う）
+        engine = await aget_engine(vectordb_path, model)
+        request = _AnswerRequest(engine, question, k, use_mmr, model, vectordb_path,
+                                 search_type, filters, fetch_k, lambda_mult, use_cache, renderer)
+        result = await request.astart()
+        if result is None:
+            result = await request.acoalesce(lambda: _aanswer(request))
+        
+    except Exception as e:
+        result = _error_result(e)
+    
+    if request is not None:
+        await request.arecord(*result)
+    return result
+
+async def _aanswer(request: _AnswerRequest) -> tuple[str, dict]:
+    """_answer() の非同期版"""
+    documents, early = await request.aretrieve()
+    if early is not None:
+        return early
+    return await request.agenerate(documents)
+
+class VendorAnswerStream:
+    """
+    回答を生成されたトークンから順に返すストリーム（stream_vendor_info() / astream_vendor_info() から生成）
+    
+    for（非同期版は async for）で回答の断片を受け取り、最後まで読み終えると response（後処理済みの回答全体）と
+    token_info（トークン数情報。time_to_first_token に最初の断片までの秒数）が設定される。
+    キャッシュから返す場合・compact / template で作成する場合・エラーの場合は、回答全体を1つの断片として返す。
+    """
+    
+    def __init__(self, question: str, vectordb_path: str, model: str, use_cache: bool, renderer: str = "llm",
+                 **search_options):
+        self.question = question
+        self.vectordb_path = vectordb_path
+        self.model = model
+        self.use_cache = use_cache
+        self.renderer = renderer
+        self.search_options = search_options
+        self.response = ""
+        self.token_info = {}
+        self.time_to_first_token = None
+        self._started = None
+        self._request = None
+    
+    def _open(self, engine: VendorRAGEngine) -> _AnswerRequest:
+        """リクエストを作成（回答キャッシュの照合は呼び出し元で start() / astart() を呼ぶ）"""
+        options = self.search_options
+        self._request = _AnswerRequest(engine, self.question, options["k"], options["use_mmr"], self.model,
+                                       self.vectordb_path, options["search_type"], options["filters"],
+                                       options["fetch_k"], options["lambda_mult"], self.use_cache, self.renderer)
+        return self._request
+    
+    def _first_chunk(self):
+        """最初の断片を受け取った時刻を記録"""
+        if self.time_to_first_token is None:
+            self.time_to_first_token = time.perf_counter() - self._started
+    
+    def _relay(self, chunk: str, chunks: List[str]) -> str:
+        """受け取った断片を記録して返す"""
+        self._first_chunk()
+        chunks.append(chunk)
+        return chunk
+    
+    def _complete(self, response: str, token_info: dict) -> str:
+        """回答全体とトークン数情報を設定し、回答全体を返す（1つの断片として返す場合に使う）"""
+        self._first_chunk()
+        self.response = response
+        self.token_info = dict(token_info)
+        if self.token_info:
+            self.token_info["time_to_first_token"] = round(self.time_to_first_token, 3)
+        return self.response
+    
+    def _finish(self, documents: List[Document], chunks: List[str], generation_started: float):
+        """トークンごとに返し終えた回答の後処理（整形・トークン数の計算・キャッシュへの保存）"""
+        formatter = self._request.engine.formatter
+        response = formatter._post_process_response("".join(chunks))
+        self._complete(response, self._request.finish(documents, response, time.perf_counter() - generation_started))
+    
+    def _record(self):
+        """最後まで読み終えた場合のみテレメトリに記録する"""
+        if self._request is not None:
+            self._request.record(self.response, self.token_info)
+    
+    async def _arecord(self):
+        """_record() の非同期版"""
+        if self._request is not None:
+            await self._request.arecord(self.response, self.token_info)
+    
+    def _after_follow(self, flight, chunks: List[str]) -> List[str]:
+        """
+        同じ質問の処理を待ち終えた後の処理
+        
+        結果を受け取れた場合は回答全体を設定し、まだ何も返していなければ回答全体を1つの断片として返す。
+        途中まで返した後に処理が中断された場合は、エラーメッセージを最後の断片として返す。
+        
+        Returns:
+            続けて返す断片のリスト
+        """
+        if self._request.single_flight.record_follow(flight.result):
+            self._complete(*self._request.shared(flight.result, "process"))
+            return [] if chunks else [self.response]
+        if not chunks:
+            return []
+        message = f"\n\n{GENERATION_ERROR_PREFIX}: 同時に処理していた同じ質問の回答生成が中断されました"
+        formatter = self._request.engine.formatter
+        self._complete(formatter._post_process_response("".join(chunks) + message), {})
+        return [message]
+    
+    def _release(self, flight, handle, result: Optional[tuple], source: Optional[str]):
+        """実行役の後処理（プロセス間のロックの解放と、待っている呼び出し元への結果の通知）"""
+        request = self._request
+        shareable = result is not None and source is None and _is_shareable(result)
+        request.single_flight.unlock(handle, request.cache_key, result if shareable else None)
+        flight.complete(result)
+        request.single_flight.leave(request.cache_key, flight)
+    
+    def __iter__(self) -> Iterator[str]:
+        self._started = time.perf_counter()
+        try:
+            early = self._open(get_engine(vectordb_path=self.vectordb_path, model=self.model)).start()
+        except Exception as e:
+            early = _error_result(e)
+        
+        if early is not None:
+            yield self._complete(*early)
+        else:
+            yield from self._coalesce()
+        self._record()
+    
+    def _coalesce(self) -> Iterator[str]:
+        """同じ質問を同時に処理している場合は、生成中の断片をそのまま受け取る"""
+        single_flight = self._request.single_flight
+        if single_flight is None:
+            yield from self._generate()
+            return
+        
+        key = self._request.cache_key
+        flight, leader = single_flight.join(key)
+        if not leader:
+            chunks = []
+            for chunk in flight.follow(single_flight.timeout):
+                yield self._relay(chunk, chunks)
+            yield from self._after_follow(flight, chunks)
+            if not chunks and not flight.result:
+                yield from self._generate()
+            return
+        
+        handle, result, source = None, None, None
+        try:
+            handle, result = single_flight.lock(key)
+            if result is not None:
+                source = "file"
+                yield self._complete(*self._request.shared(result, source))
+                return
+            for chunk in self._generate():
+                flight.publish(chunk)
+                yield chunk
+            result = self.response, self.token_info
+        finally:
+            self._release(flight, handle, result, source)
+    
+    def _generate(self) -> Iterator[str]:
+        """検索から回答生成まで（回答キャッシュの照合後の処理）"""
+        request = self._request
+        try:
+            documents, early = request.retrieve()
+            if early is None and not request.streams_tokens(documents):
+                early = request.generate(documents)
+        except Exception as e:
+            early = _error_result(e)
+        
+        if early is not None:
+            yield self._complete(*early)
+            return
+        
+        # 4-5. 回答の生成（トークンを受け取るたびに返す）
+        chunks = []
+        generation_started = time.perf_counter()
+        for chunk in request.engine.formatter.stream_response(self.question, documents, usage=request.usage):
+            yield self._relay(chunk, chunks)
+        self._finish(documents, chunks, generation_started)
+    
+    async def __aiter__(self) -> AsyncIterator[str]:
+        self._started = time.perf_counter()
+        try:
+            early = await self._open(await aget_engine(self.vectordb_path, self.model)).astart()
+        except Exception as e:
+            early = _error_result(e)
+        
+        if early is not None:
+            yield self._complete(*early)
+        else:
+            async for chunk in self._acoalesce():
+                yield chunk
+        await self._arecord()
+    
+    async def _acoalesce(self) -> AsyncIterator[str]:
+        """_coalesce() の非同期版"""
+        single_flight = self._request.single_flight
+        if single_flight is None:
+            async for chunk in self._agenerate():
+                yield chunk
+            return
+        
+        key = self._request.cache_key
+        flight, leader = single_flight.join(key)
+        if not leader:
+            chunks = []
+            async for chunk in flight.afollow(single_flight.timeout):
+                yield self._relay(chunk, chunks)
+            for chunk in self._after_follow(flight, chunks):
+                yield chunk
+            if not chunks and not flight.result:
+                async for chunk in self._agenerate():
+                    yield chunk
+            return
+        
+        handle, result, source = None, None, None
+        try:
+            handle, result = await single_flight.alock(key)
+            if result is not None:
+                source = "file"
+                yield self._complete(*self._request.shared(result, source))
+                return
+            async for chunk in self._agenerate():
+                flight.publish(chunk)
+                yield chunk
+            result = self.response, self.token_info
+        finally:
+            self._release(flight, handle, result, source)
+    
+    async def _agenerate(self) -> AsyncIterator[str]:
+        """_generate() の非同期版"""
+        request = self._request
+        try:
+            documents, early = await request.aretrieve()
+            if early is None and not request.streams_tokens(documents):
+                early = await request.agenerate(documents)
+        except Exception as e:
+            early = _error_result(e)
+        
+        if early is not None:
+            yield self._complete(*early)
+            return
+        
+        chunks = []
+        generation_started = time.perf_counter()
+        async for chunk in request.engine.formatter.astream_response(self.question, documents, usage=request.usage):
+            yield self._relay(chunk, chunks)
+        await asyncio.to_thread(self._finish, documents, chunks, generation_started)
+
+def stream_vendor_info(question: str, k: int = 5, use_mmr: bool = True, model: str = "gpt-3.5-turbo", vectordb_path: str = "vectordb", search_type: Optional[str] = None, filters: Optional[dict] = None,
+                       fetch_k: Optional[int] = None, lambda_mult: float = DEFAULT_LAMBDA_MULT, use_cache: bool = True,
+                       renderer: str = "llm") -> VendorAnswerStream:
+    """
+    query_vendor_info() のストリーミング版（引数は query_vendor_info() と同じ）
+    
+    Returns:
+        for で回答の断片を受け取る VendorAnswerStream（読み終えると response と token_info が設定される）
+    """
+    return VendorAnswerStream(
+        question, vectordb_path, model, use_cache, renderer,
+        k=k, use_mmr=use_mmr, search_type=search_type, filters=filters, fetch_k=fetch_k, lambda_mult=lambda_mult
+    )
+
+def astream_vendor_info(question: str, k: int = 5, use_mmr: bool = True, model: str = "gpt-3.5-turbo", vectordb_path: str = "vectordb", search_type: Optional[str] = None, filters: Optional[dict] = None,
+                        fetch_k: Optional[int] = None, lambda_mult: float = DEFAULT_LAMBDA_MULT, use_cache: bool = True,
+                        renderer: str = "llm") -> VendorAnswerStream:
+    """stream_vendor_info() の非同期版（async for で回答の断片を受け取る）"""
+    return stream_vendor_info(
+        question, k=k, use_mmr=use_mmr, model=model, vectordb_path=vectordb_path, search_type=search_type,
+        filters=filters, fetch_k=fetch_k, lambda_mult=lambda_mult, use_cache=use_cache, renderer=renderer
+    )
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+意味的な回答キャッシュ
+回答済みの質問の埋め込みを回答・使用したベンダーIDと一緒に保持し、言い回しの違う質問でも
+コサイン類似度が閾値以上で、検索されたベンダーの組み合わせが同じなら保存済みの回答を返す
+（LLMを呼ばない）。照合は正規化済みベクトルの行列との1回の行列積で行う
+"""
+
+import os
+import time
+import hashlib
+import threading
+from collections import deque
+from typing import List, Optional
+
+import numpy as np
+
+DEFAULT_THRESHOLD = 0.95
+DEFAULT_MAX_ENTRIES = 5000
+
+def make_context_key(vendor_ids: List[str], model: str) -> str:
+    """回答の前提（検索されたベンダーの組み合わせとモデル）のキー。ベンダーの順序は問わない"""
+    payload = "\0".join([model] + sorted(vendor_ids))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class SemanticAnswerCache:
+    """埋め込みの類似度で引く回答キャッシュ（プロセス内・件数上限付きLRU）"""
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 latency_window: int = 1000):
+        """
+        初期化
+
+        Args:
+            threshold: 同じ質問とみなすコサイン類似度の下限
+            max_entries: 保持する最大件数（超えた分は最終アクセスの古い順に削除）
+            latency_window: 短縮できた時間の分位点を計算する直近のヒット数
+        """
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._saved_seconds = deque(maxlen=latency_window)
+        self._lock = threading.Lock()
+        self._version = None
+        self._clear()
+
+    def _clear(self):
+        # 行ごとに: 正規化済みベクトル / 前提のキーの番号 / 最終アクセス / (質問, 回答, トークン数情報, 生成にかかった秒数)
+        self._vectors = None
+        self._context_codes = np.zeros(0, dtype=np.int64)
+        self._last_access = np.zeros(0, dtype=np.float64)
+        self._entries = []
+        self._codes = {}
+        self._size = 0
+
+    def _invalidate_other_versions(self, version: str):
+        """インデックスのバージョンが切り替わったら全件破棄（ロック取得済みで呼ぶ）"""
+        if version == self._version:
+            return
+        self.invalidations += self._size
+        self._clear()
+        self._version = version
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _allocate_row(self, dimension: int) -> int:
+        """保存先の行を確保（満杯なら最終アクセスの最も古い行を再利用。ロック取得済みで呼ぶ）"""
+        if self._vectors is None or self._vectors.shape[1] != dimension:
+            self._clear()
+            self._vectors = np.zeros((min(self.max_entries, 64), dimension), dtype=np.float32)
+        if self._size >= self.max_entries:
+            self.evictions += 1
+            return int(np.argmin(self._last_access[:self._size]))
+        if self._size == len(self._vectors):
+            # 容量を倍に広げる（行の追加ごとに行列全体を複製しない）
+            capacity = min(self.max_entries, len(self._vectors) * 2)
+            self._vectors = np.resize(self._vectors, (capacity, dimension))
+        if self._size == len(self._context_codes):
+            capacity = len(self._vectors)
+            self._context_codes = np.resize(self._context_codes, capacity)
+            self._last_access = np.resize(self._last_access, capacity)
+        self._entries.append(None)
+        self._size += 1
+        return self._size - 1
+
+    def get(self, question: str, vector, vendor_ids: List[str], model: str,
+            version: str) -> Optional[tuple[str, dict]]:
+        """
+        類似した質問の回答を取得
+
+        Args:
+            question: ユーザーの質問（回答中の【質問】を差し替えるために使う）
+            vector: 質問の埋め込み
+            vendor_ids: 今回検索されたベンダーID
+            model: 使用するLLMモデル
+            version: 公開中のインデックスのバージョン
+
+        Returns:
+            (回答, トークン数情報)。該当がなければNone
+        """
+        started = time.perf_counter()
+        context = make_context_key(vendor_ids, model)
+        with self._lock:
+            self._invalidate_other_versions(version)
+            code = self._codes.get(context)
+            best = None
+            if code is not None and self._size:
+                # 全件との類似度を1回の行列積で計算し、前提が同じ行だけから最大を選ぶ
+                scores = self._vectors[:self._size] @ self._normalize(vector)
+                scores[self._context_codes[:self._size] != code] = -np.inf
+                row = int(np.argmax(scores))
+                if scores[row] >= self.threshold:
+                    best = (row, float(scores[row]))
+            if best is None:
+                self.misses += 1
+                return None
+
+            row, score = best
+            self._last_access[row] = time.time()
+            cached_question, response, token_info, generation_seconds = self._entries[row]
+            self.hits += 1
+            self._saved_seconds.append(max(generation_seconds - (time.perf_counter() - started), 0.0))
+
+        # 回答の先頭にある元の質問を今回の質問に差し替える
+        head = response[:len(cached_question) + 200]
+        if cached_question and cached_question in head:
+            response = response.replace(cached_question, question, 1)
+        token_info = dict(token_info)
+        token_info["semantic_similarity"] = round(score, 4)
+        return response, token_info
+
+    def put(self, question: str, vector, vendor_ids: List[str], model: str, version: str,
+            response: str, token_info: dict, generation_seconds: float):
+        """
+        回答を保存
+
+        Args:
+            generation_seconds: 回答生成にかかった秒数（ヒット時に短縮できた時間の計算に使う）
+        """
+        context = make_context_key(vendor_ids, model)
+        row_vector = self._normalize(vector)
+        with self._lock:
+            self._invalidate_other_versions(version)
+            row = self._allocate_row(len(row_vector))
+            self._vectors[row] = row_vector
+            self._context_codes[row] = self._codes.setdefault(context, len(self._codes))
+            self._last_access[row] = time.time()
+            self._entries[row] = (question, response, dict(token_info), generation_seconds)
+
+    def stats(self) -> dict:
+        """ヒット率と、ヒットで短縮できた時間（p50 / p99、秒）などの統計を取得"""
+        with self._lock:
+            saved = list(self._saved_seconds)
+            entries = self._size
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_p50": float(np.percentile(saved, 50)) if saved else 0.0,
+            "saved_p99": float(np.percentile(saved, 99)) if saved else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "entries": entries
+        }
+
+def open_semantic_cache() -> Optional[SemanticAnswerCache]:
+    """
+    環境変数の設定に従って意味的な回答キャッシュを作成
+
+    - VENDOR_RAG_SEMANTIC_CACHE: on（デフォルト） / off
+    - VENDOR_RAG_SEMANTIC_CACHE_THRESHOLD: コサイン類似度の閾値（デフォルト: 0.95）
+    - VENDOR_RAG_SEMANTIC_CACHE_SIZE: 最大件数（デフォルト: 5000）
+
+    Returns:
+        意味的な回答キャッシュ（off の場合はNone）
+    """
+    if os.getenv("VENDOR_RAG_SEMANTIC_CACHE", "on").strip().lower() == "off":
+        return None
+    return SemanticAnswerCache(
+        threshold=float(os.getenv("VENDOR_RAG_SEMANTIC_CACHE_THRESHOLD", DEFAULT_THRESHOLD)),
+        max_entries=int(os.getenv("VENDOR_RAG_SEMANTIC_CACHE_SIZE", DEFAULT_MAX_ENTRIES))
+    )
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+同じ質問の同時実行のまとめ（single-flight）
+同じキー（回答キャッシュと同じ条件）の処理が実行中なら、後から来た呼び出しは新たに検索・回答生成をせず、
+実行中の処理の結果（ストリーミングでは生成中の断片）を受け取る。
+プロセス内はキーごとの実行中の処理を共有し、複数のワーカープロセス間はキーごとのファイルロックで
+1プロセスだけが実行し、待っていたプロセスは結果のファイルを読む（別の質問同士が待ち合うことはない）
+"""
+
+import os
+import json
+import time
+import asyncio
+import threading
+from typing import Callable, Iterator, AsyncIterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows ではファイルロックを使わず、プロセス内だけでまとめる
+    fcntl = None
+
+# 実行方式（file: プロセス内＋ファイルロックでプロセス間 / process: プロセス内のみ / off: 無効）
+SINGLE_FLIGHT_MODES = ("file", "process", "off")
+
+# 実行中の処理を待つ秒数（この間に断片も結果も届かなければ、待つのをやめて自分で実行する）
+DEFAULT_TIMEOUT = 120.0
+
+# ファイルロックの確認間隔（秒）
+LOCK_POLL_INTERVAL = 0.05
+
+# 結果・ロックのファイルを残す秒数（これより古いファイルは保存時にまとめて削除する）
+RESULT_TTL = 60.0
+
+class Flight:
+    """
+    実行中の1件の処理
+
+    実行する呼び出し元（leader）が断片と結果を書き込み、同じキーで待っている呼び出し元が読む。
+    同期版はスレッドの Condition、非同期版はイベントループごとの asyncio.Event で通知を受ける。
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.result = None
+        self.done = False
+        self._condition = threading.Condition()
+        self._async_waiters = []
+
+    def _notify(self):
+        """待っている呼び出し元に通知（ロック取得済みで呼ぶ）"""
+        self._condition.notify_all()
+        for loop, event in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # 待っていたイベントループが既に閉じている
+
+    def publish(self, chunk: str):
+        """生成された断片を追加"""
+        with self._condition:
+            self.chunks.append(chunk)
+            self._notify()
+
+    def complete(self, result):
+        """
+        結果を設定して完了（2回目以降は無視）
+
+        Args:
+            result: 処理の結果。失敗・中断した場合はNone（待っていた呼び出し元は自分で実行する）
+        """
+        with self._condition:
+            if self.done:
+                return
+            self.result = result
+            self.done = True
+            self._notify()
+
+    def follow(self, timeout: float) -> Iterator[str]:
+        """
+        断片を届いた順に返し、完了したら終わる（timeout 秒の間なにも届かなければ打ち切る）
+
+        終了後、完了していれば result に結果が入っている。
+        """
+        index = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self.done or len(self.chunks) > index, timeout)
+                new = self.chunks[index:]
+                index += len(new)
+                done = self.done
+            yield from new
+            if done or not new:
+                return
+
+    async def afollow(self, timeout: float) -> AsyncIterator[str]:
+        """follow() の非同期版（待つ間もイベントループを止めない）"""
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        with self._condition:
+            self._async_waiters.append((loop, event))
+        try:
+            index = 0
+            while True:
+                with self._condition:
+                    new = self.chunks[index:]
+                    index += len(new)
+                    done = self.done
+                    if not new and not done:
+                        event.clear()
+                for chunk in new:
+                    yield chunk
+                if done:
+                    return
+                if not new:
+                    try:
+                        await asyncio.wait_for(event.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        return
+        finally:
+            with self._condition:
+                self._async_waiters.remove((loop, event))
+
+    def wait(self, timeout: float):
+        """完了を待って結果を返す（打ち切った場合・失敗した場合はNone）"""
+        for _ in self.follow(timeout):
+            pass
+        return self.result
+
+    async def await_result(self, timeout: float):
+        """wait() の非同期版"""
+        async for _ in self.afollow(timeout):
+            pass
+        return self.result
+
+class SingleFlight:
+    """キーごとに実行中の処理を1つにまとめるクラス"""
+
+    def __init__(self, lock_dir: Optional[str] = None, timeout: float = DEFAULT_TIMEOUT):
+        """
+        初期化
+
+        Args:
+            lock_dir: プロセス間でまとめるためのロック・結果のファイルの保存先（Noneならプロセス内のみ）
+            timeout: 実行中の処理を待つ秒数
+        """
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self.timeout = timeout
+        self.leaders = 0
+        self.coalesced = 0
+        self.shared_across_processes = 0
+        self.abandoned = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._stores = 0
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+
+    def join(self, key: str) -> tuple[Flight, bool]:
+        """
+        キーの実行中の処理に加わる
+
+        Returns:
+            (処理, 自分が実行するか)。実行中の処理がなければ新しく作って実行役になる
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = Flight()
+            self.leaders += 1
+            return flight, True
+
+    def leave(self, key: str, flight: Flight):
+        """実行役の処理の終了（以降の呼び出しは新しく実行する）"""
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def record_follow(self, result) -> bool:
+        """待っていた呼び出し元の結果を集計し、共有できたかを返す"""
+        with self._lock:
+            if result is None:
+                self.abandoned += 1
+                return False
+            self.coalesced += 1
+            return True
+
+    def _paths(self, key: str) -> tuple[str, str]:
+        return (os.path.join(self.lock_dir, f"{key}.lock"),
+                os.path.join(self.lock_dir, f"{key}.json"))
+
+    def _try_lock(self, path: str):
+        """
+        ロックファイルのロックを1回試す
+
+        Returns:
+            取得できればファイルのハンドル、他のプロセスが保持していればNone
+        """
+        while True:
+            handle = open(path, "a")
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                handle.close()
+                return None
+            # 取得するまでの間に解放したプロセスがファイルを削除していれば、作り直したファイルでやり直す
+            try:
+                if os.fstat(handle.fileno()).st_ino == os.stat(path).st_ino:
+                    return handle
+            except FileNotFoundError:
+                pass
+            handle.close()
+
+    def _read_result(self, key: str, since: float):
+        """待ち始めてから他のプロセスが保存した結果を読む（なければNone）"""
+        try:
+            with open(self._paths(key)[1], "r", encoding="utf-8") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if stored.get("completed_at", 0) < since:
+            return None
+        with self._lock:
+            self.shared_across_processes += 1
+        return tuple(stored["result"])
+
+    def lock(self, key: str) -> tuple[Optional[object], Optional[tuple]]:
+        """
+        プロセス間のロックを取得（他のプロセスが実行中なら、終わるまで timeout 秒を上限に待つ）
+
+        Returns:
+            (ロックのハンドル, 待っている間に他のプロセスが保存した結果)。
+            結果があればロックは解放済み。プロセス内のみの場合・待ちきれなかった場合はロックなしで (None, None)
+        """
+        if self.lock_dir is None:
+            return None, None
+        path = self._paths(key)[0]
+        handle = self._try_lock(path)
+        if handle is not None:
+            return handle, None
+
+        since = time.time()
+        while time.time() - since < self.timeout:
+            time.sleep(LOCK_POLL_INTERVAL)
+            handle = self._try_lock(path)
+            if handle is not None:
+                return self._after_wait(handle, key, since)
+        return None, None
+
+    async def alock(self, key: str) -> tuple[Optional[object], Optional[tuple]]:
+        """lock() の非同期版（待つ間もイベントループを止めない）"""
+        if self.lock_dir is None:
+            return None, None
+        path = self._paths(key)[0]
+        handle = self._try_lock(path)
+        if handle is not None:
+            return handle, None
+
+        since = time.time()
+        while time.time() - since < self.timeout:
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+            handle = self._try_lock(path)
+            if handle is not None:
+                return self._after_wait(handle, key, since)
+        return None, None
+
+    def _after_wait(self, handle, key: str, since: float) -> tuple[Optional[object], Optional[tuple]]:
+        result = self._read_result(key, since)
+        if result is None:
+            # 実行していたプロセスが失敗した場合は、自分で実行する
+            return handle, None
+        self.unlock(handle, key)
+        return None, result
+
+    def unlock(self, handle, key: str, result: Optional[tuple] = None):
+        """
+        プロセス間のロックを解放
+
+        Args:
+            result: 待っている他のプロセスに渡す結果（JSONにできる値のタプル。Noneなら渡さない）
+        """
+        if handle is None:
+            return
+        try:
+            if result is not None:
+                self._store_result(key, result)
+        finally:
+            self._release(handle, self._paths(key)[0])
+
+    def _release(self, handle, path: str):
+        """ロックを保持したままファイルを削除してから解放（待っているプロセスは作り直したファイルでロックを取得する）"""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        fcntl.flock(handle, fcntl.LOCK_UN)
+        handle.close()
+
+    def _store_result(self, key: str, result: tuple):
+        path = self._paths(key)[1]
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"completed_at": time.time(), "result": list(result)}, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+        # 古い結果のファイルと、異常終了したプロセスが残したロックのファイルをまとめて削除（保存64回ごと）
+        self._stores += 1
+        if self._stores % 64 == 0:
+            now = time.time()
+            for entry in os.scandir(self.lock_dir):
+                try:
+                    if now - entry.stat().st_mtime <= RESULT_TTL:
+                        continue
+                    if entry.name.endswith(".json"):
+                        os.remove(entry.path)
+                    elif entry.name.endswith(".lock"):
+                        # 実行中のプロセスが保持しているロックは削除しない
+                        stale = self._try_lock(entry.path)
+                        if stale is not None:
+                            self._release(stale, entry.path)
+                except OSError:
+                    pass
+
+    def run(self, key: str, compute: Callable[[], tuple],
+            shareable: Optional[Callable[[tuple], bool]] = None) -> tuple[tuple, Optional[str]]:
+        """
+        同じキーの実行中の処理があればその結果を待ち、なければ compute() を実行する
+
+        Args:
+            key: 処理のキー
+            compute: 結果のタプルを返す処理
+            shareable: 結果を他のプロセスに渡してよいか（エラーの結果などを除く。未指定ならすべて渡す）
+
+        Returns:
+            (結果, 共有元)。共有元は "process"（プロセス内）/ "file"（他のプロセス）/ None（自分で実行）
+        """
+        flight, leader = self.join(key)
+        if not leader:
+            result = flight.wait(self.timeout)
+            if self.record_follow(result):
+                return result, "process"
+            return compute(), None
+
+        handle, result, source = None, None, None
+        try:
+            handle, result = self.lock(key)
+            if result is not None:
+                source = "file"
+                return result, source
+            result = compute()
+            return result, source
+        finally:
+            self.unlock(handle, key, result if result is not None and (shareable is None or shareable(result)) else None)
+            flight.complete(result)
+            self.leave(key, flight)
+
+    async def arun(self, key: str, compute: Callable, shareable: Optional[Callable[[tuple], bool]] = None) -> tuple[tuple, Optional[str]]:
+        """run() の非同期版（compute は結果のタプルを返すコルーチン関数）"""
+        flight, leader = self.join(key)
+        if not leader:
+            result = await flight.await_result(self.timeout)
+            if self.record_follow(result):
+                return result, "process"
+            return await compute(), None
+
+        handle, result, source = None, None, None
+        try:
+            handle, result = await self.alock(key)
+            if result is not None:
+                source = "file"
+                return result, source
+            result = await compute()
+            return result, source
+        finally:
+            self.unlock(handle, key, result if result is not None and (shareable is None or shareable(result)) else None)
+            flight.complete(result)
+            self.leave(key, flight)
+
+    def stats(self) -> dict:
+        """実行した件数（leaders）・プロセス内で結果を共有した件数（coalesced）・他のプロセスの結果を使った件数などの統計"""
+        with self._lock:
+            return {
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "shared_across_processes": self.shared_across_processes,
+                "abandoned": self.abandoned,
+                "in_flight": len(self._flights),
+            }
+
+def open_single_flight(vectordb_path: str) -> Optional[SingleFlight]:
+    """
+    環境変数の設定に従って同時実行のまとめを作成
+
+    - VENDOR_RAG_SINGLE_FLIGHT: file（デフォルト） / process / off
+    - VENDOR_RAG_SINGLE_FLIGHT_DIR: file のロック・結果のファイルの保存先（デフォルトはベクトルDBの隣）
+    - VENDOR_RAG_SINGLE_FLIGHT_TIMEOUT: 実行中の処理を待つ秒数（デフォルト: 120）
+
+    Returns:
+        同時実行のまとめ（off の場合はNone）
+    """
+    mode = os.getenv("VENDOR_RAG_SINGLE_FLIGHT", "file").strip().lower()
+    if mode not in SINGLE_FLIGHT_MODES:
+        raise ValueError(f"不明な同時実行のまとめ方です: {mode}（{' / '.join(SINGLE_FLIGHT_MODES)}）")
+    if mode == "off":
+        return None
+
+    lock_dir = None
+    if mode == "file":
+        lock_dir = os.getenv("VENDOR_RAG_SINGLE_FLIGHT_DIR") or f"{vectordb_path.rstrip(os.sep)}.singleflight"
+    return SingleFlight(lock_dir, timeout=float(os.getenv("VENDOR_RAG_SINGLE_FLIGHT_TIMEOUT", DEFAULT_TIMEOUT)))
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+リクエストのテレメトリ
+質問1件ごとに、段階ごとの所要時間（検索・回答生成・全体）・APIが返したトークン数・モデル・料金を
+ローカルのSQLiteまたはJSON Linesに追記し、統計情報（所要時間のp50/p95・日ごとのトークン数・モデルごとの料金）を集計する
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import Optional
+import numpy as np
+
+# 保存先の種類（sqlite: SQLite / jsonl: JSON Lines / off: 記録しない）
+TELEMETRY_BACKENDS = ("sqlite", "jsonl", "off")
+
+# モデルごとの料金（USドル / 100万トークン、(入力, 出力)）。環境変数 VENDOR_RAG_MODEL_PRICES（JSON）で上書きできる
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "gpt-4": (30.0, 60.0),
+}
+
+# 統計情報で集計する日数
+SUMMARY_DAYS = 7
+
+# 1件の記録の項目（SQLiteの列と同じ順序）
+RECORD_FIELDS = (
+    "created_at",          # 記録した時刻（UNIX時間）
+    "model",               # 使用モデル
+    "renderer",            # 回答の作成方法（分割生成は "map_reduce"）
+    "status",              # ok / error
+    "cache_hit",           # exact / semantic（キャッシュから返した場合）
+    "coalesced",           # process / file（同時に送られた同じ質問の結果を共有した場合）
+    "usage_source",        # api（APIの usage の値） / estimate（tiktokenでの見積もり） / none（LLMを呼んでいない）
+    "llm_calls",           # LLMの呼び出し回数
+    "input_tokens",        # 入力トークン数
+    "output_tokens",       # 出力トークン数
+    "cost_usd",            # 料金（USドル。料金が未登録のモデルはNone）
+    "search_seconds",      # 検索（質問の埋め込み＋ベクトル検索）の秒数
+    "generation_seconds",  # 回答生成の秒数
+    "first_token_seconds", # 最初の断片までの秒数（ストリーミングのみ）
+    "total_seconds",       # 全体の秒数
+)
+
+def load_prices() -> dict:
+    """モデルごとの料金（環境変数 VENDOR_RAG_MODEL_PRICES の {"モデル": [入力, 出力]} で追加・上書き）"""
+    prices = dict(MODEL_PRICES)
+    configured = os.getenv("VENDOR_RAG_MODEL_PRICES")
+    if configured:
+        try:
+            prices.update({model: tuple(value) for model, value in json.loads(configured).items()})
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"VENDOR_RAG_MODEL_PRICES を解析できません: {e}")
+    return prices
+
+def _percentile(values: list, q: float) -> float:
+    return float(np.percentile(np.array(values), q)) if values else 0.0
+
+class TelemetryStore:
+    """テレメトリの共通処理（料金の計算と集計）"""
+
+    def __init__(self, prices: Optional[dict] = None):
+        """
+        初期化
+
+        Args:
+            prices: モデル → (入力, 出力) の料金（USドル / 100万トークン。未指定時は load_prices()）
+        """
+        self.prices = prices if prices is not None else load_prices()
+        self._lock = threading.Lock()
+
+    def cost(self, model: str, input_tokens: int, output_tokens: int) -> Optional[float]:
+        """料金（USドル）を計算（料金が未登録のモデルはNone）"""
+        price = self.prices.get(model)
+        if price is None:
+            return None
+        return (input_tokens * price[0] + output_tokens * price[1]) / 1_000_000
+
+    def record(self, **fields):
+        """
+        1件を追記
+
+        Args:
+            fields: RECORD_FIELDS の項目（created_at と cost_usd は未指定なら計算する。ほかの未指定の項目はNone）
+        """
+        row = {field: fields.get(field) for field in RECORD_FIELDS}
+        if row["created_at"] is None:
+            row["created_at"] = time.time()
+        if row["cost_usd"] is None and row["llm_calls"]:
+            row["cost_usd"] = self.cost(row["model"], row["input_tokens"] or 0, row["output_tokens"] or 0)
+        self._append(row)
+
+    def _append(self, row: dict):
+        raise NotImplementedError
+
+    def _rows(self, since: float) -> list:
+        raise NotImplementedError
+
+    def summary(self, days: int = SUMMARY_DAYS) -> dict:
+        """
+        直近 days 日の集計
+
+        Returns:
+            {"requests": 件数, "errors": エラー件数, "cache_hits": キャッシュ・同時実行のまとめで返した件数,
+            "latency_p50" / "latency_p95": 全体の秒数, "stages": 段階 → {"p50", "p95"}（その段階を実行した記録のみ）,
+            "tokens_by_day": 日付 → 入出力の合計トークン数, "cost_by_model": モデル → 料金（USドル）, "cost_total": 料金の合計}
+        """
+        rows = self._rows(time.time() - days * 24 * 60 * 60)
+        tokens_by_day = defaultdict(int)
+        cost_by_model = defaultdict(float)
+        for row in rows:
+            tokens = (row["input_tokens"] or 0) + (row["output_tokens"] or 0)
+            if tokens:
+                tokens_by_day[time.strftime("%Y-%m-%d", time.localtime(row["created_at"]))] += tokens
+            if row["cost_usd"]:
+                cost_by_model[row["model"]] += row["cost_usd"]
+
+        stages = {}
+        for stage in ("search", "generation", "first_token"):
+            values = [row[f"{stage}_seconds"] for row in rows if row[f"{stage}_seconds"] is not None]
+            if values:
+                stages[stage] = {"p50": _percentile(values, 50), "p95": _percentile(values, 95)}
+
+        totals = [row["total_seconds"] for row in rows if row["total_seconds"] is not None]
+        return {
+            "requests": len(rows),
+            "errors": sum(1 for row in rows if row["status"] == "error"),
+            "cache_hits": sum(1 for row in rows if row["cache_hit"] or row["coalesced"]),
+            "latency_p50": _percentile(totals, 50),
+            "latency_p95": _percentile(totals, 95),
+            "stages": stages,
+            "tokens_by_day": dict(sorted(tokens_by_day.items())),
+            "cost_by_model": dict(cost_by_model),
+            "cost_total": sum(cost_by_model.values()),
+        }
+
+class SQLiteTelemetryStore(TelemetryStore):
+    """SQLiteに追記するテレメトリ（同じファイルを使う複数ワーカーの記録をまとめて集計できる）"""
+
+    def __init__(self, path: str, prices: Optional[dict] = None):
+        """
+        初期化
+
+        Args:
+            path: SQLiteファイルのパス
+            prices: モデルごとの料金
+        """
+        super().__init__(prices)
+        self.path = path
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        # Streamlitなど複数スレッドから利用されるため、接続はロックで保護して共有する
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS requests (
+                created_at REAL NOT NULL,
+                model TEXT,
+                renderer TEXT,
+                status TEXT,
+                cache_hit TEXT,
+                coalesced TEXT,
+                usage_source TEXT,
+                llm_calls INTEGER,
+                input_tokens INTEGER,
+                output_tokens INTEGER,
+                cost_usd REAL,
+                search_seconds REAL,
+                generation_seconds REAL,
+                first_token_seconds REAL,
+                total_seconds REAL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_created_at ON requests(created_at)")
+        self._conn.commit()
+
+    def _append(self, row: dict):
+        with self._lock:
+            self._conn.execute(
+                f"INSERT INTO requests ({', '.join(RECORD_FIELDS)}) VALUES ({', '.join('?' for _ in RECORD_FIELDS)})",
+                [row[field] for field in RECORD_FIELDS]
+            )
+            self._conn.commit()
+
+    def _rows(self, since: float) -> list:
+        with self._lock:
+            cursor = self._conn.execute(
+                f"SELECT {', '.join(RECORD_FIELDS)} FROM requests WHERE created_at >= ?", (since,)
+            )
+            return [dict(zip(RECORD_FIELDS, values)) for values in cursor.fetchall()]
+
+    def close(self):
+        """接続を閉じる"""
+        with self._lock:
+            self._conn.close()
+
+class JSONLTelemetryStore(TelemetryStore):
+    """JSON Linesに1件1行で追記するテレメトリ（他のツールでそのまま読める。集計時はファイル全体を読む）"""
+
+    def __init__(self, path: str, prices: Optional[dict] = None):
+        """
+        初期化
+
+        Args:
+            path: JSON Linesファイルのパス
+            prices: モデルごとの料金
+        """
+        super().__init__(prices)
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _append(self, row: dict):
+        line = json.dumps(row, ensure_ascii=False) + "\n"
+        with self._lock:
+            # 1行を1回の書き込みで追記する（複数ワーカーが同じファイルに追記しても行が混ざらない）
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+    def _rows(self, since: float) -> list:
+        rows = []
+        with self._lock:
+            if not os.path.exists(self.path):
+                return rows
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        continue  # 書き込み途中の行
+                    if row.get("created_at", 0) >= since:
+                        rows.append({field: row.get(field) for field in RECORD_FIELDS})
+        return rows
+
+def open_telemetry(vectordb_path: str) -> Optional[TelemetryStore]:
+    """
+    環境変数の設定に従ってテレメトリの保存先を作成
+
+    - VENDOR_RAG_TELEMETRY: sqlite（デフォルト） / jsonl / off
+    - VENDOR_RAG_TELEMETRY_PATH: 保存先（デフォルトはベクトルDBの隣の .telemetry.sqlite / .telemetry.jsonl）
+    - VENDOR_RAG_MODEL_PRICES: モデルごとの料金（JSON、USドル / 100万トークンの [入力, 出力]）
+
+    Returns:
+        テレメトリの保存先（off の場合はNone）
+    """
+    backend = os.getenv("VENDOR_RAG_TELEMETRY", "sqlite").strip().lower()
+    if backend not in TELEMETRY_BACKENDS:
+        raise ValueError(f"不明なテレメトリの保存先の種類です: {backend}（{' / '.join(TELEMETRY_BACKENDS)}）")
+    if backend == "off":
+        return None
+
+    path = os.getenv("VENDOR_RAG_TELEMETRY_PATH") or f"{vectordb_path.rstrip(os.sep)}.telemetry.{backend}"
+    if backend == "jsonl":
+        return JSONLTelemetryStore(path)
+    return SQLiteTelemetryStore(path)
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+テストの共通設定
+アプリのモジュール（フラットな構成）を読み込めるようにし、vendor_rag_ingest のフェイクOpenAI APIサーバーを
+テストごとに空いているポートで起動する
+"""
+
+import os
+import sys
+import threading
+import importlib.util
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_SERVER_PATH = os.path.join(os.path.dirname(APP_DIR), "vendor_rag_ingest", "fake_openai_server.py")
+
+sys.path.insert(0, APP_DIR)
+
+def _load_fake_server():
+    # vendor_rag_ingest には同じ名前のモジュールがあるため、sys.path には追加せずファイルから読み込む
+    spec = importlib.util.spec_from_file_location("fake_openai_server", FAKE_SERVER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+fake_openai_server = _load_fake_server()
+
+@pytest.fixture
+def fake_server():
+    """フェイクOpenAI APIサーバー（server.options の値はテスト中に変更できる。base_url は /v1 までのURL）"""
+    options = fake_openai_server.setup_argument_parser().parse_args(["--port", "0", "--dim", "8", "--quiet"])
+    server = fake_openai_server.create_server("127.0.0.1", 0, options)
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+共有トランスポート（openai_transport.py）のテスト
+フェイクOpenAI APIサーバーに対して、リトライ・サーキットブレーカー・段階ごとのタイムアウト・接続の再利用を確認する
+"""
+
+import time
+
+import httpx
+import pytest
+
+from openai_transport import CircuitOpenError, OpenAITransport
+
+EMBEDDING_BODY = {"model": "text-embedding-ada-002", "input": ["契約書管理"]}
+CHAT_BODY = {"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "質問: 契約書管理"}]}
+
+def _embed(transport: OpenAITransport, server) -> httpx.Response:
+    return transport.http_client.post(f"{server.base_url}/embeddings", json=EMBEDDING_BODY)
+
+def _chat(transport: OpenAITransport, server) -> httpx.Response:
+    return transport.http_client.post(f"{server.base_url}/chat/completions", json=CHAT_BODY)
+
+def test_retries_5xx_up_to_max_retries(fake_server):
+    fake_server.options.fail_rate = 1.0
+    transport = OpenAITransport(max_retries=2, backoff_base=0.01, failure_threshold=0)
+
+    response = _embed(transport, fake_server)
+
+    assert response.status_code == 500
+    assert fake_server.stats["/v1/embeddings"] == 3
+    stage = transport.stats()["stages"]["embedding"]
+    assert stage["retries"] == 2
+    assert stage["errors"] == 3
+
+def test_retry_after_is_honoured_for_429(fake_server):
+    # 1分に1件までのため、2件目以降は Retry-After（約60秒）付きの429になる
+    fake_server.options.rpm = 1
+    transport = OpenAITransport(max_retries=2, backoff_base=0.001, backoff_max=0.2)
+    assert _embed(transport, fake_server).status_code == 200
+
+    started = time.perf_counter()
+    response = _embed(transport, fake_server)
+    elapsed = time.perf_counter() - started
+
+    assert response.status_code == 429
+    # 指数バックオフなら合計数ミリ秒のところ、Retry-After を backoff_max で打ち切った0.2秒を2回待つ
+    assert elapsed >= 0.4
+    assert transport.stats()["stages"]["embedding"]["retries"] == 2
+    # 429はサーバー障害ではないため、サーキットブレーカーには数えない
+    assert transport.breakers["embedding"].failures == 0
+
+def test_retry_delay_prefers_retry_after_header():
+    transport = OpenAITransport(backoff_base=5.0, backoff_max=8.0)
+
+    assert transport._retry_delay(0, httpx.Response(429, headers={"Retry-After": "0.25"})) == 0.25
+    assert transport._retry_delay(0, httpx.Response(429, headers={"Retry-After": "120"})) == 8.0
+    # ヘッダーがなければ指数バックオフ（ジッターで base の0.5〜1倍）
+    assert 2.5 <= transport._retry_delay(0, httpx.Response(503)) <= 5.0
+
+def test_circuit_breaker_opens_and_recovers_through_half_open(fake_server):
+    fake_server.options.fail_rate = 1.0
+    transport = OpenAITransport(max_retries=0, failure_threshold=2, reset_seconds=0.2)
+    breaker = transport.breakers["chat"]
+
+    assert _chat(transport, fake_server).status_code == 500
+    assert breaker.state == "closed"
+    assert _chat(transport, fake_server).status_code == 500
+    assert breaker.state == "open"
+
+    # 止めている間はAPIを呼ばずにすぐ失敗させる
+    with pytest.raises(CircuitOpenError):
+        _chat(transport, fake_server)
+    assert fake_server.stats["/v1/chat/completions"] == 2
+    assert transport.stats()["stages"]["chat"]["rejected"] == 1
+
+    # reset_seconds 経過後の試しの1件が失敗すれば再び止める
+    time.sleep(0.25)
+    assert breaker.state == "half_open"
+    assert _chat(transport, fake_server).status_code == 500
+    assert breaker.state == "open"
+    assert breaker.opens == 2
+
+    # 試しの1件が成功すれば再開する
+    time.sleep(0.25)
+    fake_server.options.fail_rate = 0.0
+    assert _chat(transport, fake_server).status_code == 200
+    assert breaker.state == "closed"
+    assert _chat(transport, fake_server).status_code == 200
+
+def test_half_open_lets_only_one_probe_through():
+    transport = OpenAITransport(failure_threshold=1, reset_seconds=0.0)
+    breaker = transport.breakers["embedding"]
+    breaker.record_failure()
+
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+
+def test_stage_timeouts_are_applied_per_stage(fake_server):
+    fake_server.options.latency = 0.5
+    transport = OpenAITransport(stage_timeouts={"embedding": 0.1, "chat": 5.0}, max_retries=0, failure_threshold=0)
+
+    with pytest.raises(httpx.ReadTimeout):
+        _embed(transport, fake_server)
+    assert _chat(transport, fake_server).status_code == 200
+
+    stats = transport.stats()["stages"]
+    assert stats["embedding"]["timeouts"] == 1
+    assert stats["chat"]["timeouts"] == 0
+
+def test_connections_are_reused_across_requests(fake_server):
+    transport = OpenAITransport()
+    client = transport.openai_client(api_key="dummy")
+    client.base_url = fake_server.base_url
+
+    for _ in range(3):
+        client.embeddings.create(model="text-embedding-ada-002", input=["契約書管理"])
+    _chat(transport, fake_server)
+
+    stats = transport.stats()
+    assert stats["connections_opened"] == 1
+    assert stats["connections_reused"] == 3
+    assert stats["connections_idle"] == 1
+    assert fake_server.stats["connections"] == 1
+
+def test_pool_timeout_is_not_retried_or_counted_against_the_breaker(fake_server):
+    transport = OpenAITransport(max_connections=1, connect_timeout=0.2, failure_threshold=1)
+    body = dict(CHAT_BODY, stream=True)
+
+    # ストリーミングの応答が唯一の接続を使っている間は、次の呼び出しは接続の空きを待ちきれない
+    with transport.http_client.stream("POST", f"{fake_server.base_url}/chat/completions", json=body) as response:
+        with pytest.raises(httpx.PoolTimeout):
+            _embed(transport, fake_server)
+        response.read()
+
+    stats = transport.stats()["stages"]["embedding"]
+    assert stats["pool_timeouts"] == 1
+    assert stats["retries"] == 0
+    assert stats["circuit"] == "closed"
+    assert _embed(transport, fake_server).status_code == 200
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+同じ質問の同時実行のまとめ（singleflight.py）のテスト
+実行役（leader）と待つ側（follower）の結果の共有・打ち切り・プロセス間のファイルロックを確認する
+"""
+
+import os
+import time
+import asyncio
+import threading
+
+from singleflight import Flight, SingleFlight
+
+KEY = "ab12"
+
+def _run_concurrently(single_flight: SingleFlight, compute, count: int) -> tuple[list, list]:
+    """count 個のスレッドから同じキーで run() を呼ぶ（例外はその呼び出し元の結果として返す）"""
+    results = [None] * count
+    joined = threading.Barrier(count + 1)
+
+    def worker(i):
+        joined.wait()
+        try:
+            results[i] = single_flight.run(KEY, compute)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    joined.wait()
+    time.sleep(0.1)  # 全員が join() を終えるまで待つ
+    return threads, results
+
+def test_followers_share_the_leaders_result():
+    single_flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def compute():
+        calls.append(1)
+        release.wait(5)
+        return ("回答", {"total_tokens": 10})
+
+    threads, results = _run_concurrently(single_flight, compute, 5)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert all(result == ("回答", {"total_tokens": 10}) for result, _ in results)
+    assert sorted(source or "" for _, source in results) == ["", "process", "process", "process", "process"]
+    assert single_flight.stats() == {
+        "leaders": 1, "coalesced": 4, "shared_across_processes": 0, "abandoned": 0, "in_flight": 0,
+    }
+
+def test_next_call_after_completion_runs_again():
+    single_flight = SingleFlight()
+
+    assert single_flight.run(KEY, lambda: ("1回目",)) == (("1回目",), None)
+    assert single_flight.run(KEY, lambda: ("2回目",)) == (("2回目",), None)
+    assert single_flight.stats()["leaders"] == 2
+
+def test_follower_stops_waiting_after_timeout_and_runs_itself():
+    single_flight = SingleFlight(timeout=0.1)
+    release = threading.Event()
+
+    def slow():
+        release.wait(5)
+        return ("遅い回答",)
+
+    leader = threading.Thread(target=single_flight.run, args=(KEY, slow))
+    leader.start()
+    time.sleep(0.05)
+
+    started = time.perf_counter()
+    result = single_flight.run(KEY, lambda: ("自分で生成",))
+    elapsed = time.perf_counter() - started
+    release.set()
+    leader.join(5)
+
+    assert result == (("自分で生成",), None)
+    assert 0.1 <= elapsed < 1.0
+    assert single_flight.stats()["abandoned"] == 1
+
+def test_followers_run_themselves_when_the_leader_fails():
+    single_flight = SingleFlight()
+    calls = []
+    release = threading.Event()
+
+    def compute():
+        calls.append(1)
+        if len(calls) == 1:
+            release.wait(5)
+            raise RuntimeError("APIエラー")
+        return ("回答",)
+
+    threads, results = _run_concurrently(single_flight, compute, 3)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    # 失敗した実行役の例外は共有せず、待っていた呼び出し元はそれぞれ自分で実行する
+    assert sum(isinstance(result, RuntimeError) for result in results) == 1
+    assert [result for result in results if not isinstance(result, Exception)] == [(("回答",), None)] * 2
+    assert single_flight.stats()["abandoned"] == 2
+
+def test_followers_receive_chunks_while_they_are_generated():
+    flight = Flight()
+    received = []
+
+    follower = threading.Thread(target=lambda: received.extend(flight.follow(5)))
+    follower.start()
+    for chunk in ["回", "答", "です"]:
+        flight.publish(chunk)
+        time.sleep(0.02)
+    flight.complete(("回答です", {}))
+    follower.join(5)
+
+    assert received == ["回", "答", "です"]
+    assert flight.result == ("回答です", {})
+    # 完了後に加わった呼び出し元も、それまでの断片をすべて受け取る
+    assert list(flight.follow(0.1)) == ["回", "答", "です"]
+
+def test_follow_stops_when_nothing_arrives_before_timeout():
+    flight = Flight()
+    flight.publish("途中")
+
+    started = time.perf_counter()
+    assert list(flight.follow(0.1)) == ["途中"]
+    assert time.perf_counter() - started < 1.0
+    assert flight.result is None
+
+def test_async_callers_share_one_computation():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return ("回答",)
+
+    async def main():
+        return await asyncio.gather(*(single_flight.arun(KEY, compute) for _ in range(4)))
+
+    results = asyncio.run(main())
+
+    assert len(calls) == 1
+    assert [source for _, source in results] == [None, "process", "process", "process"]
+
+def test_async_follower_times_out():
+    flight = Flight()
+
+    async def main():
+        return [chunk async for chunk in flight.afollow(0.1)]
+
+    started = time.perf_counter()
+    assert asyncio.run(main()) == []
+    assert time.perf_counter() - started < 1.0
+
+def test_file_lock_shares_the_result_across_processes(tmp_path):
+    # ロックのファイルは open() ごとに別のロックになるため、2つのインスタンスで2つのプロセスを模擬する
+    first = SingleFlight(str(tmp_path))
+    second = SingleFlight(str(tmp_path))
+    handle, result = first.lock(KEY)
+    assert handle is not None and result is None
+
+    waited = []
+    waiter = threading.Thread(target=lambda: waited.append(second.lock(KEY)))
+    waiter.start()
+    time.sleep(0.2)
+    first.unlock(handle, KEY, ("回答", {"total_tokens": 10}))
+    waiter.join(5)
+
+    assert waited == [(None, ("回答", {"total_tokens": 10}))]
+    assert second.stats()["shared_across_processes"] == 1
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".lock")]
+
+def test_file_lock_is_taken_over_when_the_holder_fails(tmp_path):
+    first = SingleFlight(str(tmp_path))
+    second = SingleFlight(str(tmp_path))
+    handle, _ = first.lock(KEY)
+
+    waited = []
+    waiter = threading.Thread(target=lambda: waited.append(second.lock(KEY)))
+    waiter.start()
+    time.sleep(0.2)
+    first.unlock(handle, KEY)  # 結果を保存せずに解放（失敗）
+    waiter.join(5)
+
+    taken_over, result = waited[0]
+    assert taken_over is not None and result is None
+    second.unlock(taken_over, KEY)
+
+def test_file_lock_wait_is_bounded_by_timeout(tmp_path):
+    first = SingleFlight(str(tmp_path))
+    second = SingleFlight(str(tmp_path), timeout=0.2)
+    handle, _ = first.lock(KEY)
+
+    started = time.perf_counter()
+    assert second.lock(KEY) == (None, None)
+    assert 0.2 <= time.perf_counter() - started < 1.0
+    first.unlock(handle, KEY)
+
+def test_different_keys_do_not_wait_for_each_other(tmp_path):
+    first = SingleFlight(str(tmp_path))
+    second = SingleFlight(str(tmp_path), timeout=5.0)
+    handle, _ = first.lock("ab11")
+
+    started = time.perf_counter()
+    other, result = second.lock("ab22")
+
+    assert other is not None and result is None
+    assert time.perf_counter() - started < 0.5
+    second.unlock(other, "ab22")
+    first.unlock(handle, "ab11")
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ベンダー情報フィールドの解析モジュール
+`### ベンダー N: 名前 ｜ ラベル: 値 ｜ ...` 形式のセクションを1パスで解析し、
+ベクトルDBのメタデータとして保存・復元する
+"""
+
+import re
+from typing import Optional
+
+# ラベル → メタデータキー
+FIELD_LABELS = {
+    "ベンダーID": "vendor_id",
+    "別名": "aliases",
+    "面談状況": "interview_status",
+    "カテゴリ": "category",
+    "業界タグ": "industry_tags",
+    "技術スタック": "tech_stack",
+    "価格帯": "price_range",
+    "デプロイ方式": "deployment",
+    "強み": "strengths",
+    "サービス概要": "service_summary",
+    "詳細説明": "description",
+    "URL": "url",
+}
+
+# 表示順のフィールドキー
+FIELD_KEYS = ["name"] + list(FIELD_LABELS.values())
+
+# カンマ区切りの複数値フィールド
+LIST_FIELDS = ("aliases", "industry_tags", "tech_stack")
+
+# 値がない場合の表示
+MISSING_VALUE = "情報なし"
+
+# メタデータ形式のバージョン（形式変更時に更新）
+# 2: コンテキストブロック（context_block / context_block_tokens）を追加
+SCHEMA_VERSION = 2
+
+_HEADER_PATTERN = re.compile(r"^#+\s*ベンダー\s*(\d+)\s*[:：]\s*(.+)$")
+
+class VendorParseError(ValueError):
+    """ベンダーセクションの解析エラー"""
+
+def split_list(value: str) -> list[str]:
+    """カンマ区切りの値をリストに変換"""
+    return [item.strip() for item in re.split(r"[,、，]", value) if item.strip()]
+
+def parse_vendor_section(section: str) -> tuple[dict, list[str]]:
+    """
+    ベンダーセクションを1パスで解析
+
+    Args:
+        section: `### ベンダー N:` で始まるセクション文字列
+
+    Returns:
+        (フィールド辞書, 警告メッセージのリスト)
+        フィールド辞書は FIELD_KEYS のキーと vendor_number を持ち、欠損値は空文字
+
+    Raises:
+        VendorParseError: 見出しまたはベンダーIDが解析できない場合
+    """
+    header, *parts = section.strip().split("｜")
+
+    match = _HEADER_PATTERN.match(header.strip())
+    if not match:
+        raise VendorParseError(f"見出しを解析できません: {header.strip()[:50]}")
+
+    fields = {key: "" for key in FIELD_KEYS}
+    fields["vendor_number"] = int(match.group(1))
+    fields["name"] = match.group(2).strip()
+    warnings = []
+
+    for part in parts:
+        part = part.strip()
+        if not part:
+            continue
+        label, separator, value = part.partition(":")
+        key = FIELD_LABELS.get(label.strip())
+        if not separator or key is None:
+            warnings.append(f"不明な項目: {part[:30]}")
+            continue
+        if fields[key]:
+            warnings.append(f"項目が重複しています: {label.strip()}")
+        fields[key] = value.strip()
+
+    if not fields["vendor_id"]:
+        raise VendorParseError(f"ベンダーIDがありません: {fields['name']}")
+
+    missing = [label for label, key in FIELD_LABELS.items() if not fields[key]]
+    if missing:
+        warnings.append(f"未記入の項目: {', '.join(missing)}")
+
+    return fields, warnings
+
+def fields_to_metadata(fields: dict) -> dict:
+    """
+    解析済みフィールドをベクトルDBのメタデータに変換
+
+    Chromaのメタデータはスカラー値のみ保存できるため、複数値フィールドは
+    正規化したカンマ区切り文字列として保存する。
+    """
+    metadata = {"schema_version": SCHEMA_VERSION, "vendor_number": fields["vendor_number"]}
+    for key in FIELD_KEYS:
+        value = fields.get(key, "")
+        if key in LIST_FIELDS:
+            value = ",".join(split_list(value))
+        metadata[key] = value
+    return metadata
+
+def vendor_info_from_metadata(metadata: Optional[dict]) -> Optional[dict]:
+    """
+    メタデータから表示用のベンダー情報を復元
+
+    Returns:
+        FIELD_KEYS をキーとする辞書（欠損値は「情報なし」）。
+        解析済みフィールドを持たない旧形式のメタデータの場合はNone
+    """
+    if not metadata or "schema_version" not in metadata:
+        return None
+    return {key: metadata.get(key) or MISSING_VALUE for key in FIELD_KEYS}
+
+def vendor_info_from_text(content: str) -> dict:
+    """ページ本文から表示用のベンダー情報を解析（旧形式のベクトルDB向けフォールバック）"""
+    try:
+        fields, _ = parse_vendor_section(content)
+    except VendorParseError:
+        return {key: MISSING_VALUE for key in FIELD_KEYS}
+    return {key: fields[key] or MISSING_VALUE for key in FIELD_KEYS}
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ベンダーカタログのストリーミング読み込み
+複数のMarkdownファイル（ディレクトリ・globパターン可）からベンダーセクションを1件ずつ読み出し、
+プロセスプールで解析して一定件数ごとのDocumentバッチとして返す
+"""
+
+import os
+import glob
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, Optional
+
+from langchain.schema import Document
+from vendor_fields import parse_vendor_section, fields_to_metadata, VendorParseError, SCHEMA_VERSION
+from context_builder import render_context_block
+
+SECTION_PREFIX = "### ベンダー"
+
+def resolve_input_files(inputs: Iterable[str]) -> list[str]:
+    """
+    入力指定をMarkdownファイルのリストに展開
+
+    Args:
+        inputs: ファイルパス・ディレクトリ（配下の*.mdを再帰的に検索）・globパターンのリスト
+
+    Returns:
+        重複を除いたファイルパスのリスト（指定順、ディレクトリ・glob内は名前順）
+    """
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = sorted(glob.glob(os.path.join(item, "**", "*.md"), recursive=True))
+        elif glob.has_magic(item):
+            matches = sorted(glob.glob(item, recursive=True))
+        elif os.path.exists(item):
+            matches = [item]
+        else:
+            raise FileNotFoundError(f"ファイルが見つかりません: {item}")
+
+        if not matches:
+            raise FileNotFoundError(f"Markdownファイルが見つかりません: {item}")
+        files.extend(path for path in matches if path not in files)
+    return files
+
+def iter_vendor_sections(file_path: str) -> Iterator[str]:
+    """
+    ファイルを1行ずつ読み、`### ベンダー` 見出しごとのセクションを順に返す
+
+    ファイル全体をメモリに載せないため、保持するのは読み込み中の1セクション分のみ。
+    """
+    buffer = []
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith(SECTION_PREFIX):
+                if buffer:
+                    yield "".join(buffer).strip()
+                buffer = [line]
+            elif buffer:
+                buffer.append(line)
+    if buffer:
+        yield "".join(buffer).strip()
+
+def compute_content_hash(section: str) -> str:
+    """
+    ベンダーセクションの内容ハッシュを計算（行末の空白差分は無視）
+
+    メタデータ形式のバージョンを含めるため、形式変更時は全件が更新対象になる
+    （埋め込みはキャッシュから再利用される）。
+    """
+    normalized = "\n".join(line.rstrip() for line in section.strip().splitlines())
+    return hashlib.sha256(f"{SCHEMA_VERSION}\n{normalized}".encode("utf-8")).hexdigest()
+
+def parse_section_batch(batch: list[tuple[int, str, str]]) -> tuple[list[tuple[str, dict]], list[str]]:
+    """
+    セクションのバッチを解析（プロセスプールのワーカーで実行）
+
+    Args:
+        batch: (通し番号, ファイルパス, セクション文字列) のリスト
+
+    Returns:
+        ((セクション文字列, メタデータ) のリスト, 問題メッセージのリスト)
+    """
+    parsed = []
+    problems = []
+    for index, source, section in batch:
+        try:
+            fields, warnings = parse_vendor_section(section)
+        except VendorParseError as e:
+            problems.append(f"{source} セクション{index}: {e}（スキップ）")
+            continue
+
+        problems.extend(f"{fields['vendor_id']}: {warning}" for warning in warnings)
+        metadata = fields_to_metadata(fields)
+        metadata["vendor_index"] = index
+        metadata["source"] = os.path.basename(source)
+        metadata["content_hash"] = compute_content_hash(section)
+        # 検索時にそのままプロンプトに使うコンテキストブロック（トークン数付き）
+        metadata["context_block"], metadata["context_block_tokens"] = render_context_block(metadata)
+        parsed.append((section, metadata))
+    return parsed, problems
+
+def _iter_raw_batches(files: list[str], batch_size: int) -> Iterator[list[tuple[int, str, str]]]:
+    """全ファイルのセクションを通し番号付きでbatch_size件ずつ返す"""
+    batch = []
+    index = 0
+    for file_path in files:
+        for section in iter_vendor_sections(file_path):
+            index += 1
+            batch.append((index, file_path, section))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+def _iter_parsed_batches(files: list[str], batch_size: int, workers: int):
+    """解析済みバッチを入力順に返す（workers > 1 の場合はプロセスプールで並列解析）"""
+    raw_batches = _iter_raw_batches(files, batch_size)
+    if workers <= 1:
+        for batch in raw_batches:
+            yield parse_section_batch(batch)
+        return
+
+    # 先読みは workers * 2 バッチまでに制限し、メモリ使用量を一定に保つ
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for batch in raw_batches:
+            in_flight.append(executor.submit(parse_section_batch, batch))
+            if len(in_flight) >= workers * 2:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+def iter_document_batches(
+    files: list[str],
+    batch_size: int = 1000,
+    workers: int = 1,
+    strict: bool = False,
+    stats: Optional[dict] = None
+) -> Iterator[list[Document]]:
+    """
+    ベンダーセクションをDocumentのバッチとしてストリーミングで返す
+
+    Args:
+        files: 入力Markdownファイルのリスト
+        batch_size: 1バッチあたりのセクション数
+        workers: 解析に使うプロセス数（1以下ならプロセス内で解析）
+        strict: Trueの場合、解析の問題が1件でもあれば例外を送出
+        stats: 件数を集計する辞書（parsed / documents / problems を加算）
+
+    Yields:
+        Documentのリスト（ベンダーIDの重複はスキップ済み）
+    """
+    stats = stats if stats is not None else {}
+    for key in ("parsed", "documents", "problems"):
+        stats.setdefault(key, 0)
+
+    seen_ids = set()
+    for parsed, problems in _iter_parsed_batches(files, batch_size, workers):
+        documents = []
+        for section, metadata in parsed:
+            vendor_id = metadata["vendor_id"]
+            if vendor_id in seen_ids:
+                problems.append(f"{vendor_id}: ベンダーIDが重複しています（スキップ）")
+                continue
+            seen_ids.add(vendor_id)
+            documents.append(Document(page_content=section, metadata=metadata))
+
+        stats["parsed"] += len(parsed)
+        stats["documents"] += len(documents)
+        stats["problems"] += len(problems)
+        for problem in problems:
+            print(f"  解析時の問題: {problem}")
+        if problems and strict:
+            raise ValueError("解析エラーがあるため中断しました（--strict）")
+
+        if documents:
+            yield documents
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+埋め込みキャッシュ
+(モデル名, 正規化テキストのハッシュ) をキーに埋め込みベクトルをSQLiteへ永続化し、
+取り込み・検索の両方で同じベクトルを再計算しないようにする
+"""
+
+import os
+import re
+import time
+import array
+import asyncio
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from typing import List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+# 最終アクセス時刻を更新する間隔（秒）。ヒットのたびに書き込まないよう、これより新しい行は更新しない
+# （古い順の削除はこの精度で十分）
+ACCESS_UPDATE_INTERVAL = 60 * 60
+
+def normalize_text(text: str) -> str:
+    """キャッシュキー用のテキスト正規化（NFKC・前後空白除去・連続空白の圧縮）"""
+    text = unicodedata.normalize("NFKC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+def default_cache_path(vectordb_path: str) -> str:
+    """
+    キャッシュファイルのパスを決定
+
+    環境変数 VENDOR_RAG_EMBEDDING_CACHE があればそれを使い、なければベクトルDBの隣に置く
+    （ベクトルDBを再構築してもキャッシュは残る）。
+    """
+    return os.getenv("VENDOR_RAG_EMBEDDING_CACHE") or f"{vectordb_path.rstrip(os.sep)}.embedding_cache.sqlite"
+
+class EmbeddingCache:
+    """SQLiteによる埋め込みキャッシュ（サイズ上限付きLRU）"""
+
+    def __init__(self, path: str, max_entries: int = 500_000, max_bytes: int = 2 * 1024 ** 3):
+        """
+        初期化
+
+        Args:
+            path: SQLiteファイルのパス
+            max_entries: 保持する最大件数
+            max_bytes: ベクトルの合計バイト数の上限
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        # Streamlitなど複数スレッドから利用されるため、接続はロックで保護して共有する
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key BLOB PRIMARY KEY,
+                model TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                nbytes INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings(last_access)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model: str, text: str) -> bytes:
+        """キャッシュキーの生成"""
+        return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).digest()
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[List[float]]]:
+        """
+        複数テキストのベクトルを取得
+
+        Returns:
+            入力と同じ順序のリスト（未キャッシュはNone）
+        """
+        keys = [self.make_key(model, text) for text in texts]
+        found = {}
+        stale = []
+        now = time.time()
+        with self._lock:
+            # SQLiteのプレースホルダー上限を超えないよう分割して問い合わせる
+            for start in range(0, len(keys), 500):
+                chunk = list(set(keys[start:start + 500]))
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector, last_access FROM embeddings WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                for key, blob, last_access in rows:
+                    found[key] = blob
+                    if now - last_access >= ACCESS_UPDATE_INTERVAL:
+                        stale.append(key)
+
+            if stale:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in stale]
+                )
+                self._conn.commit()
+
+            hits = sum(key in found for key in keys)
+            self.hits += hits
+            self.misses += len(keys) - hits
+
+        return [array.array("f", found[key]).tolist() if key in found else None for key in keys]
+
+    def put_many(self, model: str, texts: List[str], vectors: List[List[float]]):
+        """複数テキストのベクトルを保存し、上限を超えた分を古い順に削除"""
+        now = time.time()
+        rows = []
+        for text, vector in zip(texts, vectors):
+            blob = array.array("f", vector).tobytes()
+            rows.append((self.make_key(model, text), model, blob, len(blob), now))
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, vector, nbytes, last_access) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """件数・バイト数の上限を超えた分を最終アクセスの古い順に削除（ロック取得済みで呼ぶ）"""
+        count, total_bytes = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM embeddings"
+        ).fetchone()
+        if count <= self.max_entries and total_bytes <= self.max_bytes:
+            return
+
+        average = total_bytes / count if count else 1
+        over_bytes = max(0, total_bytes - self.max_bytes)
+        excess = max(count - self.max_entries, int(over_bytes / average) + 1 if over_bytes else 0)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+            (excess,)
+        )
+        self.evictions += excess
+
+    def stats(self) -> dict:
+        """ヒット・ミス数などの統計を取得"""
+        with self._lock:
+            entries, total_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM embeddings"
+            ).fetchone()
+            hits, misses, evictions = self.hits, self.misses, self.evictions
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "evictions": evictions,
+            "entries": entries,
+            "bytes": total_bytes
+        }
+
+    def close(self):
+        """接続を閉じる"""
+        with self._lock:
+            self._conn.close()
+
+class CachedEmbeddings(Embeddings):
+    """任意のEmbeddingsをラップし、EmbeddingCacheを透過的に適用する"""
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model: str = "text-embedding-ada-002"):
+        """
+        初期化
+
+        Args:
+            embeddings: ラップする埋め込みオブジェクト
+            cache: 埋め込みキャッシュ
+            model: キャッシュキーに含めるモデル名
+        """
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model
+
+    def __getattr__(self, name):
+        # ラップ対象の属性（stats や checkpoint など）はそのまま参照できるようにする
+        if name == "embeddings":
+            raise AttributeError(name)
+        return getattr(self.embeddings, name)
+
+    def _split_misses(self, texts: List[str]):
+        cached = self.cache.get_many(self.model, texts)
+        misses = [i for i, vector in enumerate(cached) if vector is None]
+        return cached, misses
+
+    def _merge(self, texts: List[str], cached: list, misses: List[int], vectors: List[List[float]]):
+        if misses:
+            self.cache.put_many(self.model, [texts[i] for i in misses], vectors)
+            for i, vector in zip(misses, vectors):
+                cached[i] = vector
+        return cached
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """複数テキストの埋め込み（キャッシュにないものだけ計算）"""
+        cached, misses = self._split_misses(texts)
+        vectors = self.embeddings.embed_documents([texts[i] for i in misses]) if misses else []
+        return self._merge(texts, cached, misses, vectors)
+
+    def embed_query(self, text: str) -> List[float]:
+        """クエリテキストの埋め込み"""
+        cached, misses = self._split_misses([text])
+        vectors = [self.embeddings.embed_query(text)] if misses else []
+        return self._merge([text], cached, misses, vectors)[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        複数テキストの埋め込み（非同期）
+
+        キャッシュの照合・保存はSQLiteへのアクセスでブロックするため、asyncio.to_thread でイベントループの外で行う。
+        """
+        cached, misses = await asyncio.to_thread(self._split_misses, texts)
+        if not misses:
+            return cached
+        vectors = await self.embeddings.aembed_documents([texts[i] for i in misses])
+        return await asyncio.to_thread(self._merge, texts, cached, misses, vectors)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        """クエリテキストの埋め込み（非同期。キャッシュの照合・保存は aembed_documents() と同じくスレッドで行う）"""
+        cached, misses = await asyncio.to_thread(self._split_misses, [text])
+        if not misses:
+            return cached[0]
+        vectors = [await self.embeddings.aembed_query(text)]
+        return (await asyncio.to_thread(self._merge, [text], cached, misses, vectors))[0]
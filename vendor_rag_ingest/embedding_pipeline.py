@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+埋め込みパイプライン
+バッチ分割・並列実行・レート制限（RPM/TPM）・ジッター付きリトライ・チェックポイントを備えた
+OpenAI Embeddings 呼び出しを提供する
+"""
+
+import os
+import time
+import random
+import struct
+import hashlib
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import openai
+from langchain_core.embeddings import Embeddings
+
+@lru_cache(maxsize=4)
+def _get_encoding(model: str):
+    """tiktokenのエンコーダーを取得（プロセス内でキャッシュ）"""
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+def estimate_tokens(text: str, model: str = "text-embedding-ada-002") -> int:
+    """レート制限用のトークン数見積もり"""
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # フォールバック: 日本語は1文字≒1トークン以上になるため文字数で見積もる
+    return len(text)
+
+class RateLimiter:
+    """1分あたりのリクエスト数・トークン数を制限するトークンバケット"""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        """
+        初期化
+
+        Args:
+            requests_per_minute: 1分あたりの最大リクエスト数
+            tokens_per_minute: 1分あたりの最大トークン数
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._request_allowance = float(requests_per_minute)
+        self._token_allowance = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        """経過時間に応じてバケットを補充"""
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_allowance = min(
+            self.requests_per_minute,
+            self._request_allowance + elapsed * self.requests_per_minute / 60.0
+        )
+        self._token_allowance = min(
+            self.tokens_per_minute,
+            self._token_allowance + elapsed * self.tokens_per_minute / 60.0
+        )
+
+    def acquire(self, tokens: int):
+        """1リクエスト分（tokensトークン）の枠が空くまで待機"""
+        # 1バッチで上限を超える場合でも永久に待たないよう上限で打ち切る
+        tokens = min(tokens, self.tokens_per_minute)
+        with self._condition:
+            while True:
+                self._refill()
+                if self._request_allowance >= 1 and self._token_allowance >= tokens:
+                    self._request_allowance -= 1
+                    self._token_allowance -= tokens
+                    return
+
+                request_wait = (1 - self._request_allowance) * 60.0 / self.requests_per_minute
+                token_wait = (tokens - self._token_allowance) * 60.0 / self.tokens_per_minute
+                self._condition.wait(timeout=max(request_wait, token_wait, 0.01))
+
+class EmbeddingCheckpoint:
+    """
+    埋め込み結果のチェックポイント
+
+    完了したバッチごとに (キー, float32ベクトル) をファイルへ追記し、
+    中断後の再実行では保存済みのベクトルを再利用する。
+    """
+
+    _HEADER = struct.Struct("<32sI")
+
+    def __init__(self, path: str):
+        """
+        初期化
+
+        Args:
+            path: チェックポイントファイルのパス
+        """
+        self.path = path
+        self._offsets = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        """既存チェックポイントの索引を読み込み（途中で切れた末尾レコードは切り詰める）"""
+        if not os.path.exists(self.path):
+            return
+
+        valid_size = 0
+        with open(self.path, "rb") as f:
+            while True:
+                header = f.read(self._HEADER.size)
+                if len(header) < self._HEADER.size:
+                    break
+                key, dim = self._HEADER.unpack(header)
+                if len(f.read(dim * 4)) < dim * 4:
+                    break
+                self._offsets[key] = valid_size
+                valid_size = f.tell()
+
+        if valid_size != os.path.getsize(self.path):
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_size)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def get(self, key: bytes) -> Optional[List[float]]:
+        """保存済みのベクトルを取得"""
+        offset = self._offsets.get(key)
+        if offset is None:
+            return None
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            _, dim = self._HEADER.unpack(f.read(self._HEADER.size))
+            return list(struct.unpack(f"<{dim}f", f.read(dim * 4)))
+
+    def put_many(self, items: List[tuple]):
+        """(キー, ベクトル) のリストを追記"""
+        with self._lock:
+            with open(self.path, "ab") as f:
+                for key, vector in items:
+                    offset = f.tell()
+                    f.write(self._HEADER.pack(key, len(vector)))
+                    f.write(struct.pack(f"<{len(vector)}f", *vector))
+                    self._offsets[key] = offset
+                f.flush()
+                os.fsync(f.fileno())
+
+    def clear(self):
+        """チェックポイントを削除（取り込み完了後に呼び出す）"""
+        with self._lock:
+            self._offsets.clear()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+class EmbeddingPipeline(Embeddings):
+    """バッチ・並列・レート制限対応の埋め込みパイプライン"""
+
+    # リトライ対象のエラー（429・5xx・接続エラー・タイムアウト）
+    RETRYABLE_ERRORS = (
+        openai.RateLimitError,
+        openai.APIConnectionError,
+        openai.APITimeoutError,
+        openai.InternalServerError,
+    )
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        model: str = "text-embedding-ada-002",
+        base_url: Optional[str] = None,
+        batch_size: int = 100,
+        max_workers: int = 4,
+        requests_per_minute: int = 3000,
+        tokens_per_minute: int = 1_000_000,
+        max_retries: int = 6,
+        checkpoint_path: Optional[str] = None
+    ):
+        """
+        初期化
+
+        Args:
+            api_key: OpenAI APIキー
+            model: 埋め込みモデル名
+            base_url: APIのベースURL（ローカルのフェイクサーバーで検証する場合に指定）
+            batch_size: 1リクエストあたりのテキスト数
+            max_workers: 同時実行するリクエスト数の上限
+            requests_per_minute: 1分あたりのリクエスト数上限
+            tokens_per_minute: 1分あたりのトークン数上限
+            max_retries: リトライ回数の上限
+            checkpoint_path: チェックポイントファイルのパス（Noneで無効）
+        """
+        self.model = model
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.checkpoint = EmbeddingCheckpoint(checkpoint_path) if checkpoint_path else None
+
+        # リトライはパイプライン側で制御するため、クライアント側のリトライは無効化
+        self.client = openai.OpenAI(
+            api_key=api_key,
+            base_url=base_url or os.getenv("OPENAI_BASE_URL"),
+            max_retries=0
+        )
+
+        self.stats = {"requests": 0, "retries": 0, "checkpoint_hits": 0, "embedded": 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key: str, value: int = 1):
+        with self._stats_lock:
+            self.stats[key] += value
+
+    def _checkpoint_key(self, text: str) -> bytes:
+        return hashlib.sha256(f"{self.model}\0{text}".encode("utf-8")).digest()
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        """待機時間を計算（Retry-Afterヘッダー優先、なければ指数バックオフ＋ジッター）"""
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after) + random.uniform(0, 1)
+            except ValueError:
+                pass
+        return min(60.0, 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        """1バッチの埋め込み（レート制限・リトライ付き）"""
+        tokens = sum(estimate_tokens(text, self.model) for text in texts)
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire(tokens)
+            try:
+                self._count("requests")
+                response = self.client.embeddings.create(model=self.model, input=texts)
+                # レスポンスの順序はindexで保証されるため並べ替える
+                data = sorted(response.data, key=lambda item: item.index)
+                return [item.embedding for item in data]
+            except self.RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise Exception(f"埋め込みAPIの呼び出しに失敗しました（{attempt + 1}回試行）: {e}")
+                self._count("retries")
+                time.sleep(self._retry_delay(attempt, e))
+
+    def _embed_and_checkpoint(self, texts: List[str], keys: List[bytes]) -> List[List[float]]:
+        vectors = self._embed_batch(texts)
+        if self.checkpoint is not None:
+            self.checkpoint.put_many(list(zip(keys, vectors)))
+        self._count("embedded", len(texts))
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        複数テキストの埋め込み
+
+        チェックポイント済みのテキストを除き、batch_size件ずつ最大max_workers並列で埋め込む。
+
+        Args:
+            texts: 埋め込むテキストのリスト
+
+        Returns:
+            入力と同じ順序のベクトルのリスト
+        """
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        pending = []
+
+        for i, text in enumerate(texts):
+            key = self._checkpoint_key(text)
+            vector = self.checkpoint.get(key) if self.checkpoint is not None else None
+            if vector is not None:
+                results[i] = vector
+                self._count("checkpoint_hits")
+            else:
+                pending.append((i, text, key))
+
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        if batches:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [
+                    (batch, executor.submit(
+                        self._embed_and_checkpoint,
+                        [text for _, text, _ in batch],
+                        [key for _, _, key in batch]
+                    ))
+                    for batch in batches
+                ]
+                for batch, future in futures:
+                    for (i, _, _), vector in zip(batch, future.result()):
+                        results[i] = vector
+
+        return results
+
+    def embed_query(self, text: str) -> List[float]:
+        """クエリテキストの埋め込み"""
+        return self._embed_batch([text])[0]
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ローカル検証用のフェイクOpenAI APIサーバー
+/v1/embeddings に対してテキストから決定的に生成したベクトルを返し、/v1/chat/completions に対しては
+プロンプト中のベンダー情報を転記した回答（ストリーミング・JSON形式にも対応）を返す。
+RPM超過時の429応答や一定確率の5xx応答、応答の遅延を再現でき、埋め込みパイプラインや
+検索側の共有トランスポート（keep-alive・タイムアウト・リトライ）の検証に使用する。
+GET /stats でパスごとのリクエスト数と接続数を返す。
+
+使用例:
+  python fake_openai_server.py --port 8765 --rpm 60 --fail-rate 0.05
+  OPENAI_API_KEY=dummy python ingest.py --base-url http://127.0.0.1:8765/v1
+  OPENAI_API_KEY=dummy OPENAI_BASE_URL=http://127.0.0.1:8765/v1 python query.py "契約書管理系のベンダーは？"
+"""
+
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def fake_embedding(text: str, dim: int) -> list[float]:
+    """テキストのハッシュをシードにした正規化済みベクトルを生成"""
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+    rng = random.Random(seed)
+    vector = [rng.gauss(0.0, 1.0) for _ in range(dim)]
+    norm = sum(v * v for v in vector) ** 0.5
+    return [v / norm for v in vector]
+
+def fake_chat_content(messages: list, json_mode: bool) -> str:
+    """
+    プロンプト中の質問とベンダー情報から決定的な回答を作成
+
+    Args:
+        messages: チャットのメッセージ（最後のメッセージに「質問:」とベンダー情報がある想定）
+        json_mode: JSON形式（ベンダー選定）で返すか
+    """
+    prompt = str(messages[-1].get("content", "")) if messages else ""
+    question = re.search(r"^質問:\s*(.*)$", prompt, re.MULTILINE)
+    names = re.findall(r"^- \*\*ベンダー名\*\*: (.*)$", prompt, re.MULTILINE)
+    vendor_ids = re.findall(r"^- \*\*ベンダーID\*\*: (.*)$", prompt, re.MULTILINE)
+    if json_mode:
+        vendors = [{"id": vendor_id, "reason": f"{name}は質問の条件に該当します"}
+                   for vendor_id, name in zip(vendor_ids, names)]
+        return json.dumps({"vendors": vendors}, ensure_ascii=False)
+    cards = [f"## ベンダー{i}\n- **ベンダー名**: {name}" for i, name in enumerate(names, 1)]
+    return f"【質問】\n{question.group(1) if question else ''}\n\n【回答】\n" + "\n\n".join(cards)
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """フェイクAPIのリクエストハンドラ"""
+
+    server_version = "FakeOpenAI/0.1"
+    # keep-alive で接続を再利用できるようにする（ストリーミングはチャンク転送）
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.stats["connections"] = self.server.stats.get("connections", 0) + 1
+
+    def log_message(self, format, *args):
+        if not self.server.options.quiet:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _check_limits(self) -> bool:
+        """RPM超過・障害注入の判定（応答済みならFalse）"""
+        options = self.server.options
+        if options.latency:
+            time.sleep(options.latency)
+
+        if options.rpm:
+            now = time.monotonic()
+            with self.server.lock:
+                window = self.server.request_times
+                while window and now - window[0] > 60:
+                    window.popleft()
+                if len(window) >= options.rpm:
+                    retry_after = max(0.0, 60 - (now - window[0]))
+                    self._send_json(
+                        429,
+                        {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                        {"Retry-After": f"{retry_after:.2f}"}
+                    )
+                    return False
+                window.append(now)
+
+        if options.fail_rate and random.random() < options.fail_rate:
+            self._send_json(500, {"error": {"message": "Injected failure", "type": "server_error"}})
+            return False
+
+        return True
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            with self.server.lock:
+                self._send_json(200, dict(self.server.stats))
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path: {self.path}"}})
+
+    def do_POST(self):
+        request = self._read_json()
+        with self.server.lock:
+            self.server.stats[self.path] = self.server.stats.get(self.path, 0) + 1
+
+        if not self._check_limits():
+            return
+
+        if self.path.endswith("/embeddings"):
+            self._handle_embeddings(request)
+        elif self.path.endswith("/chat/completions"):
+            self._handle_chat(request)
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path: {self.path}"}})
+
+    def _handle_embeddings(self, request: dict):
+        inputs = request.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+
+        dim = self.server.options.dim
+        data = [
+            {"object": "embedding", "index": i, "embedding": fake_embedding(str(text), dim)}
+            for i, text in enumerate(inputs)
+        ]
+        tokens = sum(len(str(text)) for text in inputs)
+        self._send_json(200, {
+            "object": "list",
+            "data": data,
+            "model": request.get("model", "text-embedding-ada-002"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        })
+
+    def _handle_chat(self, request: dict):
+        messages = request.get("messages", [])
+        json_mode = (request.get("response_format") or {}).get("type") == "json_object"
+        content = fake_chat_content(messages, json_mode)
+        model = request.get("model", "gpt-3.5-turbo")
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in messages)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content),
+                 "total_tokens": prompt_tokens + len(content)}
+        created = int(time.time())
+
+        if not request.get("stream"):
+            self._send_json(200, {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": "stop"}],
+                "usage": usage
+            })
+            return
+
+        # Server-Sent Events をチャンク転送で返す（--chunk-delay ごとに数文字ずつ）
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send_event(payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        size = self.server.options.chunk_chars
+        for start in range(0, len(content), size):
+            if self.server.options.chunk_delay:
+                time.sleep(self.server.options.chunk_delay)
+            send_event(json.dumps({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": content[start:start + size]}, "finish_reason": None}]
+            }, ensure_ascii=False))
+        send_event(json.dumps({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+            "usage": usage if (request.get("stream_options") or {}).get("include_usage") else None
+        }))
+        send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """フェイクサーバー（並列の呼び出しで接続待ちが起きないよう、接続の受付キューを既定の5より大きくする）"""
+
+    request_queue_size = 128
+
+def create_server(host: str, port: int, options) -> ThreadingHTTPServer:
+    """フェイクサーバーの生成"""
+    server = FakeOpenAIServer((host, port), FakeOpenAIHandler)
+    server.options = options
+    server.lock = threading.Lock()
+    server.request_times = deque()
+    server.stats = {}
+    return server
+
+def setup_argument_parser():
+    """コマンドライン引数の設定"""
+    parser = argparse.ArgumentParser(description="ローカル検証用フェイクOpenAI APIサーバー")
+    parser.add_argument("--host", default="127.0.0.1", help="待ち受けホスト")
+    parser.add_argument("--port", type=int, default=8765, help="待ち受けポート")
+    parser.add_argument("--dim", type=int, default=1536, help="埋め込みベクトルの次元数")
+    parser.add_argument("--rpm", type=int, default=0, help="1分あたりのリクエスト上限（超過で429、0で無制限）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="5xxを返す確率")
+    parser.add_argument("--latency", type=float, default=0.0, help="応答前の待機秒数")
+    parser.add_argument("--chunk-chars", type=int, default=8, help="ストリーミングの1断片あたりの文字数")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="ストリーミングの断片ごとの待機秒数")
+    parser.add_argument("--quiet", action="store_true", help="アクセスログを出力しない")
+    return parser
+
+def main():
+    """メイン処理"""
+    options = setup_argument_parser().parse_args()
+    server = create_server(options.host, options.port, options)
+    print(f"フェイクOpenAIサーバーを起動しました: http://{options.host}:{options.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nサーバーを停止しました。")
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    exit(main())
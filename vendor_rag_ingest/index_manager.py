@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ベクトルDBのバージョン管理（ブルー/グリーン切り替え）
+
+ディレクトリ構成:
+  vectordb/
+  ├── CURRENT              # 公開中のバージョン名
+  └── versions/
+      ├── 20250101-120000-000000/   # Chroma永続化ディレクトリ＋manifest.json
+      └── 20250102-090000-000000/
+
+取り込みは新しいバージョンのディレクトリに構築し、検証後に CURRENT を
+アトミックに書き換えて公開する。古いバージョンはロールバック用に保持する。
+CURRENT がない場合は、vectordb 直下をそのまま使う旧形式として扱う。
+"""
+
+import os
+import json
+import shutil
+import threading
+from datetime import datetime
+from typing import Optional
+
+POINTER_FILE = "CURRENT"
+VERSIONS_DIR = "versions"
+MANIFEST_FILE = "manifest.json"
+
+def _versions_root(root: str) -> str:
+    return os.path.join(root, VERSIONS_DIR)
+
+def version_path(root: str, version: str) -> str:
+    """バージョンのディレクトリパス"""
+    return os.path.join(_versions_root(root), version)
+
+def read_current_version(root: str) -> Optional[str]:
+    """公開中のバージョン名を取得（旧形式・未構築の場合はNone）"""
+    try:
+        with open(os.path.join(root, POINTER_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def resolve_index_path(root: str) -> tuple[str, Optional[str]]:
+    """
+    公開中のインデックスのパスを解決
+
+    Returns:
+        (Chroma永続化ディレクトリのパス, バージョン名)。旧形式の場合バージョン名はNone
+
+    Raises:
+        FileNotFoundError: ベクトルDBが存在しない場合
+    """
+    version = read_current_version(root)
+    if version:
+        path = version_path(root, version)
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"公開中のバージョンが見つかりません: {path}")
+        return path, version
+
+    if not os.path.isdir(root):
+        raise FileNotFoundError(f"ベクトルDBが見つかりません: {root}")
+    return root, None
+
+def read_manifest(path: str) -> dict:
+    """バージョンのmanifest.jsonを読み込み"""
+    try:
+        with open(os.path.join(path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_manifest(path: str, manifest: dict):
+    """バージョンのmanifest.jsonを書き込み"""
+    tmp_path = os.path.join(path, MANIFEST_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, os.path.join(path, MANIFEST_FILE))
+
+def list_versions(root: str) -> list[str]:
+    """構築済みバージョンの一覧（古い順）"""
+    versions_root = _versions_root(root)
+    if not os.path.isdir(versions_root):
+        return []
+    return sorted(
+        name for name in os.listdir(versions_root)
+        if os.path.isdir(os.path.join(versions_root, name))
+    )
+
+def create_staging_version(root: str, base: Optional[str] = None) -> tuple[str, str]:
+    """
+    新しいバージョンのステージングディレクトリを作成
+
+    Args:
+        root: ベクトルDBのルートディレクトリ
+        base: 差分更新の元にするインデックスのパス（Noneなら空で作成）
+
+    Returns:
+        (バージョン名, ディレクトリのパス)
+    """
+    version = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    path = version_path(root, version)
+    os.makedirs(_versions_root(root), exist_ok=True)
+
+    if base:
+        # 旧形式（ルート直下）から複製する場合は管理用ファイルを除外する
+        ignore = shutil.ignore_patterns(VERSIONS_DIR, POINTER_FILE, POINTER_FILE + ".tmp", MANIFEST_FILE)
+        shutil.copytree(base, path, ignore=ignore)
+    else:
+        os.makedirs(path)
+
+    write_manifest(path, {
+        "version": version,
+        "status": "building",
+        "base": os.path.basename(base) if base else None,
+        "created_at": datetime.now().isoformat(timespec="seconds")
+    })
+    return version, path
+
+def publish_version(root: str, version: str):
+    """CURRENT をアトミックに書き換えてバージョンを公開"""
+    path = version_path(root, version)
+    if not os.path.isdir(path):
+        raise FileNotFoundError(f"バージョンが見つかりません: {version}")
+
+    manifest = read_manifest(path)
+    manifest["status"] = "published"
+    manifest["published_at"] = datetime.now().isoformat(timespec="seconds")
+    write_manifest(path, manifest)
+
+    tmp_pointer = os.path.join(root, POINTER_FILE + ".tmp")
+    with open(tmp_pointer, "w", encoding="utf-8") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_pointer, os.path.join(root, POINTER_FILE))
+
+def discard_version(root: str, version: str):
+    """公開前のバージョンを削除（検証失敗時など）"""
+    if version == read_current_version(root):
+        raise ValueError(f"公開中のバージョンは削除できません: {version}")
+    shutil.rmtree(version_path(root, version), ignore_errors=True)
+
+def prune_versions(root: str, keep: int) -> list[str]:
+    """
+    公開済みバージョンを新しい順にkeep件残して削除
+
+    公開中のバージョンと、構築中のバージョンは削除しない。
+    中断された構築（公開されずに残ったもの）は最新以外を削除する。
+
+    Returns:
+        削除したバージョン名のリスト
+    """
+    current = read_current_version(root)
+    published, abandoned = [], []
+    for version in list_versions(root):
+        status = read_manifest(version_path(root, version)).get("status")
+        (published if status == "published" else abandoned).append(version)
+
+    removable = [v for v in published[:-keep] if v != current] if keep > 0 else []
+    removable += [v for v in abandoned[:-1] if v != current]
+    for version in removable:
+        shutil.rmtree(version_path(root, version), ignore_errors=True)
+    return removable
+
+def rollback(root: str, version: Optional[str] = None) -> str:
+    """
+    公開中のバージョンを切り替え
+
+    Args:
+        version: 切り替え先（Noneなら公開中の1つ前の公開済みバージョン）
+
+    Returns:
+        切り替え後のバージョン名
+    """
+    if version is None:
+        current = read_current_version(root)
+        published = [
+            v for v in list_versions(root)
+            if read_manifest(version_path(root, v)).get("status") == "published"
+        ]
+        older = [v for v in published if current is None or v < current]
+        if not older:
+            raise ValueError("ロールバック先のバージョンがありません")
+        version = older[-1]
+
+    publish_version(root, version)
+    return version
+
+class IndexPointer:
+    """
+    CURRENT の変更を検知する軽量なウォッチャー（stat結果が変わったときだけ読み直す）
+
+    changed() は読み込むべき stat キーを返すだけで、読み込みに成功した呼び出し元が commit() で
+    確認済みにする。読み込みに失敗した場合は確認済みにならず、次の呼び出しで再び読み込みを試みる。
+    """
+
+    def __init__(self, root: str):
+        """
+        初期化（まだ何も読み込んでいない状態。最初の changed() は必ず stat キーを返す）
+
+        Args:
+            root: ベクトルDBのルートディレクトリ
+        """
+        self.root = root
+        self._pointer_path = os.path.join(root, POINTER_FILE)
+        self._stat_key = None
+        self._lock = threading.Lock()
+
+    def _stat(self) -> tuple:
+        try:
+            st = os.stat(self._pointer_path)
+            return (st.st_mtime_ns, st.st_size, st.st_ino)
+        except FileNotFoundError:
+            return (0, 0, 0)  # 旧形式（CURRENT なし）
+
+    def changed(self) -> Optional[tuple]:
+        """
+        前回の commit() 以降に CURRENT が書き換えられたかどうか
+
+        Returns:
+            書き換えられていれば現在の stat キー（読み込み後に commit() に渡す）、変わっていなければNone
+        """
+        with self._lock:
+            stat_key = self._stat()
+            return None if stat_key == self._stat_key else stat_key
+
+    def commit(self, stat_key: tuple):
+        """changed() が返した stat キーの内容を読み込み終えたことを記録"""
+        with self._lock:
+            self._stat_key = stat_key
@@ -6,13 +6,22 @@ Markdown形式のベンダー情報をチャンク分割し、Chromaベクトル
 """
 
 import os
-import shutil
-from pathlib import Path
+import argparse
 from dotenv import load_dotenv
-from langchain.text_splitter import MarkdownHeaderTextSplitter
 from langchain_community.vectorstores import Chroma
-from langchain_openai import OpenAIEmbeddings
 from langchain.schema import Document
+from embedding_pipeline import EmbeddingPipeline
+from embedding_cache import EmbeddingCache, CachedEmbeddings, default_cache_path
+from catalog_stream import resolve_input_files, iter_document_batches
+from lexical_index import LexicalIndex
+from filter_index import FilterIndex
+from alias_index import AliasIndex
+from vector_backends import write_numpy_store, remove_chroma_store, has_chroma_store, open_backend
+from index_manager import (
+    resolve_index_path, create_staging_version, publish_version, discard_version,
+    prune_versions, rollback, list_versions, read_current_version, read_manifest,
+    write_manifest, version_path
+)
 
 def load_environment():
     """環境変数の読み込み"""
@@ -31,120 +40,372 @@ def load_environment():
     
     return api_key
 
-def read_markdown_file(file_path: str) -> str:
-    """Markdownファイルの読み込み"""
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            return f.read()
-    except FileNotFoundError:
-        raise FileNotFoundError(f"ファイルが見つかりません: {file_path}")
-    except Exception as e:
-        raise Exception(f"ファイル読み込みエラー: {e}")
+def validate_index(vectorstore, expected_count: int, sample_query: str = "契約書管理") -> list[Document]:
+    """
+    公開前のインデックス検証（ドキュメント数とサンプル検索）
+    
+    Returns:
+        サンプル検索の結果
+        
+    Raises:
+        ValueError: 検証に失敗した場合
+    """
+    count = vectorstore._collection.count()
+    if count != expected_count:
+        raise ValueError(f"ドキュメント数が一致しません（期待: {expected_count}件 / 実際: {count}件）")
+    if count == 0:
+        raise ValueError("ドキュメントが1件もありません")
+    
+    results = vectorstore.similarity_search(sample_query, k=min(3, count))
+    if not results:
+        raise ValueError(f"サンプル検索の結果が空です: {sample_query}")
+    return results
 
-def split_vendor_data(text: str) -> list[Document]:
-    """ベンダー情報をMarkdownヘッダーで分割"""
-    try:
-        # 正規表現でベンダーセクションを分割
-        import re
-        vendor_sections = re.split(r'(?=### ベンダー \d+:)', text.strip())
-        
-        # 空のセクションを除外
-        vendor_sections = [section.strip() for section in vendor_sections if section.strip()]
-        
-        # Documentオブジェクトに変換
-        documents = []
-        for i, section in enumerate(vendor_sections):
-            if section.startswith('### ベンダー'):
-                doc = Document(
-                    page_content=section,
-                    metadata={"vendor_index": i + 1}
-                )
-                documents.append(doc)
-        
-        print(f"分割されたベンダー数: {len(documents)}")
-        return documents
-    except Exception as e:
-        raise Exception(f"テキスト分割エラー: {e}")
+def load_existing_hashes(vectorstore) -> dict[str, str]:
+    """既存ベクトルDBのドキュメントID→内容ハッシュを取得"""
+    existing = vectorstore._collection.get(include=["metadatas"])
+    hashes = {}
+    for doc_id, metadata in zip(existing["ids"], existing["metadatas"]):
+        # 旧形式（ハッシュなし）のドキュメントは空文字として扱い、更新対象にする
+        hashes[doc_id] = (metadata or {}).get("content_hash", "")
+    return hashes
 
-def initialize_vectorstore(persist_directory: str):
-    """ベクトルストアの初期化（既存データの削除）"""
-    if os.path.exists(persist_directory):
-        print(f"既存のベクトルDBを削除中: {persist_directory}")
-        shutil.rmtree(persist_directory)
-    
-    os.makedirs(persist_directory, exist_ok=True)
-    print(f"ベクトルDBディレクトリを作成: {persist_directory}")
+def plan_incremental_update(documents: list[Document], existing_hashes: dict[str, str]) -> dict:
+    """
+    ドキュメントのバッチと既存ハッシュを比較し、差分を算出
+    
+    Returns:
+        added / updated（Documentリスト）、unchanged（件数）を持つ辞書
+    """
+    added, updated = [], []
+    unchanged = 0
+    
+    for doc in documents:
+        vendor_id = doc.metadata["vendor_id"]
+        if vendor_id not in existing_hashes:
+            added.append(doc)
+        elif existing_hashes[vendor_id] != doc.metadata["content_hash"]:
+            updated.append(doc)
+        else:
+            unchanged += 1
+    
+    return {
+        "added": added,
+        "updated": updated,
+        "unchanged": unchanged
+    }
 
-def create_vectorstore(documents: list[Document], persist_directory: str, embeddings):
-    """ベクトルストアの作成と保存"""
-    try:
-        print("ベクトルDBにドキュメントを保存中...")
-        vectorstore = Chroma.from_documents(
-            documents=documents,
-            embedding=embeddings,
-            persist_directory=persist_directory
-        )
-        
-        # 永続化
-        vectorstore.persist()
-        print(f"ベクトルDBの保存が完了しました: {persist_directory}")
+def sync_vectorstore(vectorstore, document_batches, existing_hashes: dict[str, str]) -> dict:
+    """
+    ドキュメントのバッチを順に受け取り、ベクトルストアへ差分を反映
+    
+    新規・変更分のみバッチ単位で埋め込み・書き込みし（同一IDはupsertで置き換え）、
+    最後まで出現しなかった既存IDを削除する。バッチごとに書き込むため、
+    中断しても書き込み済みの分は次回の差分更新で「変更なし」として扱われる。
+    
+    Args:
+        vectorstore: 書き込み先のChromaベクトルストア
+        document_batches: Documentリストのイテレータ
+        existing_hashes: 既存のドキュメントID→内容ハッシュ（全件再構築時は空）
         
-        # 保存されたドキュメント数の確認
-        collection = vectorstore._collection
-        count = collection.count()
-        print(f"保存されたドキュメント数: {count}")
+    Returns:
+        added / updated / deleted / unchanged の件数
+    """
+    counts = {"added": 0, "updated": 0, "deleted": 0, "unchanged": 0}
+    seen_ids = set()
+    
+    for documents in document_batches:
+        plan = plan_incremental_update(documents, existing_hashes)
+        seen_ids.update(doc.metadata["vendor_id"] for doc in documents)
         
-        return vectorstore
+        changed = plan["added"] + plan["updated"]
+        if changed:
+            vectorstore.add_documents(changed, ids=[doc.metadata["vendor_id"] for doc in changed])
         
-    except Exception as e:
-        raise Exception(f"ベクトルDB作成エラー: {e}")
+        counts["added"] += len(plan["added"])
+        counts["updated"] += len(plan["updated"])
+        counts["unchanged"] += plan["unchanged"]
+        print(f"  処理済み: {len(seen_ids)}件（埋め込み {counts['added'] + counts['updated']}件）")
+    
+    deleted = [doc_id for doc_id in existing_hashes if doc_id not in seen_ids]
+    for start in range(0, len(deleted), 1000):
+        vectorstore.delete(ids=deleted[start:start + 1000])
+    counts["deleted"] = len(deleted)
+    
+    return counts
+
+def iter_collection_pages(vectorstore, include: list[str], page_size: int = 1000):
+    """ベクトルストアの全ドキュメントをページ単位で読み出して返す（collection.get の結果）"""
+    collection = vectorstore._collection
+    offset = 0
+    while True:
+        page = collection.get(include=include, limit=page_size, offset=offset)
+        if not page["ids"]:
+            break
+        yield page
+        offset += len(page["ids"])
+
+def iter_index_records(vectorstore, page_size: int = 1000):
+    """ベクトルストアの全ドキュメントの (ID, メタデータ) を返す"""
+    for page in iter_collection_pages(vectorstore, ["metadatas"], page_size):
+        for doc_id, metadata in zip(page["ids"], page["metadatas"]):
+            yield doc_id, metadata or {}
+
+def export_numpy_store(vectorstore, index_path: str) -> int:
+    """
+    書き込み済みのベクトルストアの内容（埋め込みを含む）をNumPy形式で書き出す
+    
+    Returns:
+        書き出した件数
+    """
+    def records():
+        for page in iter_collection_pages(vectorstore, ["documents", "metadatas", "embeddings"]):
+            for doc_id, content, metadata, vector in zip(
+                page["ids"], page["documents"], page["metadatas"], page["embeddings"]
+            ):
+                yield doc_id, content, metadata or {}, vector
+    
+    return write_numpy_store(index_path, records(), vectorstore._collection.count())
+
+def build_sidecar_indexes(vectorstore, index_path: str) -> dict:
+    """
+    書き込み済みのベクトルストアから補助インデックスを構築し、バージョンのディレクトリに保存
+    
+    差分更新でも全件から作り直すため、ベクトルストアの内容と常に一致する。
+    
+    Returns:
+        インデックス名 → 件数
+    """
+    lexical_index = LexicalIndex.build(iter_index_records(vectorstore))
+    lexical_index.save(index_path)
+    filter_index = FilterIndex.build(iter_index_records(vectorstore))
+    filter_index.save(index_path)
+    alias_index = AliasIndex.build(iter_index_records(vectorstore))
+    alias_index.save(index_path)
+    return {"lexical": len(lexical_index), "filter": len(filter_index), "alias": len(alias_index)}
+
+def setup_argument_parser():
+    """コマンドライン引数の設定"""
+    parser = argparse.ArgumentParser(description="ベンダー情報ベクトルDB構築")
+    parser.add_argument(
+        "--input",
+        nargs="+",
+        default=["../../ベンダー調査.md"],
+        help="入力Markdown（ファイル・ディレクトリ・globパターンを複数指定可）"
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=min(4, os.cpu_count() or 1),
+        help="解析に使うプロセス数（1でプロセス内解析）"
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="公開中のバージョンを引き継がず、空の状態から全件を構築（デフォルトは差分更新）"
+    )
+    parser.add_argument(
+        "--keep-versions",
+        type=int,
+        default=3,
+        help="ロールバック用に保持する公開済みバージョン数（デフォルト: 3）"
+    )
+    parser.add_argument(
+        "--rollback",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="VERSION",
+        help="取り込みを行わず、公開中のバージョンを切り替える（省略時は1つ前）"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["chroma", "numpy", "both"],
+        default="chroma",
+        help="公開するインデックスの形式（numpy: メモリマップした行列による厳密検索。デフォルト: chroma）"
+    )
+    parser.add_argument(
+        "--list-versions",
+        action="store_true",
+        help="構築済みのバージョン一覧を表示"
+    )
+    
+    # 埋め込みパイプラインの設定
+    parser.add_argument("--batch-size", type=int, default=100, help="1リクエストあたりの埋め込みテキスト数（デフォルト: 100）")
+    parser.add_argument("--max-workers", type=int, default=4, help="埋め込みリクエストの同時実行数（デフォルト: 4）")
+    parser.add_argument("--rpm", type=int, default=3000, help="1分あたりのリクエスト数上限（デフォルト: 3000）")
+    parser.add_argument("--tpm", type=int, default=1_000_000, help="1分あたりのトークン数上限（デフォルト: 1000000）")
+    parser.add_argument("--max-retries", type=int, default=6, help="429/5xx時のリトライ回数（デフォルト: 6）")
+    parser.add_argument("--write-batch-size", type=int, default=1000, help="解析・埋め込み・書き込みのバッチ件数（デフォルト: 1000）")
+    parser.add_argument("--base-url", type=str, default=None, help="OpenAI APIのベースURL（フェイクサーバー検証用）")
+    parser.add_argument("--no-cache", action="store_true", help="埋め込みキャッシュを使用しない")
+    parser.add_argument("--strict", action="store_true", help="フィールドの解析エラー・未記入項目があれば中断")
+    return parser
+
+def show_versions(root: str):
+    """構築済みバージョンの一覧を表示"""
+    current = read_current_version(root)
+    versions = list_versions(root)
+    if not versions:
+        print("構築済みのバージョンはありません。")
+        return
+    for version in versions:
+        manifest = read_manifest(version_path(root, version))
+        marker = "*" if version == current else " "
+        print(f"{marker} {version}  {manifest.get('status', '-')}  "
+              f"ドキュメント数: {manifest.get('document_count', '-')}")
 
 def main():
     """メイン処理"""
-    print("=== ベンダー情報ベクトルDB構築開始 ===")
+    args = setup_argument_parser().parse_args()
     
     # 設定
-    DATA_FILE = "../../ベンダー調査.md"
     VECTORDB_DIR = "vectordb"
     
+    if args.list_versions:
+        show_versions(VECTORDB_DIR)
+        return 0
+    
+    if args.rollback is not None:
+        try:
+            version = rollback(VECTORDB_DIR, args.rollback or None)
+            print(f"公開中のバージョンを切り替えました: {version}")
+            return 0
+        except Exception as e:
+            print(f"エラーが発生しました: {e}")
+            return 1
+    
+    print("=== ベンダー情報ベクトルDB構築開始 ===")
+    
+    staging_version = None
     try:
         # 1. 環境変数の読み込み
         print("1. 環境変数の読み込み...")
         api_key = load_environment()
         
-        # 2. Markdownファイルの読み込み
-        print("2. Markdownファイルの読み込み...")
-        text = read_markdown_file(DATA_FILE)
-        print(f"読み込み完了: {len(text)} 文字")
-        
-        # 3. ベンダー情報の分割
-        print("3. ベンダー情報の分割...")
-        documents = split_vendor_data(text)
+        # 2. 入力ファイルの解決（内容はストリーミングで読み込む）
+        print("2. 入力ファイルの確認...")
+        input_files = resolve_input_files(args.input)
+        for path in input_files:
+            print(f"  - {path}")
         
-        # 4. ベクトルストアの初期化
-        print("4. ベクトルストアの初期化...")
-        initialize_vectorstore(VECTORDB_DIR)
+        # 3. ステージング用バージョンの作成
+        # 公開中のインデックスには一切書き込まず、複製（差分更新）または空のディレクトリに構築する
+        base_path = None
+        if not args.full:
+            try:
+                base_path, base_version = resolve_index_path(VECTORDB_DIR)
+                print(f"3. 公開中のインデックスを元に差分更新します: {base_version or '旧形式'}")
+            except FileNotFoundError:
+                base_path = None
+        if base_path is None:
+            print("3. 空のインデックスから構築します...")
+        staging_version, staging_path = create_staging_version(VECTORDB_DIR, base=base_path)
+        print(f"ステージング: {staging_path}")
         
-        # 5. OpenAI Embeddingsの初期化
-        print("5. OpenAI Embeddingsの初期化...")
-        embeddings = OpenAIEmbeddings(
+        # 4. 埋め込みパイプラインの初期化
+        # チェックポイント・キャッシュはバージョンをまたいで再利用するため vectordb の外に置く
+        print("4. 埋め込みパイプラインの初期化...")
+        pipeline = EmbeddingPipeline(
+            api_key=api_key,
             model="text-embedding-ada-002",
-            openai_api_key=api_key
+            base_url=args.base_url,
+            batch_size=args.batch_size,
+            max_workers=args.max_workers,
+            requests_per_minute=args.rpm,
+            tokens_per_minute=args.tpm,
+            max_retries=args.max_retries,
+            checkpoint_path=f"{VECTORDB_DIR}.embedding_checkpoint"
         )
+        # 永続キャッシュを挟み、内容が同じベンダーは再構築時も再計算しない
+        embedding_cache = None
+        embeddings = pipeline
+        if not args.no_cache:
+            embedding_cache = EmbeddingCache(default_cache_path(VECTORDB_DIR))
+            embeddings = CachedEmbeddings(pipeline, embedding_cache, model="text-embedding-ada-002")
+        if len(pipeline.checkpoint):
+            print(f"チェックポイントから再開します: {len(pipeline.checkpoint)}件の埋め込みを再利用")
         
-        # 6. ベクトルストアの作成と保存
-        print("6. ベクトルストアの作成と保存...")
-        vectorstore = create_vectorstore(documents, VECTORDB_DIR, embeddings)
+        # 5. 解析・埋め込み・書き込みをバッチ単位でストリーミング処理
+        print("5. ベンダー情報の解析とベクトルDBへの書き込み...")
+        if base_path and not has_chroma_store(staging_path):
+            # NumPy形式のみで公開されたバージョンからの更新は全件を書き込む（埋め込みはキャッシュから再利用）
+            print("公開中のバージョンにChroma形式がないため、全件を書き込みます")
+        vectorstore = Chroma(
+            persist_directory=staging_path,
+            embedding_function=embeddings
+        )
+        existing_hashes = load_existing_hashes(vectorstore) if base_path else {}
+        parse_stats = {}
+        document_batches = iter_document_batches(
+            input_files,
+            batch_size=args.write_batch_size,
+            workers=args.parse_workers,
+            strict=args.strict,
+            stats=parse_stats
+        )
+        counts = sync_vectorstore(vectorstore, document_batches, existing_hashes)
+        vectorstore.persist()
+        
+        print(f"解析されたベンダー数: {parse_stats['documents']}（問題 {parse_stats['problems']}件）")
+        print(f"追加: {counts['added']}件 / 更新: {counts['updated']}件 / "
+              f"削除: {counts['deleted']}件 / 変更なし: {counts['unchanged']}件")
+        
+        # 完了したのでチェックポイントを削除
+        pipeline.checkpoint.clear()
+        print(f"埋め込み統計: {pipeline.stats}")
+        if embedding_cache is not None:
+            print(f"埋め込みキャッシュ: {embedding_cache.stats()}")
+        
+        # 6. 補助インデックス（キーワード検索用のn-gram転置インデックス・絞り込み用ビットマップ）の構築
+        print("6. 補助インデックスの構築...")
+        sidecar_counts = build_sidecar_indexes(vectorstore, staging_path)
+        print(f"キーワード検索用インデックス: {sidecar_counts['lexical']}件 / "
+              f"絞り込み用インデックス: {sidecar_counts['filter']}件 / "
+              f"ベンダー名辞書: {sidecar_counts['alias']}表記")
+        if args.backend in ("numpy", "both"):
+            numpy_count = export_numpy_store(vectorstore, staging_path)
+            print(f"NumPy形式のインデックス: {numpy_count}件")
+        
+        # 7. 検証（ドキュメント数・サンプル検索）
+        print("7. インデックスの検証...")
+        test_query = "契約書管理"
+        results = validate_index(vectorstore, parse_stats["documents"], test_query)
+        if args.backend in ("numpy", "both"):
+            numpy_backend = open_backend(staging_path, embeddings, backend="numpy")
+            if numpy_backend.count() != parse_stats["documents"]:
+                raise ValueError(f"NumPy形式のドキュメント数が一致しません（実際: {numpy_backend.count()}件）")
+            if not numpy_backend.similarity_search(test_query, k=1):
+                raise ValueError(f"NumPy形式のサンプル検索の結果が空です: {test_query}")
+        if args.backend == "numpy":
+            # NumPy形式のみで公開する場合、構築に使ったChromaのファイルは残さない
+            remove_chroma_store(staging_path)
+        print(f"保存されたドキュメント数: {parse_stats['documents']}")
+        
+        # 8. 公開（CURRENT のアトミックな切り替え）と古いバージョンの整理
+        print("8. インデックスの公開...")
+        manifest = read_manifest(staging_path)
+        manifest.update({
+            "document_count": parse_stats["documents"],
+            "inputs": input_files,
+            "counts": counts,
+            "sidecars": sidecar_counts,
+            "backends": {"chroma": ["chroma"], "numpy": ["numpy"], "both": ["chroma", "numpy"]}[args.backend]
+        })
+        write_manifest(staging_path, manifest)
+        publish_version(VECTORDB_DIR, staging_version)
+        print(f"公開中のバージョン: {staging_version}")
+        
+        pruned = prune_versions(VECTORDB_DIR, keep=args.keep_versions)
+        if pruned:
+            print(f"古いバージョンを削除しました: {', '.join(pruned)}")
         
         print("=== ベクトルDB構築完了 ===")
-        print(f"保存先: {os.path.abspath(VECTORDB_DIR)}")
+        print(f"保存先: {os.path.abspath(staging_path)}")
         
-        # 7. 動作確認（サンプル検索）
+        # 動作確認（サンプル検索の結果表示）
         print("\n=== 動作確認 ===")
-        test_query = "契約書管理"
         print(f"テスト検索クエリ: '{test_query}'")
-        
-        results = vectorstore.similarity_search(test_query, k=3)
         for i, doc in enumerate(results, 1):
             print(f"\n結果 {i}:")
             print(f"内容: {doc.page_content[:200]}...")
@@ -153,6 +414,10 @@ def main():
         
     except Exception as e:
         print(f"エラーが発生しました: {e}")
+        # 公開前のステージングは破棄し、公開中のインデックスはそのまま残す
+        if staging_version and staging_version != read_current_version(VECTORDB_DIR):
+            discard_version(VECTORDB_DIR, staging_version)
+            print(f"ステージングを破棄しました: {staging_version}（公開中のインデックスは変更されていません）")
         return 1
     
     return 0
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+日本語向け文字n-gram転置インデックス（BM25）
+取り込み時にベンダー項目から構築してインデックスのバージョンと一緒に保存し、
+検索時はベクトル検索の結果と Reciprocal Rank Fusion で統合する
+"""
+
+import os
+import re
+import json
+import math
+import unicodedata
+from collections import Counter, defaultdict
+from typing import Iterable, Optional
+
+LEXICAL_INDEX_FILE = "lexical_index.json"
+
+# 索引対象の項目と重み（重みの回数だけ語を数える簡易的なフィールド重み付け）
+FIELD_WEIGHTS = {
+    "name": 3,
+    "aliases": 3,
+    "category": 2,
+    "industry_tags": 2,
+    "tech_stack": 1,
+    "strengths": 1,
+    "service_summary": 1,
+    "description": 1,
+}
+
+NGRAM_SIZES = (2, 3)
+
+_IGNORED_CHARS = re.compile(r"[\s\W_]+", re.UNICODE)
+
+def normalize_for_index(text: str) -> str:
+    """索引用の正規化（NFKC・小文字化・記号と空白の除去）"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return _IGNORED_CHARS.sub(" ", text)
+
+def char_ngrams(text: str, sizes: tuple = NGRAM_SIZES) -> list[str]:
+    """
+    文字n-gramに分割
+
+    記号・空白で区切った各断片の中でn-gramを作る（断片をまたぐn-gramは作らない）。
+    最小サイズより短い断片はそのまま1語として扱う。
+    """
+    grams = []
+    for segment in normalize_for_index(text).split():
+        if len(segment) < min(sizes):
+            grams.append(segment)
+            continue
+        for n in sizes:
+            grams.extend(segment[i:i + n] for i in range(len(segment) - n + 1))
+    return grams
+
+class LexicalIndex:
+    """BM25でスコアリングする文字n-gram転置インデックス"""
+
+    def __init__(self, ids: list[str], doc_lengths: list[int], postings: dict, k1: float = 1.2, b: float = 0.75):
+        """
+        初期化（通常は build() または load() から生成）
+
+        Args:
+            ids: 文書番号 → ベンダーID
+            doc_lengths: 文書番号 → 語数
+            postings: n-gram → [[文書番号, 出現回数], ...]
+            k1, b: BM25のパラメータ
+        """
+        self.ids = ids
+        self.doc_lengths = doc_lengths
+        self.postings = postings
+        self.k1 = k1
+        self.b = b
+        self.average_length = (sum(doc_lengths) / len(doc_lengths)) if doc_lengths else 0.0
+        self._id_to_doc = {vendor_id: i for i, vendor_id in enumerate(ids)}
+
+    @classmethod
+    def build(cls, records: Iterable[tuple[str, dict]]) -> "LexicalIndex":
+        """
+        (ベンダーID, メタデータ) の列からインデックスを構築
+
+        Args:
+            records: ベンダーIDと vendor_fields 形式のメタデータの組
+        """
+        ids, doc_lengths = [], []
+        postings = defaultdict(list)
+        for vendor_id, metadata in records:
+            counts = Counter()
+            for field, weight in FIELD_WEIGHTS.items():
+                for gram in char_ngrams(str(metadata.get(field) or "")):
+                    counts[gram] += weight
+            doc = len(ids)
+            ids.append(vendor_id)
+            doc_lengths.append(sum(counts.values()))
+            for gram, tf in counts.items():
+                postings[gram].append([doc, tf])
+        return cls(ids, doc_lengths, dict(postings))
+
+    def save(self, directory: str):
+        """インデックスのディレクトリに保存"""
+        path = os.path.join(directory, LEXICAL_INDEX_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({
+                "ids": self.ids,
+                "doc_lengths": self.doc_lengths,
+                "postings": self.postings,
+            }, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["LexicalIndex"]:
+        """インデックスのディレクトリから読み込み（ファイルがない場合はNone）"""
+        path = os.path.join(directory, LEXICAL_INDEX_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["ids"], data["doc_lengths"], data["postings"])
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query: str, k: int = 10, candidate_ids: Optional[set] = None) -> list[tuple[str, float]]:
+        """
+        BM25で検索
+
+        Args:
+            query: 検索クエリ
+            k: 取得件数
+            candidate_ids: 対象を絞り込むベンダーIDの集合（Noneなら全件）
+
+        Returns:
+            (ベンダーID, スコア) のリスト（スコア降順）
+        """
+        total = len(self.ids)
+        if not total:
+            return []
+
+        candidates = None
+        if candidate_ids is not None:
+            candidates = {self._id_to_doc[v] for v in candidate_ids if v in self._id_to_doc}
+
+        scores = defaultdict(float)
+        for gram in set(char_ngrams(query)):
+            entries = self.postings.get(gram)
+            if not entries:
+                continue
+            idf = math.log(1 + (total - len(entries) + 0.5) / (len(entries) + 0.5))
+            for doc, tf in entries:
+                if candidates is not None and doc not in candidates:
+                    continue
+                norm = 1 - self.b + self.b * self.doc_lengths[doc] / self.average_length
+                scores[doc] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.ids[doc], score) for doc, score in ranked]
+
+def reciprocal_rank_fusion(rankings: list[list[str]], k: int = 60) -> list[tuple[str, float]]:
+    """
+    複数のランキングを Reciprocal Rank Fusion で統合
+
+    Args:
+        rankings: ベンダーIDのランキング（上位順）のリスト
+        k: RRFの定数（大きいほど下位の順位差が効きにくい）
+
+    Returns:
+        (ベンダーID, 統合スコア) のリスト（スコア降順）
+    """
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, vendor_id in enumerate(ranking, 1):
+            scores[vendor_id] += 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+テストの共通設定
+取り込みのモジュール（フラットな構成）を読み込めるようにし、フェイクOpenAI APIサーバーをテストごとに空いているポートで起動する
+"""
+
+import os
+import sys
+import threading
+
+import pytest
+
+INGEST_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, INGEST_DIR)
+
+import fake_openai_server  # noqa: E402
+
+@pytest.fixture
+def fake_server():
+    """フェイクOpenAI APIサーバー（server.options の値はテスト中に変更できる。base_url は /v1 までのURL）"""
+    options = fake_openai_server.setup_argument_parser().parse_args(["--port", "0", "--dim", "8", "--quiet"])
+    server = fake_openai_server.create_server("127.0.0.1", 0, options)
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
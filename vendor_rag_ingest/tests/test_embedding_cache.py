@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+埋め込みキャッシュ（embedding_cache.py）のテスト
+複数スレッドからのヒット・ミス数の集計と、最終アクセス時刻の更新を間引くことを確認する
+"""
+
+import time
+import threading
+
+from embedding_cache import ACCESS_UPDATE_INTERVAL, EmbeddingCache
+
+MODEL = "test-model"
+
+def _last_access(cache: EmbeddingCache, text: str) -> float:
+    return cache._conn.execute(
+        "SELECT last_access FROM embeddings WHERE key = ?", (cache.make_key(MODEL, text),)
+    ).fetchone()[0]
+
+def test_hits_and_misses_are_counted_across_threads(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+    cache.put_many(MODEL, ["あり"], [[0.5, 0.25]])
+
+    def worker():
+        for _ in range(50):
+            cache.get_many(MODEL, ["あり", "なし"])
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (400, 400)
+    assert cache.get_many(MODEL, ["あり", "なし"]) == [[0.5, 0.25], None]
+
+def test_last_access_is_updated_only_when_old(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"))
+    cache.put_many(MODEL, ["新しい", "古い"], [[1.0], [2.0]])
+    recent = _last_access(cache, "新しい")
+    old = time.time() - ACCESS_UPDATE_INTERVAL - 1
+    cache._conn.execute(
+        "UPDATE embeddings SET last_access = ? WHERE key = ?", (old, cache.make_key(MODEL, "古い"))
+    )
+    cache._conn.commit()
+
+    cache.get_many(MODEL, ["新しい", "古い"])
+
+    # 最近アクセスした行は書き込まず、古い行だけ更新する
+    assert _last_access(cache, "新しい") == recent
+    assert _last_access(cache, "古い") > old
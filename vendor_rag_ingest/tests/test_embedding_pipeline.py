@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+埋め込みパイプライン（embedding_pipeline.py）のテスト
+フェイクOpenAI APIサーバーに対して、バッチ分割・同時実行数・レート制限・リトライ・チェックポイントからの再開を確認する
+"""
+
+import time
+import threading
+
+import pytest
+
+import embedding_pipeline
+from embedding_pipeline import EmbeddingCheckpoint, EmbeddingPipeline, RateLimiter
+from fake_openai_server import fake_embedding
+
+TEXTS = [f"ベンダー{i}: 契約書管理クラウド" for i in range(25)]
+
+def _pipeline(server, **kwargs) -> EmbeddingPipeline:
+    return EmbeddingPipeline(api_key="dummy", base_url=server.base_url, **kwargs)
+
+def _assert_vectors(vectors, texts):
+    assert len(vectors) == len(texts)
+    for vector, text in zip(vectors, texts):
+        assert vector == pytest.approx(fake_embedding(text, 8), abs=1e-6)
+
+def test_texts_are_embedded_in_batches_in_input_order(fake_server):
+    pipeline = _pipeline(fake_server, batch_size=10)
+
+    vectors = pipeline.embed_documents(TEXTS)
+
+    _assert_vectors(vectors, TEXTS)
+    assert fake_server.stats["/v1/embeddings"] == 3
+    assert pipeline.stats["requests"] == 3
+    assert pipeline.stats["embedded"] == len(TEXTS)
+
+def test_concurrent_requests_are_capped_by_max_workers(fake_server):
+    fake_server.options.latency = 0.1
+    pipeline = _pipeline(fake_server, batch_size=4, max_workers=2)
+
+    # API呼び出しの同時実行数を記録する
+    create = pipeline.client.embeddings.create
+    lock = threading.Lock()
+    in_flight = [0]
+    peak = [0]
+
+    def counting_create(**kwargs):
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        try:
+            return create(**kwargs)
+        finally:
+            with lock:
+                in_flight[0] -= 1
+
+    pipeline.client.embeddings.create = counting_create
+    vectors = pipeline.embed_documents(TEXTS)
+
+    _assert_vectors(vectors, TEXTS)
+    assert fake_server.stats["/v1/embeddings"] == 7
+    assert peak[0] == 2
+
+def test_rate_limiter_waits_for_the_requests_per_minute_budget():
+    limiter = RateLimiter(requests_per_minute=120, tokens_per_minute=10_000_000)
+
+    started = time.perf_counter()
+    for _ in range(120):
+        limiter.acquire(1)
+    burst = time.perf_counter() - started
+    limiter.acquire(1)
+    waited = time.perf_counter() - started - burst
+
+    # 1分あたり120件 = 0.5秒に1件。バケットが空になるまでは待たない
+    assert burst < 0.2
+    assert 0.4 <= waited < 1.0
+
+def test_rate_limiter_waits_for_the_tokens_per_minute_budget():
+    limiter = RateLimiter(requests_per_minute=10_000, tokens_per_minute=60_000)
+    limiter.acquire(60_000)
+
+    started = time.perf_counter()
+    limiter.acquire(500)
+    waited = time.perf_counter() - started
+
+    # 1分あたり60,000トークン = 1秒あたり1,000トークン
+    assert 0.4 <= waited < 1.0
+
+def test_rate_limiter_caps_a_single_oversized_request():
+    limiter = RateLimiter(requests_per_minute=10, tokens_per_minute=1_000)
+
+    started = time.perf_counter()
+    limiter.acquire(1_000_000)
+
+    assert time.perf_counter() - started < 0.1
+
+def test_server_errors_are_retried_with_jittered_backoff(fake_server, monkeypatch):
+    fake_server.options.fail_rate = 1.0
+    sleeps = []
+    monkeypatch.setattr(embedding_pipeline.time, "sleep", sleeps.append)
+    pipeline = _pipeline(fake_server, max_retries=3)
+
+    with pytest.raises(Exception, match="4回試行"):
+        pipeline.embed_documents(TEXTS[:1])
+
+    assert fake_server.stats["/v1/embeddings"] == 4
+    assert pipeline.stats["retries"] == 3
+    # 指数バックオフ（1, 2, 4秒）に0.5〜1.5倍のジッター
+    assert len(sleeps) == 3
+    for attempt, delay in enumerate(sleeps):
+        assert 0.5 * 2 ** attempt <= delay <= 1.5 * 2 ** attempt
+
+def test_retry_delays_are_jittered():
+    pipeline = EmbeddingPipeline(api_key="dummy", base_url="http://127.0.0.1:9/v1")
+    error = RuntimeError("server error")
+
+    delays = {pipeline._retry_delay(3, error) for _ in range(20)}
+
+    assert len(delays) > 1
+    assert all(4.0 <= delay <= 12.0 for delay in delays)
+
+def test_rate_limit_responses_use_retry_after(fake_server, monkeypatch):
+    # 1分に1件までのため、2件目以降は Retry-After（約60秒）付きの429になる
+    fake_server.options.rpm = 1
+    sleeps = []
+    monkeypatch.setattr(embedding_pipeline.time, "sleep", sleeps.append)
+    pipeline = _pipeline(fake_server, max_retries=2)
+    pipeline.embed_query("契約書管理")
+
+    with pytest.raises(Exception, match="3回試行"):
+        pipeline.embed_query("チャットボット")
+
+    assert len(sleeps) == 2
+    assert all(59.0 <= delay <= 61.0 for delay in sleeps)
+
+def test_interrupted_run_resumes_from_checkpoint(fake_server, tmp_path):
+    checkpoint_path = str(tmp_path / "embeddings.ckpt")
+    texts = TEXTS[:20]
+
+    # 2バッチ目の後で429になり、リトライなしで中断する（1並列なので3・4バッチ目は保存されない）
+    fake_server.options.rpm = 2
+    interrupted = _pipeline(fake_server, batch_size=5, max_workers=1, max_retries=0, checkpoint_path=checkpoint_path)
+    with pytest.raises(Exception, match="埋め込みAPIの呼び出しに失敗しました"):
+        interrupted.embed_documents(texts)
+    assert len(EmbeddingCheckpoint(checkpoint_path)) == 10
+
+    # 書き込み途中で止まった末尾のレコードは読み込み時に切り詰める
+    with open(checkpoint_path, "ab") as f:
+        f.write(b"\x00" * 7)
+
+    fake_server.options.rpm = 0
+    requests_before = fake_server.stats["/v1/embeddings"]
+    resumed = _pipeline(fake_server, batch_size=5, max_workers=1, checkpoint_path=checkpoint_path)
+    vectors = resumed.embed_documents(texts)
+
+    _assert_vectors(vectors, texts)
+    assert resumed.stats["checkpoint_hits"] == 10
+    assert fake_server.stats["/v1/embeddings"] - requests_before == 2
+    assert len(resumed.checkpoint) == 20
+
+    resumed.checkpoint.clear()
+    assert len(EmbeddingCheckpoint(checkpoint_path)) == 0
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+インデックスのバージョン管理（index_manager.py）のテスト
+CURRENT の切り替えの検知が、読み込みに成功して commit() するまで確認済みにならないことを確認する
+"""
+
+from index_manager import IndexPointer, create_staging_version, publish_version
+
+def _publish(root: str) -> str:
+    version, _ = create_staging_version(root)
+    publish_version(root, version)
+    return version
+
+def test_pointer_reports_change_until_committed(tmp_path):
+    root = str(tmp_path)
+    _publish(root)
+    pointer = IndexPointer(root)
+
+    # 最初の確認は必ず読み込みが必要
+    stat_key = pointer.changed()
+    assert stat_key is not None
+    pointer.commit(stat_key)
+    assert pointer.changed() is None
+
+    # 読み込みに失敗して commit() しなければ、次の確認でも切り替えを報告する
+    _publish(root)
+    failed = pointer.changed()
+    assert failed is not None
+    assert pointer.changed() == failed
+
+    pointer.commit(failed)
+    assert pointer.changed() is None
+
+def test_pointer_without_current_is_loaded_once(tmp_path):
+    # 旧形式（CURRENT なし）でも最初の1回だけ読み込む
+    pointer = IndexPointer(str(tmp_path))
+
+    stat_key = pointer.changed()
+    assert stat_key is not None
+    pointer.commit(stat_key)
+    assert pointer.changed() is None
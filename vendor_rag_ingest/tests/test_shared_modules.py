@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+3つのパッケージで共有するモジュールのテスト
+登録側・アプリ・CLIはそれぞれ単独で動かすため同じモジュールを複製して持っている。
+片方だけ変更されて内容がずれた場合に失敗させる（登録側の内容が正）
+"""
+
+import os
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+INGEST_DIR = os.path.join(ROOT_DIR, "vendor_rag_ingest")
+APP_DIR = os.path.join(ROOT_DIR, "vendor_rag_app")
+QUERY_DIR = os.path.join(ROOT_DIR, "vendor_rag_query", "utils")
+
+# 3つのパッケージすべてにあるモジュール（インデックスの形式・ベンダー項目・埋め込みキャッシュを共有する）
+SHARED_MODULES = [
+    "embedding_cache.py",
+    "vendor_fields.py",
+    "index_manager.py",
+    "lexical_index.py",
+    "filter_index.py",
+    "vector_backends.py",
+    "alias_index.py",
+    "context_builder.py",
+]
+
+# 検索側（アプリ・CLI）だけにあるモジュール（アプリの内容が正）
+QUERY_SHARED_MODULES = [
+    "openai_transport.py",
+]
+
+def _read(directory: str, name: str) -> bytes:
+    with open(os.path.join(directory, name), "rb") as f:
+        return f.read()
+
+@pytest.mark.parametrize("name", SHARED_MODULES)
+@pytest.mark.parametrize("directory", [APP_DIR, QUERY_DIR], ids=["vendor_rag_app", "vendor_rag_query"])
+def test_shared_module_matches_ingest_copy(name, directory):
+    assert _read(directory, name) == _read(INGEST_DIR, name), \
+        f"{os.path.relpath(os.path.join(directory, name), ROOT_DIR)} が vendor_rag_ingest/{name} と異なります"
+
+@pytest.mark.parametrize("name", QUERY_SHARED_MODULES)
+def test_query_shared_module_matches_app_copy(name):
+    assert _read(QUERY_DIR, name) == _read(APP_DIR, name), \
+        f"vendor_rag_query/utils/{name} が vendor_rag_app/{name} と異なります"
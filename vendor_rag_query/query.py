@@ -6,11 +6,21 @@ CLIで質問を受け取り、ベクトルDBから関連ベンダーを検索し
 """
 
 import sys
+import json
 import argparse
 import os
+import time
+import asyncio
+import contextlib
 from dotenv import load_dotenv
-from utils.retriever import VendorRetriever
-from utils.formatter import VendorResponseFormatter
+from utils.retriever import VendorRetriever, SEARCH_TYPES, BACKENDS
+from utils.filter_index import parse_filter_args
+from utils.formatter import VendorResponseFormatter, RENDERERS
+from utils.context_builder import count_tokens
+from utils.openai_transport import get_transport
+
+# API呼び出しの段階の表示名
+STAGE_LABELS = {"embedding": "埋め込み", "chat": "回答生成"}
 
 def load_environment():
     """環境変数の読み込み"""
@@ -39,13 +49,49 @@ def setup_argument_parser():
   python query.py "契約書管理系のベンダーは？"
   python query.py "製造業向けの画像認識AIベンダーは？" --k 3
   python query.py "医療系のベンダーを教えて" --no-mmr
+  python query.py "ハブルの概要は？" --search hybrid
+  python query.py "契約書管理系のベンダーは？" --fetch-k 200 --lambda-mult 0.5
+  python query.py "検品を自動化したい" --filter 業界タグ=製造業 --filter デプロイ方式=SaaS --filter 価格帯=低
+  python query.py --batch questions.txt --output answers.jsonl --concurrency 8
+  cat questions.txt | python query.py --batch - > answers.jsonl
         """
     )
     
     parser.add_argument(
         "question",
         type=str,
-        help="検索したい質問"
+        nargs="?",
+        help="検索したい質問（--batch を指定した場合は不要）"
+    )
+    
+    parser.add_argument(
+        "--batch",
+        type=str,
+        default=None,
+        metavar="FILE",
+        help="1行に1つの質問を書いたファイルをまとめて処理（- で標準入力。空行と#で始まる行は無視）"
+    )
+    
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="-",
+        metavar="FILE",
+        help="一括処理の結果（JSON Lines）の出力先（デフォルト: - で標準出力）"
+    )
+    
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=64,
+        help="一括処理で1回にまとめて検索する質問数（デフォルト: 64）"
+    )
+    
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="一括処理で同時に待つ回答生成の数（デフォルト: 4）"
     )
     
     parser.add_argument(
@@ -58,7 +104,46 @@ def setup_argument_parser():
     parser.add_argument(
         "--no-mmr",
         action="store_true",
-        help="MMR検索を無効にして類似度検索を使用"
+        help="MMR検索を無効にして類似度検索を使用（--search similarity と同じ）"
+    )
+    
+    parser.add_argument(
+        "--search",
+        type=str,
+        default=None,
+        choices=SEARCH_TYPES,
+        help="検索方法（mmr / similarity / hybrid、デフォルト: mmr）"
+    )
+    
+    parser.add_argument(
+        "--fetch-k",
+        type=int,
+        default=None,
+        help="MMRで多様性を考慮する候補数（デフォルト: max(k*4, 20)。数百〜1000も可）"
+    )
+    
+    parser.add_argument(
+        "--lambda-mult",
+        type=float,
+        default=0.7,
+        help="MMRの関連性の重み（1で関連性のみ、0で多様性のみ。デフォルト: 0.7）"
+    )
+    
+    parser.add_argument(
+        "--backend",
+        type=str,
+        default="auto",
+        choices=BACKENDS,
+        help="ベクトル検索のバックエンド（auto: NumPy形式があれば優先、デフォルト: auto）"
+    )
+    
+    parser.add_argument(
+        "--filter",
+        action="append",
+        default=[],
+        metavar="項目=値",
+        help="絞り込み条件（項目: カテゴリ / 業界タグ / 価格帯 / デプロイ方式 / 面談状況、"
+             "カンマ区切りでいずれかに一致。複数指定はすべてに一致）"
     )
     
     parser.add_argument(
@@ -69,6 +154,37 @@ def setup_argument_parser():
         help="使用するLLMモデル（デフォルト: gpt-3.5-turbo）"
     )
     
+    parser.add_argument(
+        "--renderer",
+        type=str,
+        default="llm",
+        choices=RENDERERS,
+        help="回答の作成方法（llm: LLMで生成 / compact: LLMはベンダーIDと選定理由だけを生成し、項目は転記 / "
+             "template: LLMを使わず検索結果の項目を回答形式に転記。デフォルト: llm）"
+    )
+    
+    parser.add_argument(
+        "--context-tokens",
+        type=int,
+        default=None,
+        help="LLMに渡すベンダー情報のトークン数の上限（デフォルト: gpt-3.5-turbo は1500、gpt-4 は2500。"
+             "環境変数 VENDOR_RAG_CONTEXT_TOKENS でも指定可）"
+    )
+    
+    parser.add_argument(
+        "--map-reduce-k",
+        type=int,
+        default=None,
+        help="この件数より多く検索した場合は、ベンダーを分けて並列に選定してからまとめる分割生成で回答"
+             "（デフォルト: 10。環境変数 VENDOR_RAG_MAP_REDUCE_K でも指定可）"
+    )
+    
+    parser.add_argument(
+        "--no-stream",
+        action="store_true",
+        help="回答を生成し終えてからまとめて表示（デフォルトは生成されたトークンから順に表示。一括処理では常にまとめて出力）"
+    )
+    
     parser.add_argument(
         "--vectordb",
         type=str,
@@ -78,12 +194,129 @@ def setup_argument_parser():
     
     return parser
 
+def read_questions(path: str) -> list:
+    """一括処理の質問を読み込み（空行と#で始まる行は無視）"""
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith("#")]
+
+async def run_batch(args, filters: dict, api_key: str, retriever: VendorRetriever, search_type: str, output) -> int:
+    """
+    質問ファイルをまとめて処理し、1質問1行のJSON Linesで出力
+    
+    検索は batch_size 件ずつ asearch_many でまとめて行い（埋め込みは1回のバッチリクエスト）、
+    回答生成は非同期クライアントで concurrency 件まで同時に待つ（スレッドは使わない）。
+    出力は入力と同じ順序。
+    
+    Returns:
+        終了コード（1件でも失敗があれば1）
+    """
+    questions = read_questions(args.batch)
+    print(f"一括処理する質問数: {len(questions)}")
+    if not questions:
+        return 0
+    
+    formatter = VendorResponseFormatter(
+        api_key=api_key,
+        model=args.model,
+        context_tokens=args.context_tokens,
+        map_reduce_documents=args.map_reduce_k
+    )
+    semaphore = asyncio.Semaphore(max(args.concurrency, 1))
+    
+    async def generate(index: int, question: str, documents: list) -> dict:
+        record = {
+            "index": index,
+            "question": question,
+            "vendor_ids": [doc.metadata.get("vendor_id") for doc in documents],
+        }
+        if not documents:
+            record["error"] = "絞り込み条件に一致するベンダーが見つかりませんでした。" if filters else "検索結果が見つかりませんでした。"
+            return record
+        if args.renderer == "template":
+            record["response"] = formatter.render_template(question, documents)
+            return record
+        async with semaphore:
+            try:
+                if formatter.use_map_reduce(documents):
+                    record["response"], _, _ = await formatter.aformat_map_reduce(question, documents)
+                elif args.renderer == "compact":
+                    record["response"], _ = await formatter.aformat_compact(question, documents)
+                else:
+                    record["response"] = await formatter.aformat_response(question, documents)
+            except Exception as e:
+                record["error"] = str(e)
+        return record
+    
+    failures = 0
+    batch_size = max(args.batch_size, 1)
+    for start in range(0, len(questions), batch_size):
+        chunk = questions[start:start + batch_size]
+        results = await retriever.asearch_many(
+            queries=chunk,
+            k=args.k,
+            search_type=search_type,
+            filters=filters,
+            fetch_k=args.fetch_k,
+            lambda_mult=args.lambda_mult
+        )
+        records = await asyncio.gather(*(
+            generate(start + i, question, documents)
+            for i, (question, documents) in enumerate(zip(chunk, results))
+        ))
+        for record in records:
+            failures += "error" in record
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        output.flush()
+        print(f"{start + len(chunk)}/{len(questions)} 件を処理しました")
+    
+    if failures:
+        print(f"回答を生成できなかった質問: {failures}件")
+    print_transport_stats()
+    return 1 if failures else 0
+
+def print_transport_stats():
+    """API呼び出しの接続の再利用・リトライ・タイムアウトの統計を表示"""
+    stats = get_transport().stats()
+    if not any(stage["requests"] for stage in stats["stages"].values()):
+        return
+    print(f"API接続: 新規 {stats['connections_opened']}回 / 再利用 {stats['connections_reused']}回")
+    for stage, stage_stats in stats["stages"].items():
+        if stage_stats["requests"]:
+            print(f"  {STAGE_LABELS[stage]}: {stage_stats['requests']}件（リトライ {stage_stats['retries']}回・"
+                  f"タイムアウト {stage_stats['timeouts']}回・接続待ち {stage_stats['pool_timeouts']}回・停止中で中止 {stage_stats['rejected']}件、"
+                  f"応答 p95 {stage_stats['latency_p95']:.2f}秒）")
+
 def main():
     """メイン処理"""
     # 引数解析
     parser = setup_argument_parser()
     args = parser.parse_args()
     
+    try:
+        filters = parse_filter_args(args.filter)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    if args.batch is None and not args.question:
+        parser.error("質問を指定するか、--batch で質問ファイルを指定してください")
+    
+    if args.batch is not None:
+        # 一括処理では標準出力を結果専用にし、進捗表示は標準エラー出力に出す
+        output = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+        try:
+            with contextlib.redirect_stdout(sys.stderr):
+                return run(args, filters, output)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+    return run(args, filters)
+
+def run(args, filters: dict, output=None) -> int:
+    """検索＆回答生成の実行（output を指定した場合は一括処理）"""
     try:
         print("=== ベンダー情報検索＆回答生成開始 ===")
         
@@ -95,7 +328,8 @@ def main():
         print("2. ベクトルDBの読み込み...")
         retriever = VendorRetriever(
             vectordb_path=args.vectordb,
-            api_key=api_key
+            api_key=api_key,
+            backend=args.backend
         )
         
         # ベクトルDB内のドキュメント数を確認
@@ -108,35 +342,98 @@ def main():
         
         # 3. ベンダー情報の検索
         print("3. ベンダー情報の検索...")
-        print(f"質問: {args.question}")
-        print(f"検索方法: {'MMR' if not args.no_mmr else '類似度検索'}")
+        search_type = args.search or ("similarity" if args.no_mmr else "mmr")
+        search_labels = {"mmr": "MMR", "similarity": "類似度検索", "hybrid": "ハイブリッド（キーワード＋ベクトル）"}
+        print(f"検索方法: {search_labels[search_type]}")
         print(f"取得件数: {args.k}")
+        if filters:
+            conditions = [f"{field}={'/'.join(values)}" for field, values in filters.items()]
+            print(f"絞り込み: {', '.join(conditions)}")
+        
+        if output is not None:
+            status = asyncio.run(run_batch(args, filters, api_key, retriever, search_type, output))
+            print("\n=== 処理完了 ===")
+            return status
         
+        print(f"質問: {args.question}")
         documents = retriever.search(
             query=args.question,
             k=args.k,
-            use_mmr=not args.no_mmr
+            search_type=search_type,
+            filters=filters,
+            fetch_k=args.fetch_k,
+            lambda_mult=args.lambda_mult
         )
         
         if not documents:
-            print("検索結果が見つかりませんでした。")
+            print("絞り込み条件に一致するベンダーが見つかりませんでした。" if filters else "検索結果が見つかりませんでした。")
             return 1
         
         # 4. LLMの初期化
         print("4. LLMの初期化...")
         formatter = VendorResponseFormatter(
             api_key=api_key,
-            model=args.model
+            model=args.model,
+            context_tokens=args.context_tokens,
+            map_reduce_documents=args.map_reduce_k
         )
+        map_reduce = args.renderer != "template" and formatter.use_map_reduce(documents)
+        if map_reduce:
+            print(f"分割生成: {formatter.map_chunk_size}件ずつ {len(formatter._map_chunks(documents))}回に分けて選定し、まとめて回答")
+        elif args.renderer != "template":
+            context_stats = formatter.describe_context(args.question, documents)
+            source = "作成済みブロック" if context_stats["context_source"] == "precomputed" else "質問に合わせて作成"
+            print(f"コンテキスト: {context_stats['context_tokens']}トークン（上限 {context_stats['context_budget']}、"
+                  f"短縮 {context_stats['fields_truncated']}項目・省略 {context_stats['fields_dropped']}項目、{source}）")
         
         # 5. 回答の生成
         print("5. 回答の生成...")
-        response = formatter.format_response(args.question, documents)
+        # ストリーミング以外は回答全体を作成してから表示する（response がNoneならトークンから順に表示）
+        started = time.perf_counter()
+        response, summary = None, None
+        if args.renderer == "template":
+            # LLMを使わずに検索結果の項目を回答形式に転記
+            response = formatter.render_template(args.question, documents)
+            summary = f"回答作成（テンプレート）: {(time.perf_counter() - started) * 1000:.1f}ミリ秒"
+        elif map_reduce:
+            # ベンダーを分けて並列に選定（map）し、選ばれた候補から1回でまとめる（reduce）
+            response, output_text, stats = formatter.format_map_reduce(args.question, documents)
+            summary = (f"回答生成（分割生成）: {time.perf_counter() - started:.2f}秒"
+                       f"（map {stats.get('map_calls', 0)}回 {stats.get('map_seconds', 0):.2f}秒 → "
+                       f"候補 {stats.get('candidates', 0)}件 / reduce {stats.get('reduce_seconds', 0):.2f}秒）"
+                       f" / 出力トークン: {count_tokens(output_text, args.model)}")
+        elif args.renderer == "compact":
+            # LLMはベンダーIDと選定理由だけを生成し、項目は転記
+            response, output_text = formatter.format_compact(args.question, documents)
+            summary = (f"回答生成（選定のみ）: {time.perf_counter() - started:.2f}秒 / "
+                       f"出力トークン: {count_tokens(output_text, args.model)}"
+                       f"（回答全体を生成した場合の目安: {count_tokens(response, args.model)}）")
+        elif args.no_stream:
+            response = formatter.format_response(args.question, documents)
+            summary = f"回答生成: {time.perf_counter() - started:.2f}秒"
         
         # 6. 結果の出力
         print("\n" + "="*50)
-        print(response)
+        if response is not None:
+            print(response)
+        else:
+            # 生成されたトークンから順に表示
+            time_to_first_token = None
+            for chunk in formatter.stream_response(args.question, documents):
+                if time_to_first_token is None:
+                    time_to_first_token = time.perf_counter() - started
+                print(chunk, end="", flush=True)
+            print()
+            if time_to_first_token is not None:
+                summary = f"最初のトークンまで: {time_to_first_token:.2f}秒 / 回答生成: {time.perf_counter() - started:.2f}秒"
         print("="*50)
+        if summary:
+            print(summary)
+        
+        cache_stats = retriever.get_cache_stats()
+        if cache_stats:
+            print(f"埋め込みキャッシュ: ヒット {cache_stats['hits']}件 / ミス {cache_stats['misses']}件")
+        print_transport_stats()
         
         print("\n=== 処理完了 ===")
         return 0
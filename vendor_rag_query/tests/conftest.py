@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+テストの共通設定
+utils の共有モジュール（フラットな構成・相対インポートなし）を単独で読み込めるようにする
+"""
+
+import os
+import sys
+
+QUERY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.join(QUERY_DIR, "utils"))
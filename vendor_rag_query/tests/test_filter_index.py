@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+絞り込みインデックス（filter_index.py）のテスト
+同じ項目内はOR・項目間はANDになることを、メタデータを1件ずつ照合した結果と比較する
+"""
+
+import itertools
+
+import pytest
+
+from filter_index import FilterIndex, normalize_filters, normalize_value, parse_filter_args, split_values
+
+RECORDS = [
+    ("v1", {"category": "契約書管理", "industry_tags": "法務, 金融", "price_range": "中", "deployment": "SaaS"}),
+    ("v2", {"category": "チャットボット", "industry_tags": "医療", "price_range": "低", "deployment": "SaaS"}),
+    ("v3", {"category": "チャットボット", "industry_tags": "金融, 保険", "price_range": "高", "deployment": "オンプレミス"}),
+    ("v4", {"category": "契約書管理", "industry_tags": "", "price_range": "低", "deployment": "SaaS, オンプレミス"}),
+    ("v5", {"category": "ＯＣＲ", "industry_tags": "医療, 保険", "price_range": "中"}),
+]
+
+def _brute_force_match(filters: dict) -> list[str]:
+    """ベンダーごとに、すべての項目でいずれかの値に一致するかを照合"""
+    matched = []
+    for vendor_id, metadata in RECORDS:
+        if all(
+            {normalize_value(v) for v in values} & {normalize_value(v) for v in split_values(metadata.get(field))}
+            for field, values in normalize_filters(filters).items()
+        ):
+            matched.append(vendor_id)
+    return matched
+
+def _all_filters():
+    """各項目について「指定なし」または値1〜2個の組み合わせを列挙"""
+    options = {}
+    for field in ["category", "industry_tags", "price_range", "deployment"]:
+        values = sorted({value for _, metadata in RECORDS for value in split_values(metadata.get(field))})
+        options[field] = [None] + [[v] for v in values] + [list(pair) for pair in itertools.combinations(values, 2)]
+    for combination in itertools.product(*options.values()):
+        yield {field: values for field, values in zip(options, combination) if values}
+
+def test_match_agrees_with_brute_force_for_all_combinations():
+    index = FilterIndex.build(RECORDS)
+
+    for filters in _all_filters():
+        assert index.match(filters) == _brute_force_match(filters), filters
+
+def test_values_within_a_field_are_ored():
+    index = FilterIndex.build(RECORDS)
+
+    assert index.match({"category": ["契約書管理", "チャットボット"]}) == ["v1", "v2", "v3", "v4"]
+    # 複数値の項目はどれか1つの値に一致すればよい
+    assert index.match({"industry_tags": ["保険"]}) == ["v3", "v5"]
+
+def test_fields_are_anded():
+    index = FilterIndex.build(RECORDS)
+
+    assert index.match({"category": "チャットボット", "industry_tags": "金融"}) == ["v3"]
+    assert index.match({"category": "契約書管理", "deployment": "オンプレミス", "price_range": ["低", "高"]}) == ["v4"]
+    assert index.match({"category": "ＯＣＲ", "price_range": "低"}) == []
+
+def test_labels_and_values_are_normalized():
+    index = FilterIndex.build(RECORDS)
+
+    # 日本語ラベル・カンマ区切り・全角半角・大文字小文字の違いは同じ条件として扱う
+    assert index.match({"カテゴリ": "ocr"}) == ["v5"]
+    assert index.match({"デプロイ方式": "saas, オンプレミス"}) == ["v1", "v2", "v3", "v4"]
+    assert index.match({"業界タグ": "未登録の値"}) == []
+
+def test_empty_filters_match_everything():
+    index = FilterIndex.build(RECORDS)
+
+    assert index.match(None) == ["v1", "v2", "v3", "v4", "v5"]
+    assert index.match({"category": []}) == ["v1", "v2", "v3", "v4", "v5"]
+
+def test_unknown_field_is_rejected():
+    index = FilterIndex.build(RECORDS)
+
+    with pytest.raises(ValueError, match="絞り込みできない項目です"):
+        index.match({"name": "契約ナビ"})
+
+def test_saved_index_gives_the_same_matches(tmp_path):
+    index = FilterIndex.build(RECORDS)
+    index.save(str(tmp_path))
+
+    loaded = FilterIndex.load(str(tmp_path))
+
+    for filters in _all_filters():
+        assert loaded.match(filters) == index.match(filters), filters
+
+def test_parse_filter_args_merges_repeated_fields():
+    filters = parse_filter_args(["価格帯=低", "カテゴリ=チャットボット,OCR", "price_range=中"])
+
+    assert filters == {"price_range": ["低", "中"], "category": ["チャットボット", "OCR"]}
+    with pytest.raises(ValueError, match="形式が正しくありません"):
+        parse_filter_args(["価格帯"])
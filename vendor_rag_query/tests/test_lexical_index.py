@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+キーワード検索（lexical_index.py）のテスト
+文字n-gramへの分割・BM25のスコア・Reciprocal Rank Fusion による統合を、定義どおりに計算した値と比較する
+"""
+
+import math
+from collections import Counter
+
+import pytest
+
+from lexical_index import FIELD_WEIGHTS, LexicalIndex, char_ngrams, reciprocal_rank_fusion
+
+RECORDS = [
+    ("v1", {"name": "契約ナビ", "category": "契約書管理", "description": "電子契約と契約書の管理"}),
+    ("v2", {"name": "ボットワン", "category": "チャットボット", "description": "問い合わせ対応の自動化"}),
+    ("v3", {"name": "リーガルAI", "category": "契約書管理", "industry_tags": "法務, 金融",
+            "description": "契約書レビュー"}),
+    ("v4", {"name": "メディカルボット", "category": "チャットボット", "industry_tags": "医療"}),
+]
+
+def _term_counts(metadata: dict) -> Counter:
+    counts = Counter()
+    for field, weight in FIELD_WEIGHTS.items():
+        for gram in char_ngrams(str(metadata.get(field) or "")):
+            counts[gram] += weight
+    return counts
+
+def _brute_force_bm25(records, query: str, k1: float = 1.2, b: float = 0.75) -> dict:
+    """全文書・全n-gramを走査してBM25を定義どおりに計算"""
+    documents = {vendor_id: _term_counts(metadata) for vendor_id, metadata in records}
+    average_length = sum(sum(counts.values()) for counts in documents.values()) / len(documents)
+    scores = {}
+    for vendor_id, counts in documents.items():
+        length = sum(counts.values())
+        score = 0.0
+        for gram in set(char_ngrams(query)):
+            df = sum(1 for other in documents.values() if gram in other)
+            tf = counts.get(gram, 0)
+            if not tf:
+                continue
+            idf = math.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average_length))
+        if score:
+            scores[vendor_id] = score
+    return scores
+
+def test_char_ngrams_splits_segments_into_bigrams_and_trigrams():
+    assert char_ngrams("契約書管理") == ["契約", "約書", "書管", "管理", "契約書", "約書管", "書管理"]
+    # 全角英数はNFKCで正規化し、記号・空白で区切った断片をまたぐn-gramは作らない
+    assert char_ngrams("ＡＩ・ボット") == ["ai", "ボッ", "ット", "ボット"]
+    # 最小サイズより短い断片はそのまま1語
+    assert char_ngrams("A 契約") == ["a", "契約"]
+
+@pytest.mark.parametrize("query", ["契約書管理", "チャットボット", "医療 ボット", "金融の契約書レビュー"])
+def test_bm25_scores_match_brute_force(query):
+    index = LexicalIndex.build(RECORDS)
+    expected = _brute_force_bm25(RECORDS, query)
+
+    results = index.search(query, k=len(RECORDS))
+
+    assert dict(results) == pytest.approx(expected)
+    assert [score for _, score in results] == sorted(expected.values(), reverse=True)
+
+def test_bm25_ranks_matching_vendors_first():
+    index = LexicalIndex.build(RECORDS)
+
+    assert [vendor_id for vendor_id, _ in index.search("契約書管理", k=2)] == ["v1", "v3"]
+    assert index.search("存在しない語句", k=3) == []
+
+def test_bm25_candidate_ids_restrict_results_without_changing_scores():
+    index = LexicalIndex.build(RECORDS)
+    all_scores = dict(index.search("チャットボット", k=len(RECORDS)))
+
+    results = index.search("チャットボット", k=len(RECORDS), candidate_ids={"v4", "unknown"})
+
+    assert [vendor_id for vendor_id, _ in results] == ["v4"]
+    assert results[0][1] == pytest.approx(all_scores["v4"])
+
+def test_saved_index_gives_the_same_results(tmp_path):
+    index = LexicalIndex.build(RECORDS)
+    index.save(str(tmp_path))
+
+    loaded = LexicalIndex.load(str(tmp_path))
+
+    assert len(loaded) == len(RECORDS)
+    assert loaded.search("契約書レビュー", k=3) == index.search("契約書レビュー", k=3)
+    assert LexicalIndex.load(str(tmp_path / "missing")) is None
+
+def test_reciprocal_rank_fusion_sums_reciprocal_ranks():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["b", "d"]], k=60)
+
+    expected = {
+        "a": 1 / 61,
+        "b": 1 / 62 + 1 / 61,
+        "c": 1 / 63,
+        "d": 1 / 62,
+    }
+    assert dict(fused) == pytest.approx(expected)
+    # 両方のランキングに現れた b が最上位、1つにしか現れない候補は順位どおり
+    assert [vendor_id for vendor_id, _ in fused] == ["b", "a", "d", "c"]
+
+def test_reciprocal_rank_fusion_constant_controls_rank_weight():
+    # k が小さいほど上位の順位差が効く: 1位と4位の組は、k=1 では2位2つに勝ち、k=60 では負ける
+    rankings = [["a", "b"], ["c", "b"], ["x", "y", "z", "a"]]
+
+    assert reciprocal_rank_fusion(rankings, k=1)[0][0] == "a"
+    assert reciprocal_rank_fusion(rankings, k=60)[0][0] == "b"
+    assert reciprocal_rank_fusion([]) == []
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ベクトル検索バックエンド（vector_backends.py）のテスト
+行列演算によるMMRの貪欲選択を、候補ごとに類似度を計算し直す素朴な実装と比較する
+"""
+
+import numpy as np
+import pytest
+
+from vector_backends import mmr_select
+
+def _cosine(a, b) -> float:
+    return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+def _brute_force_mmr(query_vector, candidate_vectors, k: int, lambda_mult: float) -> list[int]:
+    """各ステップで全候補のスコアを定義どおりに計算するMMR（langchain と同じく1件目は最も関連性の高い候補）"""
+    relevance = [_cosine(vector, query_vector) for vector in candidate_vectors]
+    selected = [int(np.argmax(relevance))]
+    while len(selected) < min(k, len(candidate_vectors)):
+        best, best_score = None, -np.inf
+        for i, vector in enumerate(candidate_vectors):
+            if i in selected:
+                continue
+            redundancy = max(_cosine(vector, candidate_vectors[j]) for j in selected)
+            score = lambda_mult * relevance[i] - (1 - lambda_mult) * redundancy
+            if score > best_score:
+                best, best_score = i, score
+        selected.append(best)
+    return selected
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("lambda_mult", [0.0, 0.3, 0.5, 0.8, 1.0])
+def test_mmr_select_matches_brute_force(seed, lambda_mult):
+    rng = np.random.default_rng(seed)
+    query_vector = rng.normal(size=16)
+    candidate_vectors = rng.normal(size=(30, 16))
+
+    assert mmr_select(query_vector, candidate_vectors, 8, lambda_mult) == \
+        _brute_force_mmr(query_vector, candidate_vectors, 8, lambda_mult)
+
+def test_mmr_select_skips_near_duplicates():
+    query_vector = np.array([1.0, 0.0, 0.0])
+    candidate_vectors = np.array([
+        [1.0, 0.1, 0.0],
+        [1.0, 0.11, 0.0],   # 1件目とほぼ同じ
+        [0.7, 0.0, 0.7],
+    ])
+
+    assert mmr_select(query_vector, candidate_vectors, 2, 1.0) == [0, 1]
+    assert mmr_select(query_vector, candidate_vectors, 2, 0.5) == [0, 2]
+
+def test_mmr_select_caps_k_at_candidate_count():
+    rng = np.random.default_rng(0)
+    candidate_vectors = rng.normal(size=(3, 4))
+
+    assert sorted(mmr_select(rng.normal(size=4), candidate_vectors, 10, 0.5)) == [0, 1, 2]
+    assert mmr_select(rng.normal(size=4), np.empty((0, 4)), 5, 0.5) == []
@@ -6,7 +6,8 @@ Vendor RAG Query Utils Package
 
 from .retriever import VendorRetriever
 from .formatter import VendorResponseFormatter
+from .embedding_cache import EmbeddingCache, CachedEmbeddings
 
-__all__ = ['VendorRetriever', 'VendorResponseFormatter']
+__all__ = ['VendorRetriever', 'VendorResponseFormatter', 'EmbeddingCache', 'CachedEmbeddings']
 
 
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+トークン数の上限付きコンテキスト作成
+検索されたベンダーの項目を質問との関連度で順位付けし、モデルごとのトークン数の上限に収まるように
+関連の低い項目を省略・短縮してLLMに渡すコンテキストを作る。
+取り込み時には回答形式の項目だけのベンダーごとのコンテキストブロックを作成してメタデータに保存し、
+検索側はブロックをベンダーIDの順につなげるだけでコンテキストを作れる（プロンプトの先頭が同じベンダーの組み合わせで一致する）。
+トークン数はモデルごとに1度だけ作成したtiktokenのエンコーダーで数える
+"""
+
+import os
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Optional
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken がない環境では文字数から見積もる
+    tiktoken = None
+
+# コンテキストに使うトークン数の上限（モデル名 → トークン数）
+CONTEXT_TOKEN_BUDGETS = {
+    "gpt-3.5-turbo": 1500,
+    "gpt-4": 2500,
+}
+DEFAULT_CONTEXT_TOKEN_BUDGET = 1500
+
+# 各ベンダーで必ず出力する項目（見出し）
+HEADER_FIELDS = ("name", "vendor_id")
+
+# 項目 → (表示名, 基本の重要度)。回答形式に含まれる項目ほど高い
+CONTEXT_FIELDS = {
+    "name": ("ベンダー名", 1.0),
+    "vendor_id": ("ベンダーID", 1.0),
+    "aliases": ("別名", 0.2),
+    "interview_status": ("面談状況", 0.7),
+    "category": ("カテゴリ", 0.9),
+    "industry_tags": ("業界タグ", 0.75),
+    "tech_stack": ("技術スタック", 0.4),
+    "price_range": ("価格帯", 0.7),
+    "deployment": ("デプロイ方式", 0.35),
+    "strengths": ("強み", 0.8),
+    "service_summary": ("サービス概要", 0.85),
+    "description": ("詳細説明", 0.3),
+    "url": ("URL", 0.1),
+}
+
+# 質問にこれらの語があれば、その項目の重要度を上げる（正規化済みの表記）
+FIELD_HINTS = {
+    "aliases": ("別名", "旧"),
+    "interview_status": ("面談",),
+    "industry_tags": ("業界", "業種", "向け"),
+    "tech_stack": ("技術", "スタック", "python", "aws", "azure", "gcp", "llm", "gpt", "api", "言語"),
+    "price_range": ("価格", "料金", "費用", "予算", "安い", "安価", "無料", "コスト", "円"),
+    "deployment": ("デプロイ", "オンプレ", "クラウド", "saas", "導入形態"),
+    "strengths": ("強み", "特徴", "得意"),
+    "description": ("詳細", "詳しく", "具体的"),
+    "url": ("url", "サイト", "ホームページ", "リンク"),
+}
+HINT_BOOST = 1.0
+
+# 質問の語が項目の値に含まれる割合に掛ける重み
+OVERLAP_WEIGHT = 0.5
+
+# 重要度がこれ未満の項目は上限に余裕があっても出力しない
+# （回答形式にない別名・技術スタック・詳細説明・URLなどは、質問で求められたか質問の語を含む場合のみ出力）
+MIN_FIELD_SCORE = 0.5
+
+# 取り込み時に作成するコンテキストブロックの項目（基本の重要度が MIN_FIELD_SCORE 以上の項目）
+BLOCK_FIELDS = tuple(field for field, (_, base) in CONTEXT_FIELDS.items() if base >= MIN_FIELD_SCORE)
+
+# ブロックのトークン数を数えるモデル（gpt-3.5-turbo と gpt-4 は同じエンコーディング）
+BLOCK_TOKEN_MODEL = "gpt-3.5-turbo"
+
+# 上限に収まらない場合に下位のベンダーの項目から削るための、検索順位1つあたりの減点
+RANK_DECAY = 0.05
+
+# 長い項目の1項目あたりの上限トークン数（質問で求められた項目は倍まで）
+FIELD_TOKEN_LIMITS = {
+    "service_summary": 100,
+    "strengths": 80,
+    "description": 120,
+}
+
+# 上限に収まらない項目を短縮して残す場合の最小トークン数（これ未満なら省略）
+MIN_TRUNCATED_TOKENS = 16
+
+# 値がない項目（出力しない。回答では「情報なし」と扱われる）
+MISSING_VALUES = ("", "情報なし")
+
+TRUNCATION_MARK = "…"
+
+_IGNORED_CHARS = re.compile(r"[\s\W_]+", re.UNICODE)
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str):
+    """
+    モデルのtiktokenエンコーダーを取得（モデルごとに1度だけ作成）
+
+    Returns:
+        エンコーダー（tiktoken がない・エンコーディングを取得できない場合はNone）
+    """
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            # 未知のモデルは現行のチャットモデルと同じエンコーディングで数える
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # 初回はエンコーディングのファイルをダウンロードするため、オフラインでは失敗する
+        # （失敗もキャッシュされ、以降は見積もりで数える）
+        return None
+
+def _estimate_tokens(text: str) -> int:
+    """tiktoken がない場合の見積もり（ASCIIは4文字で1トークン、日本語などは1文字1トークン）"""
+    ascii_chars = sum(1 for char in text if char.isascii())
+    return (ascii_chars + 3) // 4 + len(text) - ascii_chars
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    """テキストのトークン数を計算"""
+    encoding = get_encoding(model)
+    if encoding is None:
+        return _estimate_tokens(text)
+    return len(encoding.encode(text))
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = "gpt-3.5-turbo") -> str:
+    """テキストを先頭から max_tokens トークン以内に短縮（短縮した場合は末尾に「…」）"""
+    encoding = get_encoding(model)
+    if encoding is None:
+        if _estimate_tokens(text) <= max_tokens:
+            return text
+        while text and _estimate_tokens(text) > max_tokens - 1:
+            text = text[:max(len(text) * 3 // 4, len(text) - 32)]
+        return text.rstrip() + TRUNCATION_MARK
+
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    # トークンの途中で切れた文字（U+FFFD）は落とす
+    head = encoding.decode(tokens[:max(max_tokens - 1, 0)]).rstrip("�").rstrip()
+    return head + TRUNCATION_MARK
+
+def context_budget(model: str) -> int:
+    """
+    モデルのコンテキストのトークン数の上限
+
+    環境変数 VENDOR_RAG_CONTEXT_TOKENS があればモデルによらずその値を使う。
+    """
+    configured = os.getenv("VENDOR_RAG_CONTEXT_TOKENS")
+    if configured:
+        return int(configured)
+    return CONTEXT_TOKEN_BUDGETS.get(model, DEFAULT_CONTEXT_TOKEN_BUDGET)
+
+def _line(field: str, value: str) -> str:
+    return f"- **{CONTEXT_FIELDS[field][0]}**: {value}\n"
+
+def render_context_block(vendor_info: dict, model: str = BLOCK_TOKEN_MODEL) -> tuple[str, int]:
+    """
+    ベンダー1件のコンテキストブロックを作成（取り込み時に1度だけ実行し、メタデータに保存する）
+
+    見出しは検索順位ではなくベンダーIDで付け、項目は BLOCK_FIELDS を決まった順序で出力する
+    （長い項目は FIELD_TOKEN_LIMITS で短縮、値がない項目は省略）。
+
+    Args:
+        vendor_info: CONTEXT_FIELDS の項目をキーとする辞書（メタデータ）
+        model: トークン数を数えるモデル名
+
+    Returns:
+        (ブロックのテキスト, トークン数)
+    """
+    lines = [f"\n## ベンダー（{vendor_info.get('vendor_id') or ''}）\n"]
+    for field in BLOCK_FIELDS:
+        value = str(vendor_info.get(field) or "").strip()
+        if value in MISSING_VALUES:
+            continue
+        if field in FIELD_TOKEN_LIMITS:
+            value = truncate_to_tokens(value, FIELD_TOKEN_LIMITS[field], model)
+        lines.append(_line(field, value))
+    block = "".join(lines)
+    return block, count_tokens(block, model)
+
+def _normalize(text: str) -> str:
+    return _IGNORED_CHARS.sub(" ", unicodedata.normalize("NFKC", text).casefold())
+
+def _bigrams(text: str) -> set[str]:
+    """記号・空白で区切った断片ごとの文字2-gram（1文字の断片はそのまま）"""
+    grams = set()
+    for segment in _normalize(text).split():
+        if len(segment) < 2:
+            grams.add(segment)
+        grams.update(segment[i:i + 2] for i in range(len(segment) - 1))
+    return grams
+
+class ContextBuilder:
+    """トークン数の上限付きでベンダー情報のコンテキストを作成するクラス"""
+
+    def __init__(self, model: str = "gpt-3.5-turbo", budget: Optional[int] = None):
+        """
+        初期化
+
+        Args:
+            model: トークン数を数えるモデル名
+            budget: コンテキストのトークン数の上限（未指定時はモデルごとの既定値）
+        """
+        self.model = model
+        self.budget = budget if budget is not None else context_budget(model)
+
+    def _field_scores(self, question: str) -> dict:
+        """質問に対する項目ごとの重要度（基本の重要度＋質問中の手がかり語）"""
+        normalized = _normalize(question)
+        scores = {}
+        for field, (_, base) in CONTEXT_FIELDS.items():
+            hints = FIELD_HINTS.get(field, ())
+            scores[field] = base + (HINT_BOOST if any(hint in normalized for hint in hints) else 0.0)
+        return scores
+
+    def needs_extra_fields(self, question: str) -> bool:
+        """質問がコンテキストブロックにない項目（別名・技術スタック・詳細説明・URLなど）を求めているか"""
+        normalized = _normalize(question)
+        return any(
+            hint in normalized
+            for field, hints in FIELD_HINTS.items() if field not in BLOCK_FIELDS
+            for hint in hints
+        )
+
+    def assemble(self, question: str, blocks: list) -> Optional[tuple[str, dict]]:
+        """
+        取り込み時に作成済みのコンテキストブロックをつなげてコンテキストを作成
+
+        ブロックはベンダーIDの順に並べるため、同じベンダーの組み合わせなら検索順位や質問によらず
+        同じテキストになり、プロバイダー側のプロンプトキャッシュ（先頭一致）が効く。
+
+        Args:
+            question: ユーザーの質問
+            blocks: 検索順の (ベンダーID, ブロック, トークン数) のリスト（ブロックがないベンダーはNone）
+
+        Returns:
+            (コンテキストテキスト, 統計情報)。ブロックがないベンダーがある・質問がブロックにない項目を求めている・
+            上限を超える場合はNone（build() で質問に合わせて作り直す）
+        """
+        if not blocks or any(block is None for block in blocks) or self.needs_extra_fields(question):
+            return None
+        context_tokens = sum(tokens for _, _, tokens in blocks)
+        if context_tokens > self.budget:
+            return None
+
+        texts = [text for _, text, _ in sorted(blocks, key=lambda block: block[0])]
+        return "".join(texts), {
+            "context_tokens": context_tokens,
+            "context_budget": self.budget,
+            "context_source": "precomputed",
+            "fields_included": sum(text.count("\n- ") for text in texts),
+            "fields_truncated": sum(text.count(TRUNCATION_MARK + "\n") for text in texts),
+            "fields_dropped": 0,
+        }
+
+    def build(self, question: str, vendor_infos: list) -> tuple[str, dict]:
+        """
+        コンテキストを作成
+
+        Args:
+            question: ユーザーの質問
+            vendor_infos: 検索順のベンダー情報（CONTEXT_FIELDS の項目をキーとする辞書）のリスト
+
+        Returns:
+            (コンテキストテキスト, 統計情報)
+            統計情報は context_tokens（実際のトークン数）・context_budget・context_source（"built"）・
+            fields_included・fields_truncated・fields_dropped を持つ
+        """
+        field_scores = self._field_scores(question)
+        question_grams = _bigrams(question)
+
+        # 各ベンダーの見出し（ベンダー名・ID）は上限によらず必ず出力する
+        headers = []
+        for i, vendor_info in enumerate(vendor_infos, 1):
+            lines = "".join(_line(field, vendor_info.get(field) or "") for field in HEADER_FIELDS)
+            headers.append(f"\n## ベンダー{i}\n{lines}")
+        remaining = self.budget - sum(count_tokens(header, self.model) for header in headers)
+
+        # (検索順位で減点した重要度, 検索順位, 項目の順序) で候補を並べ、上限に収まる限り採用する
+        candidates = []
+        field_order = list(CONTEXT_FIELDS)
+        for rank, vendor_info in enumerate(vendor_infos):
+            for field in field_order:
+                value = str(vendor_info.get(field) or "").strip()
+                if field in HEADER_FIELDS or value in MISSING_VALUES:
+                    continue
+                score = field_scores[field]
+                if question_grams:
+                    score += OVERLAP_WEIGHT * len(question_grams & _bigrams(value)) / len(question_grams)
+                candidates.append((RANK_DECAY * rank - score, rank, field_order.index(field), score, field, value))
+        candidates.sort()
+
+        selected = [{} for _ in vendor_infos]
+        stats = {"fields_included": 0, "fields_truncated": 0, "fields_dropped": 0}
+        for _, rank, _, score, field, value in candidates:
+            if score < MIN_FIELD_SCORE:
+                stats["fields_dropped"] += 1
+                continue
+            limit = FIELD_TOKEN_LIMITS.get(field)
+            if limit is not None:
+                if field_scores[field] >= HINT_BOOST:
+                    limit *= 2
+                shortened = truncate_to_tokens(value, limit, self.model)
+                truncated = shortened != value
+                value = shortened
+            else:
+                truncated = False
+
+            cost = count_tokens(_line(field, value), self.model)
+            if cost > remaining:
+                # 短縮できる長い項目は、残りに収まる長さで残す
+                overhead = count_tokens(_line(field, ""), self.model)
+                if field not in FIELD_TOKEN_LIMITS or remaining - overhead < MIN_TRUNCATED_TOKENS:
+                    stats["fields_dropped"] += 1
+                    continue
+                value = truncate_to_tokens(value, remaining - overhead, self.model)
+                cost = count_tokens(_line(field, value), self.model)
+                truncated = True
+
+            selected[rank][field] = value
+            remaining -= cost
+            stats["fields_included"] += 1
+            stats["fields_truncated"] += int(truncated)
+
+        # 各ベンダー内の項目は決まった順序で出力する
+        parts = []
+        for header, fields in zip(headers, selected):
+            body = "".join(_line(field, fields[field]) for field in field_order if field in fields)
+            parts.append(header + body)
+        context_text = "".join(parts)
+
+        stats["context_tokens"] = count_tokens(context_text, self.model)
+        stats["context_budget"] = self.budget
+        stats["context_source"] = "built"
+        return context_text, stats
@@ -4,38 +4,91 @@
 回答テンプレートでLLMを使って整形するモジュール
 """
 
+import os
 import re
-from typing import List, Optional
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterator, List, Optional
 from langchain.schema import Document
 from langchain_community.chat_models import ChatOpenAI
 from langchain.prompts import ChatPromptTemplate
 from langchain.schema import HumanMessage, SystemMessage
+from .vendor_fields import vendor_info_from_metadata, vendor_info_from_text
+from .context_builder import ContextBuilder, count_tokens
+from .openai_transport import get_transport
+
+# 回答の作成方法（llm: LLMで生成 / compact: LLMはベンダーIDと選定理由だけをJSONで返し、項目はメタデータから転記 /
+# template: LLMを使わず検索結果の項目を回答形式に転記）
+RENDERERS = ("llm", "compact", "template")
+
+# 回答形式の各ベンダーの項目（メタデータのキー, 表示名）
+ANSWER_FIELDS = (
+    ("name", "ベンダー名"),
+    ("category", "カテゴリ"),
+    ("industry_tags", "業界タグ"),
+    ("service_summary", "サービス概要"),
+    ("strengths", "強み"),
+    ("price_range", "価格帯"),
+    ("interview_status", "面談状況"),
+)
+
+# 分割生成（map-reduce）: 検索件数がこの数を超えるか、コンテキストの見積もりが上限を超える場合は、
+# ベンダーを MAP_CHUNK_SIZE 件ずつに分けて並列に選定・要約し（map）、選ばれたベンダーだけを1回の短い呼び出しでまとめる（reduce）
+MAP_REDUCE_DOCUMENTS = 10
+MAP_CHUNK_SIZE = 5
+# map の同時呼び出し数の上限（既定値では検索件数50件までの map を1度に呼び出す。共有トランスポートの接続数の上限より小さくする）
+MAP_CONCURRENCY = 10
+# map で関連度（0〜10）がこの値未満のベンダーは reduce に渡さない
+MAP_MIN_SCORE = 5
 
 class VendorResponseFormatter:
     """ベンダー回答整形クラス"""
     
-    def __init__(self, api_key: Optional[str] = None, model: str = "gpt-3.5-turbo"):
+    def __init__(self, api_key: Optional[str] = None, model: str = "gpt-3.5-turbo", context_tokens: Optional[int] = None,
+                 map_reduce_documents: Optional[int] = None, map_reduce_tokens: Optional[int] = None):
         """
         初期化
         
         Args:
             api_key: OpenAI APIキー
             model: 使用するモデル名
+            context_tokens: コンテキストのトークン数の上限（未指定時はモデルごとの既定値）
+            map_reduce_documents: 分割生成に切り替える検索件数（これより多い場合。
+                未指定時は環境変数 VENDOR_RAG_MAP_REDUCE_K、なければ MAP_REDUCE_DOCUMENTS）
+            map_reduce_tokens: 分割生成に切り替えるコンテキストの見積もりトークン数（これより多い場合。
+                未指定時は環境変数 VENDOR_RAG_MAP_REDUCE_TOKENS、なければコンテキストの上限）
         """
         self.api_key = api_key
         self.model = model
         self.llm = None
+        self.selection_llm = None
+        self.context_builder = ContextBuilder(model, budget=context_tokens)
+        self.map_reduce_documents = map_reduce_documents or int(os.getenv("VENDOR_RAG_MAP_REDUCE_K", MAP_REDUCE_DOCUMENTS))
+        self.map_reduce_tokens = (map_reduce_tokens or int(os.getenv("VENDOR_RAG_MAP_REDUCE_TOKENS", 0))
+                                  or self.context_builder.budget)
+        self.map_chunk_size = int(os.getenv("VENDOR_RAG_MAP_CHUNK_SIZE", MAP_CHUNK_SIZE))
+        self.map_concurrency = int(os.getenv("VENDOR_RAG_MAP_CONCURRENCY", MAP_CONCURRENCY))
         
         self._initialize_llm()
     
     def _initialize_llm(self):
         """LLMの初期化"""
         try:
+            # 接続・タイムアウト・リトライは共有トランスポートで管理する（クライアント側のリトライは無効化）
+            transport = get_transport()
             self.llm = ChatOpenAI(
                 model=self.model,
                 openai_api_key=self.api_key,
-                temperature=0.1  # 低い温度で一貫性のある回答を生成
+                temperature=0.1,  # 低い温度で一貫性のある回答を生成
+                client=transport.openai_client(self.api_key).chat.completions,
+                async_client=transport.async_openai_client(self.api_key).chat.completions,
+                request_timeout=transport.timeout("chat"),
+                max_retries=0
             )
+            # ベンダーの選定（compact）はJSONだけを返させる
+            self.selection_llm = self.llm.bind(response_format={"type": "json_object"})
             print(f"LLMを初期化しました: {self.model}")
         except Exception as e:
             raise Exception(f"LLMの初期化に失敗しました: {e}")
@@ -50,88 +103,89 @@ class VendorResponseFormatter:
         Returns:
             抽出されたベンダー情報の辞書
         """
-        content = document.page_content
-        
-        # 正規表現でベンダー情報を抽出
-        patterns = {
-            'name': r'ベンダー \d+: (.+?) ｜',
-            'vendor_id': r'ベンダーID: (.+?) ｜',
-            'aliases': r'別名: (.+?) ｜',
-            'interview_status': r'面談状況: (.+?) ｜',
-            'category': r'カテゴリ: (.+?) ｜',
-            'industry_tags': r'業界タグ: (.+?) ｜',
-            'tech_stack': r'技術スタック: (.+?) ｜',
-            'price_range': r'価格帯: (.+?) ｜',
-            'deployment': r'デプロイ方式: (.+?) ｜',
-            'strengths': r'強み: (.+?) ｜',
-            'service_summary': r'サービス概要: (.+?) ｜',
-            'description': r'詳細説明: (.+?) ｜',
-            'url': r'URL: (.+?) ｜'
-        }
-        
-        vendor_info = {}
-        for key, pattern in patterns.items():
-            match = re.search(pattern, content)
-            if match:
-                vendor_info[key] = match.group(1).strip()
-            else:
-                vendor_info[key] = "情報なし"
+        # 取り込み時に解析済みのメタデータをそのまま使用（正規表現は使わない）
+        vendor_info = vendor_info_from_metadata(document.metadata)
+        if vendor_info is None:
+            # 旧形式のベクトルDB（メタデータにフィールドがない）は本文を1パスで解析
+            vendor_info = vendor_info_from_text(document.page_content)
         
         return vendor_info
     
-    def _create_context_text(self, documents: List[Document]) -> str:
+    def _create_context_text(self, question: str, documents: List[Document]) -> tuple[str, dict]:
         """
         ドキュメントリストからコンテキストテキストを作成
         
+        取り込み時に作成済みのコンテキストブロックがあれば、ベンダーIDの順につなげるだけで作る
+        （同じベンダーの組み合わせなら同じテキストになる）。ブロックがない旧形式のベクトルDBや、
+        質問がブロックにない項目を求めている場合・上限を超える場合は、質問との関連が低い項目を
+        トークン数の上限に応じて省略・短縮して作り直す（context_builder を参照）。
+        
         Args:
+            question: ユーザーの質問
             documents: 検索結果のドキュメントリスト
             
         Returns:
-            コンテキストテキスト
+            コンテキストテキストと、トークン数・省略した項目数などの統計情報
         """
-        context_parts = []
+        assembled = self.context_builder.assemble(question, [self._context_block(doc) for doc in documents])
+        if assembled is not None:
+            return assembled
         
-        for i, doc in enumerate(documents, 1):
-            vendor_info = self._extract_vendor_info(doc)
-            
-            context_part = f"""
-## ベンダー{i}
-- **ベンダー名**: {vendor_info['name']}
-- **ベンダーID**: {vendor_info['vendor_id']}
-- **別名**: {vendor_info['aliases']}
-- **面談状況**: {vendor_info['interview_status']}
-- **カテゴリ**: {vendor_info['category']}
-- **業界タグ**: {vendor_info['industry_tags']}
-- **技術スタック**: {vendor_info['tech_stack']}
-- **価格帯**: {vendor_info['price_range']}
-- **デプロイ方式**: {vendor_info['deployment']}
-- **強み**: {vendor_info['strengths']}
-- **サービス概要**: {vendor_info['service_summary']}
-- **詳細説明**: {vendor_info['description']}
-- **URL**: {vendor_info['url']}
-"""
-            context_parts.append(context_part)
-        
-        return "\n".join(context_parts)
+        vendor_infos = [self._extract_vendor_info(doc) for doc in documents]
+        return self.context_builder.build(question, vendor_infos)
     
-    def format_response(self, question: str, documents: List[Document]) -> str:
+    def _context_block(self, document: Document) -> Optional[tuple[str, str, int]]:
+        """取り込み時に作成済みのコンテキストブロック（ベンダーID, ブロック, トークン数）。ない場合はNone"""
+        metadata = document.metadata or {}
+        block = metadata.get("context_block")
+        if not block:
+            return None
+        return metadata.get("vendor_id") or "", block, int(metadata.get("context_block_tokens") or 0)
+    
+    def describe_context(self, question: str, documents: List[Document]) -> dict:
+        """LLMに渡すコンテキストの統計情報（トークン数・上限・短縮/省略した項目数）"""
+        return self._create_context_text(question, documents)[1]
+    
+    def _build_messages(self, question: str, documents: List[Document], renderer: str = "llm") -> list:
         """
-        質問とドキュメントから整形された回答を生成
+        質問とドキュメントからLLMに渡すメッセージを作成
         
         Args:
             question: ユーザーの質問
             documents: 検索結果のドキュメントリスト
+            renderer: 回答の作成方法（"llm": 回答全体を生成 / "compact": ベンダーIDと選定理由だけを生成 /
+                "map": 分割生成の map）
             
         Returns:
-            整形されたMarkdown形式の回答
+            SystemMessage と HumanMessage のリスト
         """
-        if not documents:
-            return self._create_no_results_response(question)
-        
         # コンテキストテキストの作成
-        context_text = self._create_context_text(documents)
+        context_text, _ = self._create_context_text(question, documents)
+        
+        if renderer == "compact":
+            system_prompt, instruction = self._selection_prompt()
+        elif renderer == "map":
+            system_prompt, instruction = self._map_prompt()
+        else:
+            system_prompt, instruction = self._answer_prompt()
+        
+        # システムプロンプトとベンダー情報を先頭に置き、質問は最後に置く
+        # （同じベンダーの組み合わせならプロンプトの先頭が一致し、プロバイダー側のプロンプトキャッシュが効く）
+        human_prompt = f"""ベンダー情報:
+{context_text}
+
+質問: {question}
+
+{instruction}
+"""
         
-        # プロンプトテンプレート
+        return [
+            SystemMessage(content=system_prompt),
+            HumanMessage(content=human_prompt)
+        ]
+    
+    def _answer_prompt(self) -> tuple[str, str]:
+        """回答全体を生成させるプロンプト（システムプロンプト, 質問の後の指示）"""
         system_prompt = """あなたはベンダー情報の専門アシスタントです。
 提供されたベンダー情報のみを使用して、ユーザーの質問に回答してください。
 
@@ -160,33 +214,355 @@ class VendorResponseFormatter:
 ## ベンダー2
 （同様に続く）
 ```"""
+        return system_prompt, "上記のベンダー情報のみを使用して、質問に回答してください。"
+    
+    def _selection_prompt(self) -> tuple[str, str]:
+        """ベンダーIDと選定理由だけを生成させるプロンプト（システムプロンプト, 質問の後の指示）"""
+        system_prompt = """あなたはベンダー情報の専門アシスタントです。
+提供されたベンダー情報のみを使用して、ユーザーの質問に該当するベンダーを選んでください。
 
-        human_prompt = f"""
-質問: {question}
+重要なルール：
+1. 質問に関連するベンダーのみを、関連の高い順に選ぶ
+2. ベンダーIDは提供された値をそのまま使う
+3. 選定理由は提供されたベンダー情報に基づき、1文（40文字程度）で書く
+4. ベンダー名やカテゴリなどの項目は出力しない（項目はシステムが転記する）
+5. 次の形式のJSONだけを出力する。該当するベンダーがなければ "vendors" は空のリストにする
 
-ベンダー情報:
-{context_text}
+{"vendors": [{"id": "ベンダーID", "reason": "選定理由"}]}"""
+        return system_prompt, "上記のベンダー情報から質問に該当するベンダーを選び、JSONだけを出力してください。"
+    
+    def _map_prompt(self) -> tuple[str, str]:
+        """分割生成の map（ベンダーの一部から該当するものを関連度付きで選ぶ）のプロンプト（システムプロンプト, 質問の後の指示）"""
+        system_prompt = """あなたはベンダー情報の専門アシスタントです。
+提供されたベンダー情報（候補の一部）のみを使用して、ユーザーの質問に該当するベンダーを選んでください。
 
-上記のベンダー情報のみを使用して、質問に回答してください。
-"""
+重要なルール：
+1. 質問に関連するベンダーのみを選ぶ
+2. ベンダーIDは提供された値をそのまま使う
+3. 関連度は0〜10の整数で付ける（10が最も関連が高い）
+4. 選定理由は提供されたベンダー情報に基づき、1文（40文字程度）で書く
+5. 次の形式のJSONだけを出力する。該当するベンダーがなければ "vendors" は空のリストにする
+
+{"vendors": [{"id": "ベンダーID", "score": 関連度, "reason": "選定理由"}]}"""
+        return system_prompt, "上記のベンダー情報から質問に該当するベンダーを選び、関連度と選定理由を付けてJSONだけを出力してください。"
+    
+    def _reduce_prompt(self) -> tuple[str, str]:
+        """分割生成の reduce（map で選ばれた候補から最終的な回答のベンダーを選ぶ）のプロンプト（システムプロンプト, 質問の後の指示）"""
+        system_prompt = """あなたはベンダー情報の専門アシスタントです。
+ベンダー候補は、検索結果を分けて質問との関連度と選定理由を付けたものです。
+候補の中から、ユーザーの質問への回答に含めるベンダーを選んでください。
 
+重要なルール：
+1. 質問に関連するベンダーのみを、関連の高い順に選ぶ
+2. ベンダーIDは提供された値をそのまま使う
+3. 選定理由は候補の選定理由をもとに、1文（40文字程度）で書く
+4. 次の形式のJSONだけを出力する。該当するベンダーがなければ "vendors" は空のリストにする
+
+{"vendors": [{"id": "ベンダーID", "reason": "選定理由"}]}"""
+        return system_prompt, "上記のベンダー候補から回答に含めるベンダーを選び、JSONだけを出力してください。"
+    
+    def format_response(self, question: str, documents: List[Document]) -> str:
+        """
+        質問とドキュメントから整形された回答を生成
+        
+        Args:
+            question: ユーザーの質問
+            documents: 検索結果のドキュメントリスト
+            
+        Returns:
+            整形されたMarkdown形式の回答
+        """
+        if not documents:
+            return self._create_no_results_response(question)
+        
         try:
             # LLMで回答生成
-            messages = [
-                SystemMessage(content=system_prompt),
-                HumanMessage(content=human_prompt)
-            ]
-            
-            response = self.llm.invoke(messages)
+            response = self.llm.invoke(self._build_messages(question, documents))
             
             # 回答の整形
-            formatted_response = self._post_process_response(response.content)
+            return self._post_process_response(response.content)
             
-            return formatted_response
+        except Exception as e:
+            return f"回答生成中にエラーが発生しました: {e}"
+    
+    async def aformat_response(self, question: str, documents: List[Document]) -> str:
+        """format_response() の非同期版（LLMの非同期クライアントで生成）"""
+        if not documents:
+            return self._create_no_results_response(question)
+        
+        try:
+            response = await self.llm.ainvoke(self._build_messages(question, documents))
+            return self._post_process_response(response.content)
             
         except Exception as e:
             return f"回答生成中にエラーが発生しました: {e}"
     
+    def stream_response(self, question: str, documents: List[Document]) -> Iterator[str]:
+        """
+        format_response() のストリーミング版（生成されたトークンを順に返す）
+        
+        後処理（余分な改行の整理）はかけないため、全体をつなげた後に _post_process_response() を通す。
+        生成中にエラーが発生した場合は、エラーメッセージを最後の断片として返す。
+        """
+        if not documents:
+            yield self._create_no_results_response(question)
+            return
+        
+        try:
+            for chunk in self.llm.stream(self._build_messages(question, documents)):
+                if chunk.content:
+                    yield chunk.content
+        except Exception as e:
+            yield f"\n\n回答生成中にエラーが発生しました: {e}"
+    
+    async def astream_response(self, question: str, documents: List[Document]) -> AsyncIterator[str]:
+        """stream_response() の非同期版"""
+        if not documents:
+            yield self._create_no_results_response(question)
+            return
+        
+        try:
+            async for chunk in self.llm.astream(self._build_messages(question, documents)):
+                if chunk.content:
+                    yield chunk.content
+        except Exception as e:
+            yield f"\n\n回答生成中にエラーが発生しました: {e}"
+    
+    def render_template(self, question: str, documents: List[Document]) -> str:
+        """
+        LLMを使わずに回答を作成（検索されたベンダーの項目を回答形式のMarkdownにそのまま転記）
+        
+        「〜のベンダーは？」のような一覧の質問向け。トークンを消費せず、ミリ秒単位で返る。
+        
+        Args:
+            question: ユーザーの質問
+            documents: 検索結果のドキュメントリスト
+            
+        Returns:
+            format_response() と同じ【質問】/【回答】形式のMarkdown
+        """
+        if not documents:
+            return self._create_no_results_response(question)
+        return self._render_cards(question, [(doc, None) for doc in documents])
+    
+    def _render_cards(self, question: str, selections: list) -> str:
+        """
+        (ドキュメント, 選定理由) の列を回答形式のMarkdownに転記
+        
+        Args:
+            question: ユーザーの質問
+            selections: (ドキュメント, 選定理由またはNone) のリスト
+        """
+        parts = []
+        for i, (doc, reason) in enumerate(selections, 1):
+            vendor_info = self._extract_vendor_info(doc)
+            lines = [f"- **{label}**: {vendor_info[key]}" for key, label in ANSWER_FIELDS]
+            if reason:
+                lines.append(f"- **選定理由**: {reason}")
+            parts.append(f"## ベンダー{i}\n" + "\n".join(lines))
+        if not parts:
+            parts.append("提供されたベンダー情報の中に、ご質問に該当するベンダーは見つかりませんでした。")
+        return f"【質問】\n{question}\n\n【回答】\n" + "\n\n".join(parts)
+    
+    def _parse_selection(self, content: str, documents: List[Document]) -> list:
+        """
+        ベンダー選定のJSONを解析
+        
+        検索結果にないベンダーIDと重複は無視する。
+        
+        Returns:
+            (ドキュメント, 選定理由) のリスト（LLMが選んだ順）
+            
+        Raises:
+            ValueError: JSONとして解析できない場合
+        """
+        return [(doc, str(item.get("reason") or "").strip()) for doc, item in self._parse_vendors(content, documents)]
+    
+    def _parse_vendors(self, content: str, documents: List[Document]) -> list:
+        """
+        ベンダー選定のJSONの "vendors" を解析（検索結果にないベンダーIDと重複は無視）
+        
+        Returns:
+            (ドキュメント, JSONの要素) のリスト（LLMが選んだ順）
+            
+        Raises:
+            ValueError: JSONとして解析できない場合
+        """
+        match = re.search(r"\{.*\}", content, re.DOTALL)
+        if match is None:
+            raise ValueError("JSONが見つかりません")
+        data = json.loads(match.group(0))
+        
+        by_id = {doc.metadata.get("vendor_id"): doc for doc in documents}
+        selections, seen = [], set()
+        for item in data.get("vendors") or []:
+            vendor_id = str(item.get("id", "")).strip() if isinstance(item, dict) else ""
+            if vendor_id in by_id and vendor_id not in seen:
+                seen.add(vendor_id)
+                selections.append((by_id[vendor_id], item))
+        return selections
+    
+    def _parse_scores(self, content: str, documents: List[Document]) -> list:
+        """
+        map の結果を解析
+        
+        Returns:
+            関連度が MAP_MIN_SCORE 以上の (ドキュメント, 関連度, 選定理由) のリスト（関連度がないものは MAP_MIN_SCORE とみなす）
+        """
+        candidates = []
+        for doc, item in self._parse_vendors(content, documents):
+            try:
+                score = float(item.get("score", MAP_MIN_SCORE))
+            except (TypeError, ValueError):
+                score = MAP_MIN_SCORE
+            if score >= MAP_MIN_SCORE:
+                candidates.append((doc, score, str(item.get("reason") or "").strip()))
+        return candidates
+    
+    def format_compact(self, question: str, documents: List[Document]) -> tuple[str, str]:
+        """
+        LLMにはベンダーIDと選定理由だけをJSONで生成させ、項目はメタデータから転記して回答を作成
+        
+        LLMが書く量が選定結果だけになるため、出力トークン数と生成時間が回答全体を生成する場合より小さい。
+        
+        Args:
+            question: ユーザーの質問
+            documents: 検索結果のドキュメントリスト
+            
+        Returns:
+            (回答形式のMarkdown, LLMが実際に出力したテキスト)
+        """
+        if not documents:
+            return self._create_no_results_response(question), ""
+        
+        try:
+            response = self.selection_llm.invoke(self._build_messages(question, documents, "compact"))
+            return self._render_cards(question, self._parse_selection(response.content, documents)), response.content
+        except Exception as e:
+            return f"回答生成中にエラーが発生しました: {e}", ""
+    
+    async def aformat_compact(self, question: str, documents: List[Document]) -> tuple[str, str]:
+        """format_compact() の非同期版"""
+        if not documents:
+            return self._create_no_results_response(question), ""
+        
+        try:
+            response = await self.selection_llm.ainvoke(self._build_messages(question, documents, "compact"))
+            return self._render_cards(question, self._parse_selection(response.content, documents)), response.content
+        except Exception as e:
+            return f"回答生成中にエラーが発生しました: {e}", ""
+    
+    def use_map_reduce(self, documents: List[Document]) -> bool:
+        """
+        分割生成（map-reduce）で回答を作成するか
+        
+        検索件数が map_reduce_documents を超える場合と、コンテキストの見積もり（作成済みブロックのトークン数、
+        ない場合は本文のトークン数）が map_reduce_tokens を超える場合に使う。
+        """
+        if len(documents) > self.map_reduce_documents:
+            return True
+        estimated = 0
+        for doc in documents:
+            block = self._context_block(doc)
+            estimated += block[2] if block else count_tokens(doc.page_content, self.model)
+        return estimated > self.map_reduce_tokens
+    
+    def _map_chunks(self, documents: List[Document]) -> List[List[Document]]:
+        return [documents[i:i + self.map_chunk_size] for i in range(0, len(documents), self.map_chunk_size)]
+    
+    def _reduce_messages(self, question: str, candidates: list) -> list:
+        """map で選ばれた候補（ベンダーID・ベンダー名・関連度・選定理由だけ）から reduce のメッセージを作成"""
+        blocks = []
+        for doc, score, reason in candidates:
+            vendor_id = doc.metadata.get("vendor_id") or ""
+            blocks.append(f"\n## ベンダー（{vendor_id}）\n"
+                          f"- **ベンダーID**: {vendor_id}\n"
+                          f"- **ベンダー名**: {self._extract_vendor_info(doc)['name']}\n"
+                          f"- **関連度**: {score:g}\n"
+                          f"- **選定理由**: {reason}\n")
+        system_prompt, instruction = self._reduce_prompt()
+        human_prompt = f"""ベンダー候補:
+{"".join(blocks)}
+
+質問: {question}
+
+{instruction}
+"""
+        return [SystemMessage(content=system_prompt), HumanMessage(content=human_prompt)]
+    
+    def format_map_reduce(self, question: str, documents: List[Document]) -> tuple[str, str, dict]:
+        """
+        分割生成（map-reduce）で回答を作成
+        
+        ベンダーを map_chunk_size 件ずつに分け、各チャンクで該当するベンダーを関連度・選定理由付きで選ぶ（map、
+        最大 map_concurrency 件を並列に呼び出す）。選ばれたベンダーのID・名前・関連度・選定理由だけを渡す1回の
+        短い呼び出し（reduce）で回答に含めるベンダーと順序を決め、項目はメタデータから転記する。
+        
+        Args:
+            question: ユーザーの質問
+            documents: 検索結果のドキュメントリスト
+            
+        Returns:
+            (回答形式のMarkdown, LLMが実際に出力したテキスト（全呼び出し分）,
+            統計情報（map の呼び出し回数 map_calls・候補数 candidates・map_seconds・reduce_seconds）)
+        """
+        if not documents:
+            return self._create_no_results_response(question), "", {}
+        
+        try:
+            started = time.perf_counter()
+            chunks = self._map_chunks(documents)
+            
+            def map_chunk(chunk: List[Document]) -> str:
+                return self.selection_llm.invoke(self._build_messages(question, chunk, "map")).content
+            
+            with ThreadPoolExecutor(max_workers=min(self.map_concurrency, len(chunks))) as executor:
+                map_outputs = list(executor.map(map_chunk, chunks))
+            
+            reduce_started = time.perf_counter()
+            candidates = [candidate for chunk, output in zip(chunks, map_outputs)
+                          for candidate in self._parse_scores(output, chunk)]
+            stats = {"map_calls": len(chunks), "candidates": len(candidates),
+                     "map_seconds": reduce_started - started, "reduce_seconds": 0.0}
+            if not candidates:
+                return self._render_cards(question, []), "".join(map_outputs), stats
+            reduce_output = self.selection_llm.invoke(self._reduce_messages(question, candidates)).content
+            stats["reduce_seconds"] = time.perf_counter() - reduce_started
+            selections = self._parse_selection(reduce_output, [doc for doc, _, _ in candidates])
+            return self._render_cards(question, selections), "".join(map_outputs) + reduce_output, stats
+        except Exception as e:
+            return f"回答生成中にエラーが発生しました: {e}", "", {}
+    
+    async def aformat_map_reduce(self, question: str, documents: List[Document]) -> tuple[str, str, dict]:
+        """format_map_reduce() の非同期版（map は非同期クライアントで同時に呼び出す）"""
+        if not documents:
+            return self._create_no_results_response(question), "", {}
+        
+        try:
+            started = time.perf_counter()
+            chunks = self._map_chunks(documents)
+            semaphore = asyncio.Semaphore(self.map_concurrency)
+            
+            async def map_chunk(chunk: List[Document]) -> str:
+                async with semaphore:
+                    return (await self.selection_llm.ainvoke(self._build_messages(question, chunk, "map"))).content
+            
+            map_outputs = await asyncio.gather(*(map_chunk(chunk) for chunk in chunks))
+            
+            reduce_started = time.perf_counter()
+            candidates = [candidate for chunk, output in zip(chunks, map_outputs)
+                          for candidate in self._parse_scores(output, chunk)]
+            stats = {"map_calls": len(chunks), "candidates": len(candidates),
+                     "map_seconds": reduce_started - started, "reduce_seconds": 0.0}
+            if not candidates:
+                return self._render_cards(question, []), "".join(map_outputs), stats
+            reduce_output = (await self.selection_llm.ainvoke(self._reduce_messages(question, candidates))).content
+            stats["reduce_seconds"] = time.perf_counter() - reduce_started
+            selections = self._parse_selection(reduce_output, [doc for doc, _, _ in candidates])
+            return self._render_cards(question, selections), "".join(map_outputs) + reduce_output, stats
+        except Exception as e:
+            return f"回答生成中にエラーが発生しました: {e}", "", {}
+    
     def _create_no_results_response(self, question: str) -> str:
         """検索結果がない場合の回答"""
         return f"""【質問】
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+OpenAI APIの共有HTTPトランスポート
+埋め込みとチャットの呼び出しを、プロセス内で共有するHTTPコネクションプール（keep-alive）に通し、
+段階（embedding / chat）ごとのタイムアウト・上限付きの指数バックオフのリトライ・サーキットブレーカーを
+HTTPトランスポートの層でまとめて適用する。接続の再利用やリトライの回数などの統計を取得できる
+"""
+
+import os
+import time
+import random
+import asyncio
+import threading
+import weakref
+from collections import deque
+from typing import Optional
+
+import httpx
+import numpy as np
+import openai
+
+# 呼び出しの段階（URLのパスで判定）
+STAGES = ("embedding", "chat")
+
+# リトライするHTTPステータス（429はサーバー障害ではないため、サーキットブレーカーの失敗には数えない）
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+RATE_LIMIT_STATUS = 429
+
+class CircuitOpenError(httpx.TransportError):
+    """サーキットブレーカーが開いているため、APIを呼び出さずに失敗させた"""
+
+class CircuitBreaker:
+    """
+    連続した失敗が閾値に達したら一定時間呼び出しを止めるサーキットブレーカー
+
+    止めている間（open）はすぐに失敗させ、reset_seconds 経過後は1件だけ試し（half_open）、
+    成功すれば再開（closed）、失敗すれば再び止める。
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        """
+        初期化
+
+        Args:
+            failure_threshold: 止めるまでの連続失敗回数（0で無効）
+            reset_seconds: 止めてから試しに1件通すまでの秒数
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opens = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """closed / open / half_open"""
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        """呼び出してよいか（half_open の間は試しの1件だけ通す）"""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def release(self):
+        """試しの1件が結果を判定できずに終わった場合（接続待ちのタイムアウトなど）に、次の1件を試せるようにする"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            probe_failed = self._probing
+            self._probing = False
+            if not self.failure_threshold:
+                return
+            if probe_failed or (self._opened_at is None and self.failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self.opens += 1
+
+def stage_of(request: httpx.Request) -> str:
+    """リクエストの段階（/embeddings は embedding、それ以外は chat）"""
+    return "embedding" if request.url.path.endswith("/embeddings") else "chat"
+
+class _ResilientTransport(httpx.BaseTransport):
+    """共有プールのトランスポートに、タイムアウト・リトライ・サーキットブレーカーを加えるラッパー"""
+
+    def __init__(self, owner: "OpenAITransport"):
+        self.owner = owner
+        self.inner = httpx.HTTPTransport(limits=owner.limits)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        stage = self.owner._prepare(request, self.owner._trace)
+        attempt = 0
+        while True:
+            self.owner._before_attempt(stage)
+            started = time.perf_counter()
+            try:
+                response = self.inner.handle_request(request)
+            except httpx.TransportError as e:
+                delay = self.owner._after_error(stage, attempt, e)
+                if delay is None:
+                    raise
+            else:
+                delay = self.owner._after_response(stage, attempt, response, time.perf_counter() - started)
+                if delay is None:
+                    return response
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        self.inner.close()
+
+class _AsyncResilientTransport(httpx.AsyncBaseTransport):
+    """_ResilientTransport の非同期版（接続はイベントループごとのプールに保持する）"""
+
+    def __init__(self, owner: "OpenAITransport"):
+        self.owner = owner
+        # 非同期の接続は作成したイベントループでしか使えないため、ループごとにプールを分ける
+        self.inners = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _inner(self) -> httpx.AsyncHTTPTransport:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            inner = self.inners.get(loop)
+            if inner is None:
+                inner = self.inners[loop] = httpx.AsyncHTTPTransport(limits=self.owner.limits)
+            return inner
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        stage = self.owner._prepare(request, self.owner._atrace)
+        inner = self._inner()
+        attempt = 0
+        while True:
+            self.owner._before_attempt(stage)
+            started = time.perf_counter()
+            try:
+                response = await inner.handle_async_request(request)
+            except httpx.TransportError as e:
+                delay = self.owner._after_error(stage, attempt, e)
+                if delay is None:
+                    raise
+            else:
+                delay = self.owner._after_response(stage, attempt, response, time.perf_counter() - started)
+                if delay is None:
+                    return response
+                await response.aclose()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def aclose(self):
+        inner = self.inners.get(asyncio.get_running_loop())
+        if inner is not None:
+            await inner.aclose()
+
+class OpenAITransport:
+    """埋め込み・チャットで共有するHTTPクライアント（同期版・非同期版）と、その統計"""
+
+    def __init__(
+        self,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 30.0,
+        connect_timeout: float = 5.0,
+        stage_timeouts: Optional[dict] = None,
+        max_retries: int = 2,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        failure_threshold: int = 5,
+        reset_seconds: float = 30.0,
+        latency_window: int = 1000
+    ):
+        """
+        初期化
+
+        Args:
+            max_connections: 同時に開く接続数の上限
+            max_keepalive_connections: 待機中も保持する接続数の上限
+            keepalive_expiry: 待機中の接続を閉じるまでの秒数
+            connect_timeout: 接続のタイムアウト（秒）
+            stage_timeouts: 段階 → 読み込み・書き込みのタイムアウト（秒）。ストリーミングでは断片ごとの待ち時間に適用
+                （プールの空きを待つ時間は connect_timeout。待ちきれない場合はリトライせず httpx.PoolTimeout を送出する）
+            max_retries: リトライ回数の上限（429・5xx・接続エラー・タイムアウトが対象）
+            backoff_base: 1回目のリトライまでの待機秒数（以降は倍にしてジッターを加える）
+            backoff_max: 1回あたりの待機秒数の上限（Retry-After もこの値で打ち切る）
+            failure_threshold: サーキットブレーカーを開くまでの連続失敗回数（0で無効）
+            reset_seconds: サーキットブレーカーを開いてから試しに1件通すまでの秒数
+            latency_window: 応答時間の分位点を計算する直近のリクエスト数
+        """
+        stage_timeouts = {"embedding": 10.0, "chat": 60.0, **(stage_timeouts or {})}
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeouts = {
+            stage: httpx.Timeout(stage_timeouts[stage], connect=connect_timeout, pool=connect_timeout)
+            for stage in STAGES
+        }
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breakers = {stage: CircuitBreaker(failure_threshold, reset_seconds) for stage in STAGES}
+
+        self._counts = {
+            stage: {"requests": 0, "attempts": 0, "retries": 0, "errors": 0, "timeouts": 0, "rejected": 0, "pool_timeouts": 0}
+            for stage in STAGES
+        }
+        self._latencies = {stage: deque(maxlen=latency_window) for stage in STAGES}
+        self._connections_opened = 0
+        self._lock = threading.Lock()
+
+        self._sync_transport = _ResilientTransport(self)
+        self._async_transport = _AsyncResilientTransport(self)
+        # タイムアウトはトランスポートで段階ごとに設定するため、クライアントの既定値は使われない
+        self.http_client = httpx.Client(transport=self._sync_transport, timeout=self.timeouts["chat"])
+        self.async_http_client = httpx.AsyncClient(transport=self._async_transport, timeout=self.timeouts["chat"])
+
+    def timeout(self, stage: str) -> httpx.Timeout:
+        """段階のタイムアウト"""
+        return self.timeouts[stage]
+
+    def openai_client(self, api_key: Optional[str] = None) -> openai.OpenAI:
+        """共有プールを使うOpenAIクライアント（リトライはこのトランスポートで行う）"""
+        return openai.OpenAI(api_key=api_key, http_client=self.http_client, max_retries=0)
+
+    def async_openai_client(self, api_key: Optional[str] = None) -> openai.AsyncOpenAI:
+        """openai_client() の非同期版"""
+        return openai.AsyncOpenAI(api_key=api_key, http_client=self.async_http_client, max_retries=0)
+
+    def _count(self, stage: str, key: str, value: int = 1):
+        with self._lock:
+            self._counts[stage][key] += value
+
+    def _trace(self, event: str, info: dict):
+        # 新しく接続した回数（リクエスト数との差が keep-alive で再利用した回数）
+        if event == "connection.connect_tcp.complete":
+            with self._lock:
+                self._connections_opened += 1
+
+    async def _atrace(self, event: str, info: dict):
+        self._trace(event, info)
+
+    def _prepare(self, request: httpx.Request, trace) -> str:
+        """段階のタイムアウトと接続の計測を設定し、段階を返す"""
+        stage = stage_of(request)
+        request.extensions["timeout"] = self.timeouts[stage].as_dict()
+        request.extensions["trace"] = trace
+        self._count(stage, "requests")
+        return stage
+
+    def _before_attempt(self, stage: str):
+        if not self.breakers[stage].allow():
+            self._count(stage, "rejected")
+            raise CircuitOpenError(f"{stage} のAPI呼び出しが続けて失敗したため、一時的に停止しています")
+        self._count(stage, "attempts")
+
+    def _retry_delay(self, attempt: int, response: Optional[httpx.Response] = None) -> float:
+        """待機秒数（Retry-After があれば優先、なければ指数バックオフ＋ジッター。どちらも backoff_max まで）"""
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        return min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def _after_error(self, stage: str, attempt: int, error: Exception) -> Optional[float]:
+        """接続エラー・タイムアウトの記録。リトライする場合は待機秒数、しない場合はNone"""
+        if isinstance(error, httpx.PoolTimeout):
+            # プロセス内の接続数の上限による待ちはAPIの障害ではないため、サーキットブレーカーの失敗に数えず、
+            # リトライで待ちを増やさずにそのまま失敗させる
+            self.breakers[stage].release()
+            self._count(stage, "pool_timeouts")
+            return None
+        self.breakers[stage].record_failure()
+        self._count(stage, "timeouts" if isinstance(error, httpx.TimeoutException) else "errors")
+        if attempt >= self.max_retries:
+            return None
+        self._count(stage, "retries")
+        return self._retry_delay(attempt)
+
+    def _after_response(self, stage: str, attempt: int, response: httpx.Response, seconds: float) -> Optional[float]:
+        """応答の記録。リトライする場合は待機秒数、しない場合（成功・リトライ対象外・回数超過）はNone"""
+        status = response.status_code
+        if status >= 500 or status == 408:
+            self.breakers[stage].record_failure()
+            self._count(stage, "errors")
+        else:
+            # 4xx はサーバーが応答できているため、サーキットブレーカーには成功として数える
+            self.breakers[stage].record_success()
+            with self._lock:
+                self._latencies[stage].append(seconds)
+        if status not in RETRYABLE_STATUS or attempt >= self.max_retries:
+            return None
+        self._count(stage, "retries")
+        return self._retry_delay(attempt, response)
+
+    def _pool_connections(self) -> list:
+        # httpx の内部のプール（httpcore）から現在の接続を数える
+        transports = [self._sync_transport.inner] + list(self._async_transport.inners.values())
+        pools = [getattr(transport, "_pool", None) for transport in transports]
+        return [connection for pool in pools if pool is not None for connection in pool.connections]
+
+    def stats(self) -> dict:
+        """
+        接続とリトライの統計
+
+        Returns:
+            connections_opened（新しく接続した回数）・connections_reused（keep-alive で再利用した回数）・
+            connections_open / connections_idle（現在の接続数）と、段階ごとの
+            requests・retries・errors・timeouts・rejected（サーキットブレーカーで止めた回数）・
+            pool_timeouts（接続数の上限で空きを待ちきれなかった回数）・
+            latency_p50 / latency_p95（応答ヘッダーまでの秒数）・circuit（状態）・circuit_opens
+        """
+        connections = self._pool_connections()
+        with self._lock:
+            # 接続待ちでタイムアウトした試行は接続を使っていない
+            attempts = sum(counts["attempts"] - counts["pool_timeouts"] for counts in self._counts.values())
+            stats = {
+                "connections_opened": self._connections_opened,
+                "connections_reused": max(attempts - self._connections_opened, 0),
+                "connections_open": len(connections),
+                "connections_idle": sum(1 for connection in connections if connection.is_idle()),
+                "stages": {}
+            }
+            for stage in STAGES:
+                latencies = list(self._latencies[stage])
+                stats["stages"][stage] = {
+                    **self._counts[stage],
+                    "latency_p50": float(np.percentile(latencies, 50)) if latencies else 0.0,
+                    "latency_p95": float(np.percentile(latencies, 95)) if latencies else 0.0,
+                    "circuit": self.breakers[stage].state,
+                    "circuit_opens": self.breakers[stage].opens
+                }
+        return stats
+
+    def close(self):
+        """同期版の接続を閉じる"""
+        self.http_client.close()
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def get_transport() -> OpenAITransport:
+    """
+    プロセス内で共有するトランスポートを取得（初回のみ環境変数の設定で作成）
+
+    - VENDOR_RAG_HTTP_MAX_CONNECTIONS: 同時に開く接続数の上限（デフォルト: 20）
+    - VENDOR_RAG_HTTP_KEEPALIVE: 待機中の接続を閉じるまでの秒数（デフォルト: 30）
+    - VENDOR_RAG_CONNECT_TIMEOUT: 接続のタイムアウト秒数（デフォルト: 5）
+    - VENDOR_RAG_EMBEDDING_TIMEOUT / VENDOR_RAG_CHAT_TIMEOUT: 段階ごとの読み込みのタイムアウト秒数（デフォルト: 10 / 60）
+    - VENDOR_RAG_MAX_RETRIES: リトライ回数の上限（デフォルト: 2）
+    - VENDOR_RAG_CIRCUIT_FAILURES: サーキットブレーカーを開く連続失敗回数（デフォルト: 5、0で無効）
+    - VENDOR_RAG_CIRCUIT_RESET: サーキットブレーカーを開いてから試しに1件通すまでの秒数（デフォルト: 30）
+    """
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            max_connections = int(os.getenv("VENDOR_RAG_HTTP_MAX_CONNECTIONS", 20))
+            _transport = OpenAITransport(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=float(os.getenv("VENDOR_RAG_HTTP_KEEPALIVE", 30)),
+                connect_timeout=float(os.getenv("VENDOR_RAG_CONNECT_TIMEOUT", 5)),
+                stage_timeouts={
+                    "embedding": float(os.getenv("VENDOR_RAG_EMBEDDING_TIMEOUT", 10)),
+                    "chat": float(os.getenv("VENDOR_RAG_CHAT_TIMEOUT", 60)),
+                },
+                max_retries=int(os.getenv("VENDOR_RAG_MAX_RETRIES", 2)),
+                failure_threshold=int(os.getenv("VENDOR_RAG_CIRCUIT_FAILURES", 5)),
+                reset_seconds=float(os.getenv("VENDOR_RAG_CIRCUIT_RESET", 30))
+            )
+        return _transport
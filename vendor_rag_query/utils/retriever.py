@@ -4,131 +4,503 @@
 ベクトルDBからチャンクを検索するモジュール
 """
 
-import os
+import asyncio
+import threading
 from typing import List, Optional
-from langchain_community.vectorstores import Chroma
 from langchain_community.embeddings import OpenAIEmbeddings
 from langchain.schema import Document
-from langchain_community.retrievers import MMRRetriever
+from .embedding_cache import EmbeddingCache, CachedEmbeddings, default_cache_path
+from .index_manager import IndexPointer, resolve_index_path
+from .lexical_index import LexicalIndex, reciprocal_rank_fusion
+from .filter_index import FilterIndex, normalize_filters
+from .alias_index import AliasIndex
+from .vector_backends import BACKENDS, open_backend
+from .openai_transport import get_transport
+
+# 検索方法（mmr: 多様性重視 / similarity: 類似度のみ / hybrid: キーワード検索とベクトル検索の統合）
+SEARCH_TYPES = ("mmr", "similarity", "hybrid")
+
+# MMRの既定値（fetch_k 未指定時は max(k * 4, 20) 件の候補から選ぶ）
+DEFAULT_LAMBDA_MULT = 0.7
+
+class IndexSnapshot:
+    """
+    公開中の1つのバージョンのベクトル検索バックエンドと補助インデックス（読み込み後は変更しない）
+    
+    バージョンの切り替えではスナップショットごと差し替えるため、バックエンドと補助インデックスの
+    バージョンが食い違った状態にはならない。
+    """
+    
+    def __init__(self, index_path: str, index_version: Optional[str], backend, lexical_index: Optional[LexicalIndex],
+                 filter_index: Optional[FilterIndex], alias_index: Optional[AliasIndex]):
+        self.index_path = index_path
+        self.index_version = index_version
+        self.backend = backend
+        # Chromaバックエンドの場合のみ（NumPy形式ではNone）
+        self.vectorstore = getattr(backend, "vectorstore", None)
+        # 構築前の旧バージョンにはないためNoneになる
+        self.lexical_index = lexical_index
+        self.filter_index = filter_index
+        self.alias_index = alias_index
 
 class VendorRetriever:
     """ベンダー情報検索クラス"""
     
-    def __init__(self, vectordb_path: str = "vectordb", api_key: Optional[str] = None):
+    def __init__(self, vectordb_path: str = "vectordb", api_key: Optional[str] = None, backend: str = "auto"):
         """
         初期化
         
         Args:
             vectordb_path: ベクトルDBのパス
             api_key: OpenAI APIキー
+            backend: ベクトル検索のバックエンド（"auto" / "chroma" / "numpy"。auto はNumPy形式があれば優先）
         """
         self.vectordb_path = vectordb_path
         self.api_key = api_key
-        self.vectorstore = None
-        self.retriever = None
+        self.backend_name = backend
+        self.embedding_cache = None
+        self.embeddings = None
+        # 公開中のバージョンのスナップショット（読み込み直しは1回の代入で差し替える）
+        self.index = None
+        self.index_pointer = IndexPointer(vectordb_path)
+        self._reload_lock = threading.Lock()
         
         self._initialize_vectorstore()
     
+    @property
+    def backend(self):
+        return self.index.backend if self.index else None
+    
+    @property
+    def vectorstore(self):
+        return self.index.vectorstore if self.index else None
+    
+    @property
+    def lexical_index(self) -> Optional[LexicalIndex]:
+        return self.index.lexical_index if self.index else None
+    
+    @property
+    def filter_index(self) -> Optional[FilterIndex]:
+        return self.index.filter_index if self.index else None
+    
+    @property
+    def alias_index(self) -> Optional[AliasIndex]:
+        return self.index.alias_index if self.index else None
+    
+    @property
+    def index_path(self) -> Optional[str]:
+        return self.index.index_path if self.index else None
+    
+    @property
+    def index_version(self) -> Optional[str]:
+        return self.index.index_version if self.index else None
+    
     def _initialize_vectorstore(self):
         """ベクトルストアの初期化"""
         try:
-            # ベクトルDBの存在確認
-            if not os.path.exists(self.vectordb_path):
-                raise FileNotFoundError(f"ベクトルDBが見つかりません: {self.vectordb_path}")
-            
-            # OpenAI Embeddingsの初期化
-            embeddings = OpenAIEmbeddings(
-                model="text-embedding-ada-002",
-                openai_api_key=self.api_key
-            )
+            # ベクトルDBの存在確認（公開中のバージョン、または旧形式のディレクトリ）
+            resolve_index_path(self.vectordb_path)
             
-            # Chromaベクトルストアの読み込み
-            self.vectorstore = Chroma(
-                persist_directory=self.vectordb_path,
-                embedding_function=embeddings
+            # OpenAI Embeddingsの初期化（永続キャッシュでラップし、同じ質問の再埋め込みを避ける）
+            # 接続・タイムアウト・リトライは共有トランスポートで管理する（クライアント側のリトライは無効化）
+            transport = get_transport()
+            self.embedding_cache = EmbeddingCache(default_cache_path(self.vectordb_path))
+            self.embeddings = CachedEmbeddings(
+                OpenAIEmbeddings(
+                    model="text-embedding-ada-002",
+                    openai_api_key=self.api_key,
+                    client=transport.openai_client(self.api_key).embeddings,
+                    async_client=transport.async_openai_client(self.api_key).embeddings,
+                    request_timeout=transport.timeout("embedding"),
+                    max_retries=0
+                ),
+                self.embedding_cache,
+                model="text-embedding-ada-002"
             )
             
-            # MMR Retrieverの初期化
-            self.retriever = MMRRetriever(
-                vectorstore=self.vectorstore,
-                fetch_k=10,  # より多くの候補を取得
-                k=5,         # 最終的に5件を返す
-                lambda_mult=0.7  # 多様性の重み
-            )
+            # ベクトル検索バックエンド（Chroma または NumPy形式）の読み込み
+            index = self._refresh_if_updated()
             
-            print(f"ベクトルDBを読み込みました: {self.vectordb_path}")
+            print(f"ベクトルDBを読み込みました: {index.index_path}"
+                  f"（バージョン: {index.index_version or '旧形式'} / バックエンド: {index.backend.name}）")
             
         except Exception as e:
             raise Exception(f"ベクトルストアの初期化に失敗しました: {e}")
     
-    def search_similarity(self, query: str, k: int = 5) -> List[Document]:
+    def _load_index(self) -> IndexSnapshot:
+        """公開中のバージョンのベクトル検索バックエンドと補助インデックスを読み込み"""
+        index_path, index_version = resolve_index_path(self.vectordb_path)
+        return IndexSnapshot(
+            index_path,
+            index_version,
+            open_backend(index_path, self.embeddings, self.backend_name),
+            LexicalIndex.load(index_path),
+            FilterIndex.load(index_path),
+            AliasIndex.load(index_path),
+        )
+    
+    def _refresh_if_updated(self) -> IndexSnapshot:
+        """
+        取り込みで CURRENT が切り替わっていれば、新しいバージョンを読み込み直す（再起動不要）
+        
+        すべて読み込めてから1回の代入で差し替え、その後で確認済みにする。途中で失敗した場合は
+        今のスナップショットのまま残し、次の呼び出しで読み込みをやり直す。
+        
+        Returns:
+            公開中のバージョンのスナップショット
+        """
+        if self.index_pointer.changed() is not None:
+            with self._reload_lock:
+                # 待っている間に他のスレッドが読み込み直していれば、それを使う
+                stat_key = self.index_pointer.changed()
+                if stat_key is not None:
+                    self.index = self._load_index()
+                    self.index_pointer.commit(stat_key)
+        return self.index
+    
+    def _resolve_candidates(self, index: IndexSnapshot, filters: Optional[dict]) -> Optional[List[str]]:
+        """
+        絞り込み条件に一致するベンダーIDを取得
+        
+        Returns:
+            候補のベンダーIDのリスト（絞り込みなし、または全件が一致する場合はNone）
+        """
+        if not normalize_filters(filters):
+            return None
+        if index.filter_index is None:
+            raise ValueError("絞り込み用インデックスがありません。取り込みを再実行してください")
+        
+        candidate_ids = index.filter_index.match(filters)
+        print(f"絞り込み条件に一致するベンダー: {len(candidate_ids)}件 / {len(index.filter_index)}件")
+        if len(candidate_ids) == len(index.filter_index):
+            return None
+        return candidate_ids
+    
+    def search_similarity(self, query: str, k: int = 5, filters: Optional[dict] = None) -> List[Document]:
         """
         類似度検索
         
         Args:
             query: 検索クエリ
             k: 取得するドキュメント数
+            filters: 絞り込み条件（一致するベンダーだけをスコアリング対象にする）
             
         Returns:
             検索結果のドキュメントリスト
         """
         try:
-            if not self.vectorstore:
+            if not self.index:
                 raise ValueError("ベクトルストアが初期化されていません")
             
-            results = self.vectorstore.similarity_search(query, k=k)
+            index = self._refresh_if_updated()
+            candidate_ids = self._resolve_candidates(index, filters)
+            if candidate_ids is not None and not candidate_ids:
+                return []
+            results = index.backend.similarity_search(query, k=k, candidate_ids=candidate_ids)
             print(f"類似度検索で {len(results)} 件のベンダー情報を取得しました")
             return results
             
         except Exception as e:
             raise Exception(f"類似度検索に失敗しました: {e}")
     
-    def search_mmr(self, query: str, k: int = 5) -> List[Document]:
+    def search_mmr(self, query: str, k: int = 5, filters: Optional[dict] = None, fetch_k: Optional[int] = None,
+                   lambda_mult: float = DEFAULT_LAMBDA_MULT) -> List[Document]:
         """
         MMR（Maximum Marginal Relevance）検索
         
+        上位 fetch_k 件の候補とその保存済みベクトルを1回で取得し、候補同士の類似度行列を使った
+        行列演算で k 件を選ぶ（fetch_k を数百〜1000にしても実用的な速度で動く）。
+        
         Args:
             query: 検索クエリ
             k: 取得するドキュメント数
+            filters: 絞り込み条件（一致するベンダーだけをスコアリング対象にする）
+            fetch_k: 多様性を考慮する候補数（未指定時は max(k * 4, 20)）
+            lambda_mult: 関連性の重み（1に近いほど関連性、0に近いほど多様性を重視）
             
         Returns:
             検索結果のドキュメントリスト
         """
         try:
-            if not self.retriever:
-                raise ValueError("MMR Retrieverが初期化されていません")
+            if not self.index:
+                raise ValueError("ベクトルストアが初期化されていません")
             
-            results = self.retriever.get_relevant_documents(query)
+            index = self._refresh_if_updated()
+            candidate_ids = self._resolve_candidates(index, filters)
+            if candidate_ids is not None and not candidate_ids:
+                results = []
+            else:
+                results = index.backend.max_marginal_relevance_search(
+                    query,
+                    k=k,
+                    fetch_k=max(fetch_k or max(k * 4, 20), k),
+                    lambda_mult=lambda_mult,
+                    candidate_ids=candidate_ids
+                )
             print(f"MMR検索で {len(results)} 件のベンダー情報を取得しました")
             return results
             
         except Exception as e:
             raise Exception(f"MMR検索に失敗しました: {e}")
     
-    def search(self, query: str, k: int = 5, use_mmr: bool = True) -> List[Document]:
+    def _fuse_hybrid(self, index: IndexSnapshot, query: str, vector_results: List[Document], k: int,
+                     candidate_ids: Optional[List[str]] = None) -> List[Document]:
+        """キーワード検索（n-gram BM25）の結果とベクトル検索の結果を Reciprocal Rank Fusion で統合"""
+        vector_docs = {doc.metadata.get("vendor_id"): doc for doc in vector_results}
+        lexical_hits = index.lexical_index.search(
+            query, k=max(k * 4, 20), candidate_ids=set(candidate_ids) if candidate_ids is not None else None
+        )
+        lexical_ids = [vendor_id for vendor_id, _ in lexical_hits]
+        fused_ids = [vendor_id for vendor_id, _ in reciprocal_rank_fusion([list(vector_docs), lexical_ids])[:k]]
+        
+        # キーワード検索のみでヒットしたベンダーは本文とメタデータをまとめて取得する
+        lexical_only = {
+            doc.metadata["vendor_id"]: doc
+            for doc in index.backend.get_documents([vendor_id for vendor_id in fused_ids if vendor_id not in vector_docs])
+        }
+        return [
+            vector_docs.get(vendor_id) or lexical_only[vendor_id]
+            for vendor_id in fused_ids
+            if vendor_id in vector_docs or vendor_id in lexical_only
+        ]
+    
+    def search_hybrid(self, query: str, k: int = 5, filters: Optional[dict] = None) -> List[Document]:
+        """
+        ハイブリッド検索（n-gram BM25のキーワード検索とベクトル検索を Reciprocal Rank Fusion で統合）
+        
+        Args:
+            query: 検索クエリ
+            k: 取得するドキュメント数
+            filters: 絞り込み条件（一致するベンダーだけをスコアリング対象にする）
+            
+        Returns:
+            検索結果のドキュメントリスト
+        """
+        try:
+            if not self.index:
+                raise ValueError("ベクトルストアが初期化されていません")
+            
+            index = self._refresh_if_updated()
+            candidate_ids = self._resolve_candidates(index, filters)
+            if candidate_ids is not None and not candidate_ids:
+                return []
+            vector_results = index.backend.similarity_search(query, k=max(k * 4, 20), candidate_ids=candidate_ids)
+            if index.lexical_index is None:
+                print("キーワード検索用インデックスがないため、類似度検索で代替します")
+                return vector_results[:k]
+            
+            results = self._fuse_hybrid(index, query, vector_results, k, candidate_ids)
+            print(f"ハイブリッド検索で {len(results)} 件のベンダー情報を取得しました")
+            return results
+            
+        except Exception as e:
+            raise Exception(f"ハイブリッド検索に失敗しました: {e}")
+    
+    def _resolve_mentions(self, index: IndexSnapshot, queries: List[str], candidate_ids: Optional[List[str]]) -> list:
+        """
+        質問ごとに言及されたベンダーをベンダー名辞書で特定（埋め込み不要）
+        
+        Returns:
+            質問ごとの (言及されたベンダーIDのリスト, ベンダー名だけで特定できたかどうか)。
+            絞り込み条件に一致しないベンダーは除外し、残らなければ未特定として扱う
+        """
+        if index.alias_index is None:
+            return [([], False) for _ in queries]
+        
+        allowed = set(candidate_ids) if candidate_ids is not None else None
+        mentions = []
+        for query in queries:
+            vendor_ids, resolved = index.alias_index.resolve(query)
+            if allowed is not None:
+                vendor_ids = [vendor_id for vendor_id in vendor_ids if vendor_id in allowed]
+            mentions.append((vendor_ids, resolved and bool(vendor_ids)))
+        return mentions
+    
+    def _merge_mentions(self, index: IndexSnapshot, mentions: list, results: List[List[Document]],
+                        k: int) -> List[List[Document]]:
+        """言及されたベンダーを検索結果の先頭に置く（特定できた質問は言及されたベンダーのみ）"""
+        mentioned_ids = list(dict.fromkeys(vendor_id for vendor_ids, _ in mentions for vendor_id in vendor_ids))
+        if not mentioned_ids:
+            return results
+        
+        documents = {doc.metadata["vendor_id"]: doc for doc in index.backend.get_documents(mentioned_ids)}
+        merged = []
+        for (vendor_ids, _), docs in zip(mentions, results):
+            pinned = [documents[vendor_id] for vendor_id in vendor_ids if vendor_id in documents]
+            pinned_ids = {doc.metadata["vendor_id"] for doc in pinned}
+            merged.append((pinned + [doc for doc in docs if doc.metadata.get("vendor_id") not in pinned_ids])[:k])
+        return merged
+    
+    def search(self, query: str, k: int = 5, use_mmr: bool = True, search_type: Optional[str] = None,
+               filters: Optional[dict] = None, fetch_k: Optional[int] = None,
+               lambda_mult: float = DEFAULT_LAMBDA_MULT) -> List[Document]:
         """
         検索実行（デフォルトでMMR使用）
         
+        質問に含まれるベンダー名・別名は結果の先頭に置き、ベンダー名だけで特定できる質問
+        （「ハブルの概要は？」など）は埋め込みとベクトル検索を省略して該当ベンダーを返す。
+        
         Args:
             query: 検索クエリ
             k: 取得するドキュメント数
-            use_mmr: MMR検索を使用するかどうか
+            use_mmr: MMR検索を使用するかどうか（search_type 未指定時のみ参照）
+            search_type: 検索方法（"mmr" / "similarity" / "hybrid"）
+            filters: 絞り込み条件（例: {"industry_tags": ["製造業"], "deployment": ["SaaS"]}）。
+                絞り込み用インデックスがない旧バージョンでは、ベンダー名で特定できる質問でもエラーにする
+            fetch_k: MMRで多様性を考慮する候補数（未指定時は max(k * 4, 20)）
+            lambda_mult: MMRの関連性の重み
             
         Returns:
             検索結果のドキュメントリスト
         """
-        if use_mmr:
-            return self.search_mmr(query, k)
-        else:
-            return self.search_similarity(query, k)
+        return self.search_many(
+            [query], k=k, use_mmr=use_mmr, search_type=search_type,
+            filters=filters, fetch_k=fetch_k, lambda_mult=lambda_mult
+        )[0]
+    
+    def _search_by_vectors(self, index: IndexSnapshot, queries: List[str], query_vectors: List[List[float]], k: int,
+                           search_type: str, candidate_ids: Optional[List[str]], fetch_k: Optional[int],
+                           lambda_mult: float) -> List[List[Document]]:
+        """埋め込み済みの質問でベクトル検索（search_many と asearch_many で共通）"""
+        if search_type == "mmr":
+            return index.backend.max_marginal_relevance_search_by_vectors(
+                query_vectors,
+                k=k,
+                fetch_k=max(fetch_k or max(k * 4, 20), k),
+                lambda_mult=lambda_mult,
+                candidate_ids=candidate_ids
+            )
+        if search_type == "hybrid" and index.lexical_index is not None:
+            vector_results = index.backend.similarity_search_by_vectors(
+                query_vectors, k=max(k * 4, 20), candidate_ids=candidate_ids
+            )
+            return [
+                self._fuse_hybrid(index, query, docs, k, candidate_ids)
+                for query, docs in zip(queries, vector_results)
+            ]
+        return index.backend.similarity_search_by_vectors(query_vectors, k=k, candidate_ids=candidate_ids)
+    
+    def search_many(self, queries: List[str], k: int = 5, use_mmr: bool = True, search_type: Optional[str] = None,
+                    filters: Optional[dict] = None, fetch_k: Optional[int] = None,
+                    lambda_mult: float = DEFAULT_LAMBDA_MULT) -> List[List[Document]]:
+        """
+        複数の質問をまとめて検索
+        
+        全質問の埋め込みを1回のバッチリクエスト（キャッシュ済みの質問は除く）で取得し、
+        ベクトル検索もバックエンドへの1回の問い合わせ・行列積でまとめて行う。
+        ベンダー名だけで特定できる質問は埋め込みもベクトル検索も行わない。
+        引数は search() と同じ（絞り込み条件は全質問に共通）。
+        
+        Returns:
+            質問ごとの検索結果のドキュメントリスト（入力と同じ順序）
+        """
+        search_type = search_type or ("mmr" if use_mmr else "similarity")
+        if search_type not in SEARCH_TYPES:
+            raise ValueError(f"不明な検索方法です: {search_type}")
+        
+        try:
+            if not self.index:
+                raise ValueError("ベクトルストアが初期化されていません")
+            
+            queries = list(queries)
+            if not queries:
+                return []
+            
+            # 1回の検索はここで取得したスナップショットだけを使う（検索中に他のスレッドが読み込み直しても、
+            # 絞り込み・ベクトル検索・キーワード検索・ベンダー名辞書のバージョンは食い違わない）
+            index = self._refresh_if_updated()
+            candidate_ids = self._resolve_candidates(index, filters)
+            if candidate_ids is not None and not candidate_ids:
+                return [[] for _ in queries]
+            
+            # ベンダー名だけで特定できた質問は埋め込みとベクトル検索を省略する
+            mentions = self._resolve_mentions(index, queries, candidate_ids)
+            pending = [i for i, (_, resolved) in enumerate(mentions) if not resolved]
+            results = [[] for _ in queries]
+            if pending:
+                pending_queries = [queries[i] for i in pending]
+                query_vectors = self.embeddings.embed_documents(pending_queries)
+                pending_results = self._search_by_vectors(
+                    index, pending_queries, query_vectors, k, search_type, candidate_ids, fetch_k, lambda_mult
+                )
+                for i, docs in zip(pending, pending_results):
+                    results[i] = docs
+            
+            print(f"{len(queries)} 件の質問を検索しました（ベンダー名で特定: {len(queries) - len(pending)}件）")
+            return self._merge_mentions(index, mentions, results, k)
+            
+        except Exception as e:
+            raise Exception(f"検索に失敗しました: {e}")
+    
+    async def asearch_many(self, queries: List[str], k: int = 5, use_mmr: bool = True, search_type: Optional[str] = None,
+                           filters: Optional[dict] = None, fetch_k: Optional[int] = None,
+                           lambda_mult: float = DEFAULT_LAMBDA_MULT) -> List[List[Document]]:
+        """
+        search_many() の非同期版
+        
+        埋め込みは非同期クライアントで待ち、ローカルのベクトル検索は asyncio.to_thread で
+        既定のスレッドプール（上限あり）に渡す。質問ごとにスレッドを占有しない。
+        """
+        search_type = search_type or ("mmr" if use_mmr else "similarity")
+        if search_type not in SEARCH_TYPES:
+            raise ValueError(f"不明な検索方法です: {search_type}")
+        
+        try:
+            if not self.index:
+                raise ValueError("ベクトルストアが初期化されていません")
+            
+            queries = list(queries)
+            if not queries:
+                return []
+            
+            # 新しいバージョンが公開されていれば、読み込み直しもスレッドで行う
+            if self.index_pointer.changed() is not None:
+                await asyncio.to_thread(self._refresh_if_updated)
+            index = self._refresh_if_updated()
+            candidate_ids = self._resolve_candidates(index, filters)
+            if candidate_ids is not None and not candidate_ids:
+                return [[] for _ in queries]
+            
+            mentions = self._resolve_mentions(index, queries, candidate_ids)
+            pending = [i for i, (_, resolved) in enumerate(mentions) if not resolved]
+            results = [[] for _ in queries]
+            if pending:
+                pending_queries = [queries[i] for i in pending]
+                query_vectors = await self.embeddings.aembed_documents(pending_queries)
+                pending_results = await asyncio.to_thread(
+                    self._search_by_vectors, index, pending_queries, query_vectors, k, search_type, candidate_ids,
+                    fetch_k, lambda_mult
+                )
+                for i, docs in zip(pending, pending_results):
+                    results[i] = docs
+            
+            print(f"{len(queries)} 件の質問を検索しました（ベンダー名で特定: {len(queries) - len(pending)}件）")
+            return self._merge_mentions(index, mentions, results, k)
+            
+        except Exception as e:
+            raise Exception(f"検索に失敗しました: {e}")
+    
+    async def asearch(self, query: str, k: int = 5, use_mmr: bool = True, search_type: Optional[str] = None,
+                      filters: Optional[dict] = None, fetch_k: Optional[int] = None,
+                      lambda_mult: float = DEFAULT_LAMBDA_MULT) -> List[Document]:
+        """search() の非同期版（引数は search() と同じ）"""
+        return (await self.asearch_many(
+            [query], k=k, use_mmr=use_mmr, search_type=search_type,
+            filters=filters, fetch_k=fetch_k, lambda_mult=lambda_mult
+        ))[0]
+    
+    def get_cache_stats(self) -> dict:
+        """埋め込みキャッシュの統計を取得"""
+        if not self.embedding_cache:
+            return {}
+        return self.embedding_cache.stats()
     
     def get_document_count(self) -> int:
         """ベクトルDB内のドキュメント数を取得"""
         try:
-            if not self.vectorstore:
+            if not self.index:
                 return 0
             
-            collection = self.vectorstore._collection
-            return collection.count()
+            return self._refresh_if_updated().backend.count()
         except Exception:
             return 0
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ベクトル検索のバックエンド
+Chroma と、正規化済みベクトルをメモリマップした .npy 行列で厳密検索する NumPy 形式を
+同じインターフェースで扱えるようにする
+
+NumPy形式のファイル（インデックスのバージョンのディレクトリに配置）:
+  vectors.npy           # float32 の (件数, 次元) 行列（行ごとにL2正規化済み）
+  vector_records.jsonl  # 1行1件の {"id", "page_content", "metadata"}
+  vector_offsets.npy    # vector_records.jsonl の各行の開始バイト位置（件数+1）
+  vector_ids.json       # 行番号 → ベンダーID
+
+行列・オフセットは読み取り専用でメモリマップするため、読み込みは一瞬で、
+複数のワーカープロセスがOSのページキャッシュを共有できる。
+"""
+
+import os
+import json
+import mmap
+import shutil
+from typing import Iterable, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.vectorstores import Chroma
+
+VECTORS_FILE = "vectors.npy"
+RECORDS_FILE = "vector_records.jsonl"
+OFFSETS_FILE = "vector_offsets.npy"
+IDS_FILE = "vector_ids.json"
+CHROMA_FILE = "chroma.sqlite3"
+
+BACKENDS = ("auto", "chroma", "numpy")
+
+def has_numpy_store(index_path: str) -> bool:
+    """NumPy形式のファイルがあるかどうか"""
+    return all(os.path.exists(os.path.join(index_path, name)) for name in (VECTORS_FILE, RECORDS_FILE, OFFSETS_FILE, IDS_FILE))
+
+def has_chroma_store(index_path: str) -> bool:
+    """Chromaの永続化ファイルがあるかどうか"""
+    return os.path.exists(os.path.join(index_path, CHROMA_FILE))
+
+def _chroma_where(candidate_ids: Optional[List[str]]) -> Optional[dict]:
+    """候補のベンダーIDをChromaの検索条件に変換"""
+    return {"vendor_id": {"$in": candidate_ids}} if candidate_ids is not None else None
+
+def write_numpy_store(index_path: str, records: Iterable[tuple[str, str, dict, list]], count: int) -> int:
+    """
+    NumPy形式のファイルを書き出す
+
+    Args:
+        index_path: 出力先（インデックスのバージョンのディレクトリ）
+        records: (ID, 本文, メタデータ, 埋め込みベクトル) の列
+        count: 件数（行列の確保に使う）
+
+    Returns:
+        書き出した件数
+    """
+    matrix = None
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    ids = []
+    records_path = os.path.join(index_path, RECORDS_FILE)
+    vectors_path = os.path.join(index_path, VECTORS_FILE)
+
+    with open(records_path, "wb") as f:
+        for row, (doc_id, content, metadata, vector) in enumerate(records):
+            if row >= count:
+                raise ValueError(f"件数が想定より多くなっています（想定: {count}件）")
+            vector = np.asarray(vector, dtype=np.float32)
+            if matrix is None:
+                matrix = np.lib.format.open_memmap(vectors_path, mode="w+", dtype=np.float32, shape=(count, len(vector)))
+            norm = np.linalg.norm(vector)
+            matrix[row] = vector / norm if norm else vector
+
+            line = json.dumps({"id": doc_id, "page_content": content, "metadata": metadata}, ensure_ascii=False)
+            f.write(line.encode("utf-8") + b"\n")
+            offsets[row + 1] = f.tell()
+            ids.append(doc_id)
+
+    if len(ids) != count:
+        raise ValueError(f"件数が一致しません（想定: {count}件 / 実際: {len(ids)}件）")
+    if matrix is not None:
+        matrix.flush()
+        del matrix
+    else:
+        np.save(vectors_path, np.zeros((0, 0), dtype=np.float32))
+
+    np.save(os.path.join(index_path, OFFSETS_FILE), offsets)
+    with open(os.path.join(index_path, IDS_FILE), "w", encoding="utf-8") as f:
+        json.dump(ids, f, ensure_ascii=False)
+    return len(ids)
+
+def remove_chroma_store(index_path: str):
+    """Chromaの永続化ファイル（SQLiteとセグメントのディレクトリ）を削除（NumPy形式のみで公開する場合）"""
+    for name in os.listdir(index_path):
+        path = os.path.join(index_path, name)
+        if name.startswith(CHROMA_FILE):
+            os.remove(path)
+        elif os.path.isdir(path):
+            shutil.rmtree(path)
+
+def _normalize(vector) -> np.ndarray:
+    """ベクトル（または行列の各行）をL2正規化"""
+    vector = np.asarray(vector, dtype=np.float32)
+    norms = np.linalg.norm(vector, axis=-1, keepdims=True)
+    return vector / np.where(norms == 0, 1, norms)
+
+def mmr_select(query_vector: np.ndarray, candidate_vectors: np.ndarray, k: int, lambda_mult: float) -> List[int]:
+    """
+    MMR（Maximal Marginal Relevance）による貪欲選択を行列演算で実行
+
+    候補同士の類似度行列を最初に1回だけ計算し、選択済みベンダーとの最大類似度を
+    ベクトルで更新していくため、各ステップは候補数に比例する計算だけで済む。
+
+    Args:
+        query_vector: クエリのベクトル
+        candidate_vectors: 候補のベクトル（類似度の高い順、(候補数, 次元)）
+        k: 選択する件数
+        lambda_mult: 関連性の重み（1に近いほど関連性、0に近いほど多様性を重視）
+
+    Returns:
+        選択した候補の位置（選択順）
+    """
+    if not len(candidate_vectors):
+        return []
+    candidates = _normalize(candidate_vectors)
+    relevance = candidates @ _normalize(query_vector)
+    similarity = candidates @ candidates.T
+
+    k = min(k, len(candidates))
+    selected = [int(np.argmax(relevance))]
+    max_similarity = similarity[selected[0]].copy()
+    available = np.ones(len(candidates), dtype=bool)
+    available[selected[0]] = False
+
+    while len(selected) < k:
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+    return selected
+
+class ChromaBackend:
+    """Chromaによるバックエンド"""
+
+    name = "chroma"
+
+    def __init__(self, index_path: str, embeddings):
+        """
+        初期化
+
+        Args:
+            index_path: Chroma永続化ディレクトリ
+            embeddings: クエリの埋め込みに使うEmbeddings
+        """
+        self.embeddings = embeddings
+        self.vectorstore = Chroma(persist_directory=index_path, embedding_function=embeddings)
+
+    def count(self) -> int:
+        """ドキュメント数"""
+        return self.vectorstore._collection.count()
+
+    def _query(self, query_vectors: list, n: int, candidate_ids: Optional[List[str]], include: list) -> Optional[dict]:
+        """複数クエリの上位n件を1回の問い合わせで取得（対象が0件の場合はNone）"""
+        collection = self.vectorstore._collection
+        n_results = min(n, len(candidate_ids) if candidate_ids is not None else collection.count())
+        if n_results <= 0 or not len(query_vectors):
+            return None
+        return collection.query(
+            query_embeddings=[list(map(float, vector)) for vector in query_vectors],
+            n_results=n_results,
+            where=_chroma_where(candidate_ids),
+            include=include
+        )
+
+    def similarity_search_by_vectors(self, query_vectors: list, k: int,
+                                     candidate_ids: Optional[List[str]] = None) -> List[List[Document]]:
+        """複数クエリの類似度検索（クエリごとの結果のリスト）"""
+        found = self._query(query_vectors, k, candidate_ids, ["documents", "metadatas"])
+        if found is None:
+            return [[] for _ in query_vectors]
+        return [
+            [Document(page_content=content, metadata=metadata or {}) for content, metadata in zip(documents, metadatas)]
+            for documents, metadatas in zip(found["documents"], found["metadatas"])
+        ]
+
+    def max_marginal_relevance_search_by_vectors(self, query_vectors: list, k: int, fetch_k: int, lambda_mult: float,
+                                                 candidate_ids: Optional[List[str]] = None) -> List[List[Document]]:
+        """
+        複数クエリのMMR検索（クエリごとの結果のリスト）
+
+        上位fetch_k件の候補とその保存済みベクトルを1回の問い合わせで取得し、mmr_select で選択する。
+        """
+        found = self._query(query_vectors, fetch_k, candidate_ids, ["documents", "metadatas", "embeddings"])
+        if found is None:
+            return [[] for _ in query_vectors]
+        results = []
+        for i, query_vector in enumerate(query_vectors):
+            if not found["ids"][i]:
+                results.append([])
+                continue
+            selected = mmr_select(np.asarray(query_vector), np.asarray(found["embeddings"][i]), k, lambda_mult)
+            results.append([
+                Document(page_content=found["documents"][i][j], metadata=found["metadatas"][i][j] or {})
+                for j in selected
+            ])
+        return results
+
+    def similarity_search(self, query: str, k: int, candidate_ids: Optional[List[str]] = None) -> List[Document]:
+        """類似度検索（candidate_ids を指定するとその中だけを検索）"""
+        return self.similarity_search_by_vectors([self.embeddings.embed_query(query)], k, candidate_ids)[0]
+
+    def max_marginal_relevance_search(self, query: str, k: int, fetch_k: int, lambda_mult: float,
+                                      candidate_ids: Optional[List[str]] = None) -> List[Document]:
+        """MMR検索（candidate_ids を指定するとその中だけを検索）"""
+        return self.max_marginal_relevance_search_by_vectors(
+            [self.embeddings.embed_query(query)], k, fetch_k, lambda_mult, candidate_ids
+        )[0]
+
+    def get_documents(self, ids: List[str]) -> List[Document]:
+        """ベンダーIDを指定してドキュメントを取得（指定順、存在しないIDは除外）"""
+        if not ids:
+            return []
+        found = self.vectorstore._collection.get(ids=ids, include=["documents", "metadatas"])
+        by_id = {
+            doc_id: Document(page_content=content, metadata=metadata or {})
+            for doc_id, content, metadata in zip(found["ids"], found["documents"], found["metadatas"])
+        }
+        return [by_id[doc_id] for doc_id in ids if doc_id in by_id]
+
+class NumpyBackend:
+    """メモリマップした正規化済み行列による厳密検索のバックエンド"""
+
+    name = "numpy"
+
+    # 一度にスコアを計算するクエリ数（スコア行列 件数×クエリ数 のメモリ使用量を抑える）
+    query_block_size = 64
+
+    def __init__(self, index_path: str, embeddings):
+        """
+        初期化（ファイルはメモリマップするだけで、内容は検索時に必要な分だけ読まれる）
+
+        Args:
+            index_path: NumPy形式のファイルがあるディレクトリ
+            embeddings: クエリの埋め込みに使うEmbeddings
+        """
+        self.index_path = index_path
+        self.embeddings = embeddings
+        self.vectors = np.load(os.path.join(index_path, VECTORS_FILE), mmap_mode="r")
+        self.offsets = np.load(os.path.join(index_path, OFFSETS_FILE), mmap_mode="r")
+        with open(os.path.join(index_path, RECORDS_FILE), "rb") as f:
+            self._records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(f.name) else b""
+        self._row_by_id = None
+
+    def count(self) -> int:
+        """ドキュメント数"""
+        return int(self.vectors.shape[0])
+
+    def _rows_for(self, ids: List[str]) -> np.ndarray:
+        """ベンダーIDを行番号に変換（IDの対応表は初回のみ読み込む）"""
+        if self._row_by_id is None:
+            with open(os.path.join(self.index_path, IDS_FILE), "r", encoding="utf-8") as f:
+                self._row_by_id = {doc_id: row for row, doc_id in enumerate(json.load(f))}
+        return np.array([self._row_by_id[doc_id] for doc_id in ids if doc_id in self._row_by_id], dtype=np.int64)
+
+    def _document(self, row: int) -> Document:
+        record = json.loads(self._records[int(self.offsets[row]):int(self.offsets[row + 1])])
+        return Document(page_content=record["page_content"], metadata=record["metadata"])
+
+    def _top_k(self, query_vectors: np.ndarray, k: int, candidate_ids: Optional[List[str]]) -> List[np.ndarray]:
+        """
+        内積（正規化済みなのでコサイン類似度）の上位k件の行番号をクエリごとに類似度順で返す
+
+        スコアは行列とクエリ行列の積で一度に計算し、argpartition で上位k件だけを並べ替える。
+        """
+        rows = self._rows_for(candidate_ids) if candidate_ids is not None else None
+        matrix = self.vectors if rows is None else self.vectors[rows]
+        if not len(matrix):
+            return [np.array([], dtype=np.int64) for _ in query_vectors]
+
+        k = min(k, len(matrix))
+        results = []
+        for start in range(0, len(query_vectors), self.query_block_size):
+            scores = matrix @ query_vectors[start:start + self.query_block_size].T
+            top = np.argpartition(-scores, k - 1, axis=0)[:k]
+            order = np.argsort(-np.take_along_axis(scores, top, axis=0), axis=0)
+            top = np.take_along_axis(top, order, axis=0).T
+            results.extend(top if rows is None else rows[top])
+        return results
+
+    def similarity_search_by_vectors(self, query_vectors: list, k: int,
+                                     candidate_ids: Optional[List[str]] = None) -> List[List[Document]]:
+        """複数クエリの類似度検索（クエリごとの結果のリスト）"""
+        top_rows = self._top_k(_normalize(query_vectors), k, candidate_ids)
+        return [[self._document(row) for row in rows] for rows in top_rows]
+
+    def max_marginal_relevance_search_by_vectors(self, query_vectors: list, k: int, fetch_k: int, lambda_mult: float,
+                                                 candidate_ids: Optional[List[str]] = None) -> List[List[Document]]:
+        """
+        複数クエリのMMR検索（クエリごとの結果のリスト）
+
+        上位fetch_k件の行のベクトルを行列から直接取り出して mmr_select で選択し、
+        選ばれた行だけをドキュメントに変換する。
+        """
+        query_vectors = _normalize(query_vectors)
+        results = []
+        for query_vector, rows in zip(query_vectors, self._top_k(query_vectors, fetch_k, candidate_ids)):
+            selected = mmr_select(query_vector, self.vectors[rows], k, lambda_mult)
+            results.append([self._document(rows[i]) for i in selected])
+        return results
+
+    def similarity_search(self, query: str, k: int, candidate_ids: Optional[List[str]] = None) -> List[Document]:
+        """類似度検索（candidate_ids を指定するとその中だけを検索）"""
+        return self.similarity_search_by_vectors([self.embeddings.embed_query(query)], k, candidate_ids)[0]
+
+    def max_marginal_relevance_search(self, query: str, k: int, fetch_k: int, lambda_mult: float,
+                                      candidate_ids: Optional[List[str]] = None) -> List[Document]:
+        """MMR検索（candidate_ids を指定するとその中だけを検索）"""
+        return self.max_marginal_relevance_search_by_vectors(
+            [self.embeddings.embed_query(query)], k, fetch_k, lambda_mult, candidate_ids
+        )[0]
+
+    def get_documents(self, ids: List[str]) -> List[Document]:
+        """ベンダーIDを指定してドキュメントを取得（指定順、存在しないIDは除外）"""
+        return [self._document(row) for row in self._rows_for(ids)]
+
+def open_backend(index_path: str, embeddings, backend: str = "auto"):
+    """
+    インデックスのバージョンに合ったバックエンドを開く
+
+    Args:
+        index_path: インデックスのバージョンのディレクトリ
+        embeddings: クエリの埋め込みに使うEmbeddings
+        backend: "auto"（NumPy形式があれば優先）/ "chroma" / "numpy"
+
+    Raises:
+        FileNotFoundError: 指定した形式のファイルがない場合
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"不明なバックエンドです: {backend}")
+    if backend == "auto":
+        backend = "numpy" if has_numpy_store(index_path) else "chroma"
+
+    if backend == "numpy":
+        if not has_numpy_store(index_path):
+            raise FileNotFoundError(f"NumPy形式のインデックスがありません: {index_path}")
+        return NumpyBackend(index_path, embeddings)
+
+    if not has_chroma_store(index_path):
+        raise FileNotFoundError(f"Chroma形式のインデックスがありません: {index_path}")
+    return ChromaBackend(index_path, embeddings)